@@ -13,9 +13,9 @@ import asyncio
 import threading
 import logging
 from logging import Filter
-import requests
 import json
 import os
+import sqlite3
 import base64
 import re
 import io
@@ -25,25 +25,25 @@ import random
 import subprocess
 import sys
 import atexit
-from typing import TYPE_CHECKING, Dict, List, Tuple, Optional
+import math
+import importlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, Optional
 
-try:
-    import matplotlib.pyplot as plt
-    import pymysql
-except ImportError:
-    print("Установка модуля matplotlib...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "matplotlib", "pymysql"])
-    import matplotlib.pyplot as plt
+_IMPORT_STARTED = time.perf_counter()
 
-try:
-    from tonutils.client import TonapiClient
-    from tonutils.wallet import WalletV5R1
 
-except ImportError:
-    print("Установка модуля tonutils...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "tonutils"])
-    from tonutils.client import TonapiClient
-    from tonutils.wallet import WalletV5R1
+def lazy_import(module: str, package: str):
+    """Импорт тяжёлой зависимости при первом использовании, при отсутствии ставится через pip."""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        print(f"Установка модуля {package}...")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+        return importlib.import_module(module)
+
 
 try:
     import httpx
@@ -72,6 +72,8 @@ except ImportError as e:
 
 if TYPE_CHECKING:
     from cardinal import Cardinal
+    from tonutils.client import TonapiClient
+    from tonutils.wallet import WalletV5R1
 
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -112,7 +114,29 @@ default_config = {
 """,
     "AUTO_REFUND": False,
     "SHOW_SENDER": "0",
-    "USE_OLD_BALANCE": False
+    "USE_OLD_BALANCE": False,
+    "FRAGMENT_TIMEOUT": 15,
+    "PAYMENT_WORKERS": 3,
+    "BALANCE_SYNC_INTERVAL": 60,
+    "CONFIRMATION_TIMEOUT": 125,
+    "RECIPIENT_CACHE_TTL": 600,
+    "RECIPIENT_NEGATIVE_TTL": 60,
+    "LOTS_SNAPSHOT_TTL": 300,
+    "TRANSFER_BATCH_SIZE": 1,
+    "SPECULATIVE_PREPARE": False,
+    "SPECULATIVE_TTL": 120,
+    "PRIORITY_SMALL_ORDERS": 0,
+    "PRIORITY_MAX_STREAK": 3,
+    "CIRCUIT_BREAKER": True,
+    "CIRCUIT_FAILURE_RATE": 0.5,
+    "CIRCUIT_MIN_CALLS": 6,
+    "CIRCUIT_WINDOW": 120,
+    "CIRCUIT_PROBE_INTERVAL": 60,
+    "LOW_BALANCE_GUARD": True,
+    "LOW_BALANCE_HOURS": 1.0,
+    "BURN_RATE_WINDOW": 3,
+    "BALANCE_GUARD_INTERVAL": 60,
+    "WALLETS": []
 }
 
 
@@ -166,6 +190,196 @@ FRAGMENT_COOKIE = config["fragment_api"]["cookie"]
 FRAGMENT_URL = config["fragment_api"]["url"]
 SUBCATEGORY_ID = config["fragment_api"].get("subcategory_id", 2418)
 
+METRICS_FILE = "storage/plugins/auto_stars_metrics.prom"
+
+
+class PipelineMetrics:
+    """Задержки этапов выдачи Stars (p50/p95/p99), повторы, классы ошибок и глубина очереди."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+
+    def __init__(self, sample_size: int = 1000):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self.samples: Dict[str, deque] = {}
+        self.bucket_counts: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+        self.retries: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.sample_size)
+                self.bucket_counts[stage] = [0] * len(self.BUCKETS)
+                self.sums[stage] = 0.0
+            self.samples[stage].append(seconds)
+            self.sums[stage] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.bucket_counts[stage][i] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def retry(self, reason: str):
+        with self._lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def error(self, error_class: str):
+        with self._lock:
+            self.errors[error_class] = self.errors.get(error_class, 0) + 1
+
+    @staticmethod
+    def classify_error(error: str) -> str:
+        if error.startswith(UNCERTAIN_TRANSFER_ERROR):
+            return "send_uncertain"
+        if '406' in error:
+            return "http_406"
+        if 'Не удалось декодировать JSON' in error:
+            return "json_decode"
+        if 'Недостаточно средств' in error:
+            return "insufficient_funds"
+        if 'No Telegram users found' in error:
+            return "user_not_found"
+        if 'подтверждение' in error:
+            return "confirmation_timeout"
+        if '429' in error:
+            return "rate_limited"
+        if 'Server error' in error or '502' in error or '503' in error:
+            return "unavailable"
+        return "other"
+
+    def percentiles(self, stage: str) -> Tuple[float, float, float]:
+        with self._lock:
+            values = sorted(self.samples.get(stage, ()))
+        if not values:
+            return 0.0, 0.0, 0.0
+        return tuple(values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.95, 0.99))
+
+    def summary_text(self) -> str:
+        lines = ["📈 Метрики AutoStars", "────────────────────"]
+        for stage in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(stage)
+            lines.append(f"{stage}: n={len(self.samples[stage])} p50={p50:.2f}s p95={p95:.2f}s p99={p99:.2f}s")
+        for name, gauge in self.gauges.items():
+            lines.append(f"{name}: {gauge()}")
+        if self.retries:
+            lines.append("Повторы: " + ", ".join(f"{k}={v}" for k, v in sorted(self.retries.items())))
+        if self.errors:
+            lines.append("Ошибки: " + ", ".join(f"{k}={v}" for k, v in sorted(self.errors.items())))
+        return "\n".join(lines)
+
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE autostars_stage_latency_seconds histogram"]
+        with self._lock:
+            stages = {stage: (list(self.bucket_counts[stage]), self.sums[stage], len(self.samples[stage]))
+                      for stage in self.samples}
+            retries = dict(self.retries)
+            errors = dict(self.errors)
+        for stage, (counts, total, _) in sorted(stages.items()):
+            for bound, count in zip(self.BUCKETS, counts):
+                le = "+Inf" if bound == math.inf else str(bound)
+                lines.append(f'autostars_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'autostars_stage_latency_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'autostars_stage_latency_seconds_count{{stage="{stage}"}} {counts[-1]}')
+        lines.append("# TYPE autostars_stage_latency_quantile_seconds gauge")
+        for stage in sorted(stages):
+            for q, value in zip(("0.5", "0.95", "0.99"), self.percentiles(stage)):
+                lines.append(f'autostars_stage_latency_quantile_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+        lines.append("# TYPE autostars_retries_total counter")
+        for reason, count in sorted(retries.items()):
+            lines.append(f'autostars_retries_total{{reason="{reason}"}} {count}')
+        lines.append("# TYPE autostars_errors_total counter")
+        for error_class, count in sorted(errors.items()):
+            lines.append(f'autostars_errors_total{{class="{error_class}"}} {count}')
+        for name, gauge in self.gauges.items():
+            lines.append(f"# TYPE autostars_{name} gauge")
+            lines.append(f"autostars_{name} {gauge()}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+metrics = PipelineMetrics()
+
+
+class CircuitBreaker:
+    """Предохранитель внешнего сервиса: размыкается, когда доля ошибок в скользящем окне превышает порог."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 6, window: float = 120.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.state = self.CLOSED
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.on_open: Optional[Callable[[CircuitBreaker], None]] = None
+        self._calls: deque = deque()
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool, error: Optional[str] = None):
+        if not config["CIRCUIT_BREAKER"]:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not ok:
+                self.last_error = error
+            # Пока цепь разомкнута, её состояние определяют только пробные запросы SalesGuard
+            if self.state != self.CLOSED:
+                return
+            self._calls.append((now, ok))
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._calls.popleft()
+            failures = sum(1 for _, call_ok in self._calls if not call_ok)
+            total = len(self._calls)
+            if total < self.min_calls or failures / total < self.failure_rate:
+                return
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            self._calls.clear()
+        logger.error(f"Предохранитель {self.name} разомкнут: {failures} ошибок из {total} "
+                     f"за {int(self.window)} с. Последняя ошибка: {self.last_error}")
+        metrics.error(f"circuit_{self.name}")
+        if self.on_open is not None:
+            self.on_open(self)
+
+    def half_open(self):
+        with self._lock:
+            self.state = self.HALF_OPEN
+
+    def reopen(self):
+        with self._lock:
+            self.state = self.OPEN
+
+    def close(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.opened_at = None
+            self._calls.clear()
+
+
+fragment_breaker = CircuitBreaker("fragment", failure_rate=config["CIRCUIT_FAILURE_RATE"],
+                                  min_calls=config["CIRCUIT_MIN_CALLS"], window=config["CIRCUIT_WINDOW"])
+wallet_breaker = CircuitBreaker("wallet", failure_rate=config["CIRCUIT_FAILURE_RATE"],
+                                min_calls=config["CIRCUIT_MIN_CALLS"], window=config["CIRCUIT_WINDOW"])
+
 url = f"{FRAGMENT_URL}?hash={FRAGMENT_HASH}"
 headers = {
     "Accept": "application/json, text/javascript, */*; q=0.01",
@@ -184,6 +398,51 @@ headers = {
     "X-Requested-With": "XMLHttpRequest"
 }
 
+
+class FragmentClient:
+    """Общий пул keep-alive соединений к API Fragment для event loop PaymentProcessor."""
+
+    def __init__(self, timeout: float = 15.0, max_connections: int = 10):
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 5.0))
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60.0
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Клиент создаётся лениво внутри цикла, в котором будет использоваться
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(headers=headers, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @staticmethod
+    def healthy(response: httpx.Response) -> bool:
+        # Просроченные cookie/hash обычно дают 4xx или HTML-страницу вместо JSON
+        return response.status_code < 400 and response.text.lstrip()[:1] in ("{", "[")
+
+    async def post(self, data: dict, timeout: Optional[float] = None) -> httpx.Response:
+        client = self._get_client()
+        with metrics.timer(f"fragment_{data.get('method', 'request')}"):
+            try:
+                response = await client.post(url, data=data, timeout=timeout if timeout is not None else self.timeout)
+            except httpx.HTTPError as e:
+                fragment_breaker.record(False, str(e))
+                raise
+        healthy = self.healthy(response)
+        fragment_breaker.record(healthy, None if healthy else f"HTTP {response.status_code}: {response.text[:100]}")
+        return response
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+fragment_client = FragmentClient(timeout=config["FRAGMENT_TIMEOUT"])
+
+
 def decoder(data: str) -> bytes:
     while len(data) % 4 != 0:
         data += "="
@@ -203,10 +462,10 @@ def remove_at_symbol(username: str) -> str:
 
 
 def generate_order_graph(date_str: str) -> io.BytesIO:
-    if date_str not in stats_data:
+    day_stats = stats_store.day(date_str)
+    if day_stats is None:
         return None
 
-    day_stats = stats_data[date_str]
     successful = day_stats.get("successful_transactions", 0)
     unsuccessful = day_stats.get("unsuccessful_transactions", 0)
     quantities = day_stats.get("quantities_sold", {})
@@ -214,7 +473,11 @@ def generate_order_graph(date_str: str) -> io.BytesIO:
     categories = list(quantities.keys())
     quantities_sold = list(quantities.values())
 
-    fig, ax = plt.subplots(figsize=(8, 6))
+    # Figure без pyplot: график рисуется в потоке ChartRenderer, а не в главном.
+    # matplotlib загружается только при первом запросе графика
+    Figure = lazy_import("matplotlib.figure", "matplotlib").Figure
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
 
     ax.bar(['Успешные', 'Неуспешные'], [successful, unsuccessful], color=['green', 'red'], label="Статус заказов")
 
@@ -225,35 +488,223 @@ def generate_order_graph(date_str: str) -> io.BytesIO:
     ax.set_ylabel('Количество заказов')
     ax2.set_ylabel('Количество проданных Stars')
 
-    plt.title(f"Статистика заказов и проданных Stars за {date_str}")
+    ax2.set_title(f"Статистика заказов и проданных Stars за {date_str}")
     fig.tight_layout()
 
     image_stream = io.BytesIO()
-    plt.savefig(image_stream, format='png')
+    fig.savefig(image_stream, format='png')
     image_stream.seek(0)
-    plt.close(fig)
 
     return image_stream
 
 
 STATS_FILE = "plugins/stars_stats.json"
+STATS_LOG_FILE = "plugins/stars_stats.log"
+
+
+class StatsStore:
+    """Журнал транзакций только на дозапись и компактные дневные сводки.
+
+    Сводки периодически сохраняются снимком в STATS_FILE вместе со смещением журнала,
+    при загрузке дочитывается только хвост журнала после снимка.
+    """
+
+    def __init__(self, snapshot_path: str, log_path: str, snapshot_every: int = 50,
+                 snapshot_interval: float = 600.0):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.days: Dict[str, dict] = {}
+        # Номер изменения сводки за день, по нему ChartRenderer сбрасывает кэш графика
+        self.revisions: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._log_offset = 0
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        # Снимок и журнал читаются с диска при первом обращении, а не при импорте плагина
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+
+    @staticmethod
+    def _empty_day() -> dict:
+        return {
+            "successful_transactions": 0,
+            "unsuccessful_transactions": 0,
+            "quantities_sold": {}
+        }
 
+    def _apply(self, entry: dict):
+        day = self.days.setdefault(entry["date"], self._empty_day())
+        self.revisions[entry["date"]] = self.revisions.get(entry["date"], 0) + 1
+        if entry.get("status") == "success":
+            day["successful_transactions"] += 1
+        else:
+            day["unsuccessful_transactions"] += 1
+        q_str = str(entry.get("quantity"))
+        day["quantities_sold"][q_str] = day["quantities_sold"].get(q_str, 0) + 1
+        if entry.get("status") == "success" and entry.get("amount"):
+            # Почасовой расход TON и проданные звёзды — для прогноза BalanceGuard
+            hour = str(entry.get("time", "00"))[:2]
+            spent = day.setdefault("ton_spent_by_hour", {})
+            spent[hour] = spent.get(hour, 0) + float(entry["amount"])
+            stars = day.setdefault("stars_by_hour", {})
+            stars[hour] = stars.get(hour, 0) + int(entry.get("quantity") or 0)
+
+    def _append(self, entries: List[dict]):
+        with open(self.log_path, 'ab') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n")
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        snapshot = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        with self._lock:
+            self._loaded = True
+            if "days" in snapshot:
+                self.days = snapshot["days"]
+                self._log_offset = snapshot.get("log_offset", 0)
+            else:
+                # Старый формат: {дата: {..., "transactions": [...]}} — переносим историю в журнал
+                migrated = []
+                for date_str, day in snapshot.items():
+                    for transaction in day.pop("transactions", []):
+                        migrated.append(dict(transaction, date=date_str))
+                    self.days[date_str] = day
+                if migrated:
+                    self._append(migrated)
+                self._log_offset = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+                self.snapshot()
+            self._replay()
+
+    def _replay(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    logger.warning(f"Пропущена повреждённая запись журнала статистики: {line[:100]!r}")
+                self._log_offset += len(line)
+
+    def snapshot(self):
+        with self._lock:
+            if not self._loaded:
+                return
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"log_offset": self._log_offset, "days": self.days}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+
+    def record(self, success: bool, quantity: int, amount: Optional[float] = None):
+        now = datetime.datetime.now()
+        entry = {
+            "date": now.strftime("%Y-%m-%d"),
+            "time": now.strftime("%H:%M:%S"),
+            "quantity": quantity,
+            "status": "success" if success else "fail"
+        }
+        if amount is not None:
+            entry["amount"] = amount
+        line = json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n"
+        self._ensure_loaded()
+        with self._lock:
+            with open(self.log_path, 'ab') as f:
+                f.write(line)
+            self._log_offset += len(line)
+            self._apply(entry)
+            self._unsaved += 1
+            if self._unsaved >= self.snapshot_every or time.monotonic() - self._saved_at >= self.snapshot_interval:
+                self.snapshot()
+
+    def revision(self, date_str: str) -> int:
+        self._ensure_loaded()
+        with self._lock:
+            return self.revisions.get(date_str, 0)
+
+    def burn_rate(self, hours: int = 3) -> Tuple[float, Optional[float]]:
+        """Расход TON в час за последние hours часов и средняя цена одной звезды за то же время."""
+        self._ensure_loaded()
+        now = datetime.datetime.now()
+        spent = 0.0
+        stars = 0
+        with self._lock:
+            for i in range(hours):
+                slot = now - datetime.timedelta(hours=i)
+                day = self.days.get(slot.strftime("%Y-%m-%d"))
+                if day is None:
+                    continue
+                hour = slot.strftime("%H")
+                spent += day.get("ton_spent_by_hour", {}).get(hour, 0)
+                stars += day.get("stars_by_hour", {}).get(hour, 0)
+        return spent / max(1, hours), (spent / stars if stars else None)
+
+    def day(self, date_str: str) -> Optional[dict]:
+        self._ensure_loaded()
+        with self._lock:
+            day = self.days.get(date_str)
+            return json.loads(json.dumps(day)) if day is not None else None
+
+
+stats_store = StatsStore(STATS_FILE, STATS_LOG_FILE)
+
+
+class ChartRenderer:
+    """Рендер графиков !status в отдельном потоке с кэшем PNG по дате."""
 
-def load_stats() -> dict:
-    os.makedirs(os.path.dirname(STATS_FILE), exist_ok=True)
-    if not os.path.exists(STATS_FILE):
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump({}, f, ensure_ascii=False)
-    with open(STATS_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
+    def __init__(self):
+        # Один поток: matplotlib не рассчитан на параллельный рендер
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autostars-charts")
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Tuple[int, bytes]] = {}
+        self._in_flight: Dict[Tuple[str, int], Future] = {}
+
+    def render(self, date_str: str) -> Future:
+        """Future с PNG за дату или None, если статистики нет. Одинаковые запросы объединяются."""
+        revision = stats_store.revision(date_str)
+        with self._lock:
+            cached = self._cache.get(date_str)
+            if cached is not None and cached[0] == revision:
+                future = Future()
+                future.set_result(cached[1])
+                return future
+            key = (date_str, revision)
+            if key not in self._in_flight:
+                self._in_flight[key] = self._executor.submit(self._render, date_str, revision)
+            return self._in_flight[key]
+
+    def _render(self, date_str: str, revision: int) -> Optional[bytes]:
+        try:
+            image_stream = generate_order_graph(date_str)
+            if image_stream is None:
+                return None
+            png = image_stream.getvalue()
+            with self._lock:
+                self._cache[date_str] = (revision, png)
+            return png
+        finally:
+            with self._lock:
+                self._in_flight.pop((date_str, revision), None)
 
-def save_stats(stats_data: dict):
-    with open(STATS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(stats_data, f, indent=4, ensure_ascii=False)
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
 
 
-stats_data = load_stats()
+chart_renderer = ChartRenderer()
 
 
 def send_error_with_inline_url(c, USER_ID, orderID: str, error: str):
@@ -284,208 +735,682 @@ def send_error_with_inline_url(c, USER_ID, orderID: str, error: str):
     )
 
 
-def update_stats(success: bool, quantity: int):
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-    if date_str not in stats_data:
-        stats_data[date_str] = {
-            "successful_transactions": 0,
-            "unsuccessful_transactions": 0,
-            "quantities_sold": {},
-            "transactions": []
-        }
-    if success:
-        stats_data[date_str]["successful_transactions"] += 1
-    else:
-        stats_data[date_str]["unsuccessful_transactions"] += 1
-    q_str = str(quantity)
-    if q_str not in stats_data[date_str]["quantities_sold"]:
-        stats_data[date_str]["quantities_sold"][q_str] = 0
-    stats_data[date_str]["quantities_sold"][q_str] += 1
-    now_time = datetime.datetime.now().strftime("%H:%M:%S")
-    stats_data[date_str]["transactions"].append({
-        "time": now_time,
-        "quantity": quantity,
-        "status": "success" if success else "fail"
-    })
-    save_stats(stats_data)
+def update_stats(success: bool, quantity: int, amount: Optional[float] = None):
+    stats_store.record(success, quantity, amount)
 
 
-async def check_wallet_balance() -> float:
-    client = TonapiClient(api_key=API_KEY, is_testnet=IS_TESTNET)
-    wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(client, MNEMONIC)
-    balance_nano = await wallet.balance()
-    if config["USE_OLD_BALANCE"]:
-        balance_ton = balance_nano
-    else:
-        balance_ton = balance_nano / 1_000_000_000
-    logger.debug(f"Баланс кошелька: {balance_ton} TON")
-    return balance_nano
+class WalletSession:
+    """Долгоживущие TonapiClient и WalletV5R1, пересоздаются только при смене мнемоники или API ключа.
 
+    index — номер кошелька в WALLETS; None — основной кошелёк из MNEMONIC.
+    """
 
-async def send_ton_transaction(amount: float, comment: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    client = TonapiClient(api_key=API_KEY, is_testnet=IS_TESTNET)
-    wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(client, MNEMONIC)
-    balance_ton = await check_wallet_balance()
-    if balance_ton < amount:
-        error_msg = f"Недостаточно средств на кошельке. Требуется: {amount} TON, доступно: {balance_ton} TON."
-        logger.warning(error_msg)
-        return None, None, error_msg
+    def __init__(self, index: Optional[int] = None):
+        self.index = index
+        # Переводы с одного кошелька выполняются строго по одному из-за seqno
+        self.lock = asyncio.Lock()
+        self.client: Optional[TonapiClient] = None
+        self.wallet: Optional[WalletV5R1] = None
+        self._credentials: Optional[Tuple[str, bool, Tuple[str, ...]]] = None
+        self._file_credentials: Optional[Tuple[str, bool, Tuple[str, ...]]] = None
+        self._config_mtime: Optional[float] = None
 
-    async def send_transaction_task():
+    def _read_credentials(self) -> Tuple[str, bool, Tuple[str, ...]]:
+        try:
+            mtime = os.path.getmtime(CONFIG_FILE)
+        except OSError:
+            mtime = None
+        if mtime is None or mtime != self._config_mtime:
+            file_config = config
+            if mtime is not None:
+                try:
+                    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                        file_config = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    logger.warning(f"Не удалось перечитать {CONFIG_FILE}: {e}")
+            source = file_config
+            if self.index is not None:
+                wallets = file_config.get("WALLETS") or config["WALLETS"]
+                source = wallets[self.index] if self.index < len(wallets) else config["WALLETS"][self.index]
+            self._file_credentials = (
+                source.get("API_KEY", file_config.get("API_KEY", config["API_KEY"])),
+                source.get("IS_TESTNET", file_config.get("IS_TESTNET", config["IS_TESTNET"])),
+                # У кошелька из WALLETS своя мнемоника, общей с MNEMONIC нет: WalletPool такие не берёт
+                tuple(source.get("MNEMONIC") or ()) if self.index is not None
+                else tuple(source.get("MNEMONIC", config["MNEMONIC"]))
+            )
+            self._config_mtime = mtime
+        return self._file_credentials
+
+    def get_wallet(self) -> WalletV5R1:
+        credentials = self._read_credentials()
+        if self.wallet is None or credentials != self._credentials:
+            api_key, is_testnet, mnemonic = credentials
+            # tonutils загружается при первом обращении к кошельку
+            TonapiClient = lazy_import("tonutils.client", "tonutils").TonapiClient
+            WalletV5R1 = lazy_import("tonutils.wallet", "tonutils").WalletV5R1
+            self.client = TonapiClient(api_key=api_key, is_testnet=is_testnet)
+            self.wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(self.client, list(mnemonic))
+            self._credentials = credentials
+            logger.debug("Сессия кошелька TON создана.")
+        return self.wallet
+
+    async def _guarded(self, call: Callable):
         try:
-            tx_hash = await wallet.transfer(
+            result = await call()
+        except Exception as e:
+            # 406 «External message was not accepted» — гонка за seqno, а не недоступность кошелька
+            if "External message was not accepted" not in str(e):
+                wallet_breaker.record(False, str(e))
+            raise
+        wallet_breaker.record(True)
+        return result
+
+    async def balance(self):
+        return await self._guarded(lambda: self.get_wallet().balance())
+
+    async def transfer(self, destination: str, amount: float, body: str) -> str:
+        return await self._guarded(lambda: self.get_wallet().transfer(destination=destination, amount=amount, body=body))
+
+    async def batch_transfer(self, messages: List[Tuple[str, float, str]]) -> str:
+        """Одна транзакция кошелька с несколькими исходящими сообщениями (destination, amount, body)."""
+        TransferData = lazy_import("tonutils.wallet.data", "tonutils").TransferData
+        data_list = [TransferData(destination=destination, amount=amount, body=body)
+                     for destination, amount, body in messages]
+        return await self._guarded(lambda: self.get_wallet().batch_transfer(data_list=data_list))
+
+
+class TransferBatcher:
+    """Упаковывает переводы нескольких заказов в одну транзакцию кошелька.
+
+    Пока идёт перевод (и пауза на смену seqno), новые заказы копятся в очереди;
+    следующая транзакция забирает до max_messages из них разом.
+    """
+
+    # Fragment получает от нас устройство с maxMessages: 4
+    MAX_MESSAGES_LIMIT = 4
+
+    def __init__(self, wallet_session: WalletSession, max_messages: int = 1):
+        self.wallet_session = wallet_session
+        self.max_messages = max(1, min(int(max_messages), self.MAX_MESSAGES_LIMIT))
+        self.pending: List[Tuple[float, str, asyncio.Future]] = []
+        # Ссылки на запущенные _flush: без них задачу может собрать GC, а её ошибка потеряется
+        self._tasks: set = set()
+
+    async def submit(self, amount: float, comment: str) -> str:
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending.append((amount, comment, waiter))
+        task = asyncio.create_task(self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._flush_done)
+        return await waiter
+
+    def _flush_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка в пакетной отправке переводов: {task.exception()}")
+
+    async def _flush(self):
+        async with self.wallet_session.lock:
+            if not self.pending:
+                return
+            batch = self.pending[:self.max_messages]
+            del self.pending[:self.max_messages]
+            try:
+                with metrics.timer("wallet_transfer"):
+                    tx_hash = await self._send(batch)
+            except Exception as e:
+                for amount, comment, waiter in batch:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+            total = sum(amount for amount, comment, waiter in batch)
+            logger.info(f"Успешно переведено {total} TON ({len(batch)} заказ.)! TX Hash: {tx_hash}")
+            for amount, comment, waiter in batch:
+                if not waiter.done():
+                    waiter.set_result(tx_hash)
+            # Пауза остаётся под блокировкой, чтобы следующий перевод получил новый seqno
+            await asyncio.sleep(random.randint(2, 10))
+
+    async def _send(self, batch: List[Tuple[float, str, asyncio.Future]]) -> str:
+        if len(batch) == 1:
+            amount, comment, waiter = batch[0]
+            return await self.wallet_session.transfer(
                 destination=DESTINATION_ADDRESS,
                 amount=amount,
                 body=comment,
             )
-            logger.info(f"Успешно переведено {amount} TON! TX Hash: {tx_hash}")
-            await asyncio.sleep(random.randint(2, 10))
+        else:
+            return await self.wallet_session.batch_transfer(
+                [(DESTINATION_ADDRESS, amount, comment) for amount, comment, waiter in batch]
+            )
+
+
+def to_ton(balance_raw) -> float:
+    if config["USE_OLD_BALANCE"]:
+        return float(balance_raw)
+    return balance_raw / 1_000_000_000
+
+
+class BalanceLedger:
+    """Локальный баланс кошелька с резервированием сумм под заказы в работе."""
+
+    def __init__(self, wallet_session: WalletSession, sync_interval: float = 60.0):
+        self.wallet_session = wallet_session
+        self.sync_interval = sync_interval
+        self.balance: Optional[float] = None
+        self.synced_at = 0.0
+        self.reservations: Dict[str, float] = {}
+        # Подтверждённые переводы держат резерв до ближайшей синхронизации с сетью
+        self._settled: set = set()
+        self._sync_lock = asyncio.Lock()
+        self._sync_requested = asyncio.Event()
+
+    @property
+    def reserved(self) -> float:
+        return sum(self.reservations.values())
+
+    @property
+    def unsettled(self) -> int:
+        """Число заказов, перевод по которым ещё не подтверждён (без резервов, ждущих синхронизации)."""
+        return len(self.reservations.keys() - self._settled)
+
+    @property
+    def available(self) -> Optional[float]:
+        if self.balance is None:
+            return None
+        return self.balance - self.reserved
+
+    async def sync(self) -> float:
+        async with self._sync_lock:
+            settled = set(self._settled)
+            balance_raw = await self.wallet_session.balance()
+            self.balance = to_ton(balance_raw)
+            self.synced_at = time.time()
+            for order_id in settled:
+                self.reservations.pop(order_id, None)
+                self._settled.discard(order_id)
+            logger.debug(f"Баланс кошелька: {self.balance} TON, в резерве: {self.reserved} TON")
+            return self.balance
+
+    async def current(self) -> float:
+        if self.balance is None:
+            await self.sync()
+        return self.balance
+
+    async def reserve(self, order_id: str, amount: float) -> Tuple[bool, float]:
+        if self.balance is None:
+            await self.sync()
+        available = self.available
+        if available < amount:
+            return False, available
+        self.reservations[order_id] = amount
+        return True, available
+
+    def release(self, order_id: str):
+        self.reservations.pop(order_id, None)
+        self._settled.discard(order_id)
+
+    def settle(self, order_id: str):
+        if order_id in self.reservations:
+            self._settled.add(order_id)
+        self.request_sync()
+
+    def request_sync(self):
+        self._sync_requested.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._sync_requested.wait(), timeout=self.sync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._sync_requested.clear()
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning(f"Не удалось синхронизировать баланс кошелька: {e}")
+
+
+class WalletShard:
+    """Один кошелёк пула: своя сессия (и seqno), свой батчер переводов и свой баланс."""
+
+    def __init__(self, name: str, index: Optional[int], max_messages: int, sync_interval: float):
+        self.name = name
+        self.session = WalletSession(index)
+        self.batcher = TransferBatcher(self.session, max_messages=max_messages)
+        self.ledger = BalanceLedger(self.session, sync_interval=sync_interval)
+
+    @property
+    def in_flight(self) -> int:
+        return self.ledger.unsettled
+
+
+class WalletPool:
+    """Кошельки из WALLETS (или один MNEMONIC): заказ закрепляется за кошельком при резервировании.
+
+    Выбирается кошелёк, которому хватает средств, с наименьшим числом переводов в работе,
+    а при равенстве — с наибольшим доступным балансом. Переводы разных кошельков идут параллельно.
+    """
+
+    def __init__(self, shards: List[WalletShard]):
+        self.shards = shards
+        self._assigned: Dict[str, WalletShard] = {}
+        self._reserve_lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, max_messages: int = 1, sync_interval: float = 60.0) -> WalletPool:
+        wallets = config["WALLETS"]
+        shards = []
+        mnemonics = set()
+        for index, wallet in enumerate(wallets):
+            name = wallet.get("name") or f"wallet{index + 1}"
+            mnemonic = tuple(wallet.get("MNEMONIC") or ())
+            # Два шарда одного кошелька делили бы seqno под разными блокировками и дважды считали баланс
+            if not mnemonic:
+                logger.error(f"Кошелёк {name} из WALLETS пропущен: не указана его MNEMONIC.")
+                continue
+            if mnemonic in mnemonics:
+                logger.error(f"Кошелёк {name} из WALLETS пропущен: такая MNEMONIC уже есть в пуле.")
+                continue
+            mnemonics.add(mnemonic)
+            shards.append(WalletShard(name, index, max_messages, sync_interval))
+        if not shards:
+            return cls([WalletShard("main", None, max_messages, sync_interval)])
+        return cls(shards)
+
+    @property
+    def balance(self) -> Optional[float]:
+        balances = [shard.ledger.balance for shard in self.shards if shard.ledger.balance is not None]
+        return sum(balances) if balances else None
+
+    @property
+    def available(self) -> Optional[float]:
+        available = [shard.ledger.available for shard in self.shards if shard.ledger.available is not None]
+        return sum(available) if available else None
+
+    @property
+    def reserved(self) -> float:
+        return sum(shard.ledger.reserved for shard in self.shards)
+
+    @property
+    def reservations(self) -> Dict[str, float]:
+        reservations = {}
+        for shard in self.shards:
+            reservations.update(shard.ledger.reservations)
+        return reservations
+
+    def shard_of(self, order_id: str) -> Optional[WalletShard]:
+        return self._assigned.get(order_id)
+
+    async def _sync_shard(self, shard: WalletShard) -> Optional[float]:
+        try:
+            return await shard.ledger.sync()
+        except Exception as e:
+            logger.warning(f"Не удалось получить баланс кошелька {shard.name}: {e}")
+            return None
+
+    async def sync(self) -> float:
+        """Синхронизирует все кошельки; ошибка, только если не ответил ни один."""
+        balances = await asyncio.gather(*(self._sync_shard(shard) for shard in self.shards))
+        if all(balance is None for balance in balances):
+            raise RuntimeError("Ни один кошелёк пула не ответил")
+        return self.balance
+
+    async def current(self) -> float:
+        if any(shard.ledger.balance is None for shard in self.shards):
+            await self.sync()
+        return self.balance
+
+    async def reserve(self, order_id: str, amount: float) -> Tuple[bool, float]:
+        """Закрепляет заказ за кошельком; при неудаче возвращает наибольший доступный баланс одного кошелька."""
+        async with self._reserve_lock:
+            unsynced = [shard for shard in self.shards if shard.ledger.balance is None]
+            if unsynced:
+                await asyncio.gather(*(self._sync_shard(shard) for shard in unsynced))
+            candidates = [shard for shard in self.shards
+                          if shard.ledger.available is not None and shard.ledger.available >= amount]
+            if not candidates:
+                best = max((shard.ledger.available for shard in self.shards if shard.ledger.available is not None),
+                           default=0.0)
+                return False, best
+            shard = min(candidates, key=lambda item: (item.in_flight, -item.ledger.available))
+            reserved, available = await shard.ledger.reserve(order_id, amount)
+            if reserved:
+                self._assigned[order_id] = shard
+                logger.debug(f"Заказ {order_id} закреплён за кошельком {shard.name}")
+            return reserved, available
+
+    async def submit(self, order_id: str, amount: float, comment: str) -> str:
+        return await self._assigned[order_id].batcher.submit(amount, comment)
+
+    def release(self, order_id: str):
+        shard = self._assigned.pop(order_id, None)
+        if shard is not None:
+            shard.ledger.release(order_id)
+
+    def settle(self, order_id: str):
+        shard = self._assigned.pop(order_id, None)
+        if shard is not None:
+            shard.ledger.settle(order_id)
+        else:
+            # Заказ из сверки после перезапуска: кошелёк неизвестен, обновляем все балансы
+            self.request_sync()
+
+    def request_sync(self):
+        for shard in self.shards:
+            shard.ledger.request_sync()
+
+    async def run(self):
+        await asyncio.gather(*(shard.ledger.run() for shard in self.shards))
+
+
+DUPLICATE_PAYMENT_ERROR = "Перевод по заказу уже отправлялся, повторная оплата отменена."
+UNCERTAIN_TRANSFER_ERROR = "Перевод мог уйти в сеть, заказ передан продавцу на ручную проверку."
+# Ошибки, при которых внешнее сообщение точно не принято в сеть: отклонено или запрос отбит лимитом.
+# Любая другая ошибка (таймаут, обрыв соединения) могла случиться уже после отправки,
+# и такой перевод нельзя ни повторять, ни возвращать
+TRANSFER_NOT_SENT_ERRORS = ("External message was not accepted", "429")
+
+
+def transfer_not_sent(error: str) -> bool:
+    return any(marker in error for marker in TRANSFER_NOT_SENT_ERRORS)
+
+
+async def send_ton_transaction(amount: float, comment: str, order_id: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    wallets = get_payment_processor().wallets
+    reserved, available = await wallets.reserve(order_id, amount)
+    if not reserved:
+        error_msg = f"Недостаточно средств на кошельке. Требуется: {amount} TON, доступно: {available} TON."
+        logger.warning(error_msg)
+        return None, None, error_msg
+
+    if not payment_ledger.begin_transfer(order_id):
+        wallets.release(order_id)
+        return None, None, DUPLICATE_PAYMENT_ERROR
+
+    async def send_transaction_task():
+        try:
+            shard = wallets.shard_of(order_id)
+            tx_hash = await wallets.submit(order_id, amount, comment)
+            payment_ledger.mark(order_id, "sent", tx_hash=tx_hash, amount=amount, wallet=shard.name)
             logger.debug(f"Ссылка Tonviewer: https://tonviewer.com/transaction/{tx_hash}")
             ref_id = comment.split("Ref#")[-1].strip()
             return tx_hash, ref_id, None
         except Exception as e:
             error_msg = f"Ошибка при отправке транзакции: {e}"
             logger.error(error_msg)
-            return None, None, error_msg
+            if transfer_not_sent(str(e)):
+                wallets.release(order_id)
+                payment_ledger.mark(order_id, "send_failed", error=str(e)[:200])
+                return None, None, error_msg
+            # Резерв снимается только после синхронизации баланса: списание могло пройти
+            wallets.settle(order_id)
+            payment_ledger.mark(order_id, "manual", reason="send_uncertain", error=str(e)[:200])
+            return None, None, f"{UNCERTAIN_TRANSFER_ERROR} {error_msg}"
 
     task = asyncio.create_task(send_transaction_task())
     result = await task
     return result
 
 
-async def main_async(username: str, quantity: int) -> Tuple[Optional[str], Optional[str], int, Optional[str]]:
-    if quantity:
-        clean_username = remove_at_symbol(username)
-        logger.debug(f"Очистенный username: {clean_username}")
-        payload_search = {
-            "query": clean_username,
-            "quantity": quantity,
-            "method": "searchStarsRecipient"
-        }
-        logger.debug(f"Payload для поиска recipient: {payload_search}")
+class RecipientCache:
+    """TTL-кэш searchStarsRecipient по нормализованному username, включая ответы «не найден»."""
+
+    def __init__(self, ttl: float = 600.0, negative_ttl: float = 60.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, Optional[dict], Optional[str]]] = {}
+
+    @staticmethod
+    def normalize(username: str) -> str:
+        return remove_at_symbol(username.strip()).lower()
+
+    def get(self, username: str) -> Optional[Tuple[Optional[dict], Optional[str]]]:
+        key = self.normalize(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, found, error = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+        return found, error
+
+    def put(self, username: str, found: Optional[dict], error: Optional[str] = None):
+        ttl = self.ttl if found else self.negative_ttl
+        with self._lock:
+            self._entries[self.normalize(username)] = (time.monotonic() + ttl, found, error)
+
+
+recipient_cache = RecipientCache(ttl=config["RECIPIENT_CACHE_TTL"], negative_ttl=config["RECIPIENT_NEGATIVE_TTL"])
+
+
+async def search_recipient(username: str, quantity: int = 50) -> Tuple[Optional[dict], Optional[str]]:
+    """Возвращает блок 'found' ответа searchStarsRecipient или текст ошибки."""
+    cached = recipient_cache.get(username)
+    if cached is not None:
+        logger.debug(f"Recipient для {username} взят из кэша.")
+        return cached
+    clean_username = remove_at_symbol(username.strip())
+    logger.debug(f"Очистенный username: {clean_username}")
+    payload_search = {
+        "query": clean_username,
+        "quantity": quantity,
+        "method": "searchStarsRecipient"
+    }
+    logger.debug(f"Payload для поиска recipient: {payload_search}")
+    try:
+        response_search = await fragment_client.post(payload_search)
+        response_search.raise_for_status()
+        logger.debug(f"Ответ сервера (поиск recipient): {response_search.text}")
+        if not response_search.text:
+            error_msg = "Пустой ответ от сервера Fragment при поиске recipient."
+            logger.error(error_msg)
+            return None, error_msg
         try:
-            response_search = requests.post(url, headers=headers, data=payload_search)
-            response_search.raise_for_status()
-            logger.debug(f"Ответ сервера (поиск recipient): {response_search.text}")
-            if not response_search.text:
-                error_msg = "Пустой ответ от сервера Fragment при поиске recipient."
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            try:
-                text_search = response_search.json()
-            except json.JSONDecodeError as e:
-                error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_search.text}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            logger.debug(f"JSON поиска recipient: {text_search}")
-        except requests.RequestException as e:
-            error_msg = f"Ошибка при запросе поиска recipient: {e}"
+            text_search = response_search.json()
+        except json.JSONDecodeError as e:
+            error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_search.text}"
             logger.error(error_msg)
-            return None, None, quantity, error_msg
-        if text_search.get('ok') is True:
-            recipient = text_search.get('found', {}).get('recipient')
-            if not recipient:
-                error_msg = f"Recipient не найден в ответе: {text_search}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-        else:
-            error_detail = text_search.get('error', 'Неизвестная ошибка при поиске recipient.')
-            error_msg = f"Ошибка при поиске recipient: {error_detail}"
+            return None, error_msg
+        logger.debug(f"JSON поиска recipient: {text_search}")
+    except httpx.HTTPError as e:
+        error_msg = f"Ошибка при запросе поиска recipient: {e}"
+        logger.error(error_msg)
+        return None, error_msg
+    if text_search.get('ok') is True:
+        found = text_search.get('found') or {}
+        if not found.get('recipient'):
+            error_msg = f"Recipient не найден в ответе: {text_search}"
             logger.error(error_msg)
-            return None, None, quantity, error_msg
-        payload_init = {
-            "recipient": recipient,
-            "quantity": quantity,
-            "method": "initBuyStarsRequest"
-        }
-        logger.debug(f"Payload для инициализации покупки: {payload_init}")
+            return None, error_msg
+        recipient_cache.put(username, found)
+        return found, None
+    error_detail = text_search.get('error', 'Неизвестная ошибка при поиске recipient.')
+    error_msg = f"Ошибка при поиске recipient: {error_detail}"
+    logger.error(error_msg)
+    if 'No Telegram users found' in str(error_detail):
+        recipient_cache.put(username, None, error_msg)
+    return None, error_msg
+
+
+def search_recipient_sync(username: str, timeout: Optional[float] = None) -> Tuple[Optional[dict], Optional[str]]:
+    """search_recipient для потоков FunPay: выполняется в цикле PaymentProcessor через общий пул соединений."""
+    future = asyncio.run_coroutine_threadsafe(search_recipient(username), get_payment_processor().loop)
+    return future.result(timeout=timeout or config["FRAGMENT_TIMEOUT"] + 5)
+
+
+async def prepare_purchase(username: str, quantity: int) -> Tuple[Optional[dict], Optional[str]]:
+    """Все запросы к Fragment до перевода: recipient, req_id, сумма и комментарий с Ref#."""
+    found, error_msg = await search_recipient(username, quantity)
+    if error_msg:
+        return None, error_msg
+    recipient = found['recipient']
+    payload_init = {
+        "recipient": recipient,
+        "quantity": quantity,
+        "method": "initBuyStarsRequest"
+    }
+    logger.debug(f"Payload для инициализации покупки: {payload_init}")
+    try:
+        response_init = await fragment_client.post(payload_init)
+        response_init.raise_for_status()
+        logger.debug(f"Ответ сервера (инициализация покупки): {response_init.text}")
+        if not response_init.text:
+            error_msg = "Пустой ответ от сервера Fragment при инициализации покупки."
+            logger.error(error_msg)
+            return None, error_msg
         try:
-            response_init = requests.post(url, headers=headers, data=payload_init)
-            response_init.raise_for_status()
-            logger.debug(f"Ответ сервера (инициализация покупки): {response_init.text}")
-            if not response_init.text:
-                error_msg = "Пустой ответ от сервера Fragment при инициализации покупки."
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            try:
-                text_init = response_init.json()
-            except json.JSONDecodeError as e:
-                error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_init.text}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            logger.debug(f"JSON инициализации покупки: {text_init}")
-        except requests.RequestException as e:
-            error_msg = f"Ошибка при инициализации покупки Stars: {e}"
+            text_init = response_init.json()
+        except json.JSONDecodeError as e:
+            error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_init.text}"
             logger.error(error_msg)
-            return None, None, quantity, error_msg
-        req_id = text_init.get('req_id')
+            return None, error_msg
+        logger.debug(f"JSON инициализации покупки: {text_init}")
+    except httpx.HTTPError as e:
+        error_msg = f"Ошибка при инициализации покупки Stars: {e}"
+        logger.error(error_msg)
+        return None, error_msg
+    req_id = text_init.get('req_id')
+    try:
+        AMOUNT = float(text_init.get('amount', 0))
+        logger.debug(f"Требуемая сумма: {AMOUNT} TON")
+    except (TypeError, ValueError):
+        AMOUNT = 0
+        logger.error("Не удалось конвертировать 'amount' в float.")
+    if not req_id or AMOUNT == 0:
+        error_msg = f"Не удалось получить req_id или amount: {text_init}"
+        logger.error(error_msg)
+        return None, error_msg
+    payload_link = {
+        "account": '{"address":"0:adc5b49f73e4796ecc3c290ad0d89f87fa552b515d173d5295469df9612c24a","chain":"-239","walletStateInit":"te6ccgECFgEAAwQAAgE0AQIBFP8A9KQT9LzyyAsDAFEAAAAAKamjF5hE%2BFriD8Ufe710n9USsAZBzBxLOlXNYCYDiPBRvJZXQAIBIAQFAgFIBgcE%2BPKDCNcYINMf0x%2FT%2F%2FQE0VFDuvKhUVG68qIF%2BQFUEGT5EPKj%2BAAkpMjLH1JAyx9SMMv%2FUhD0AMntVPgPAdMHIcAAn2xRkyDXSpbTB9QC%2BwDoMOAhwAHjACHAAuMAAcADkTDjDQOkyMsfEssfy%2F8SExQVAubQAdDTAyFxsJJfBOAi10nBIJJfBOAC0x8hghBwbHVnvSKCEGRzdHK9sJJfBeAD%2BkAwIPpEAcjKB8v%2FydDtRNCBAUDXIfQEMFyBAQj0Cm%2BhMbOSXwfgBdM%2FyCWCEHBsdWe6kjgw4w0DghBkc3RyupJJfBuMNCAkCASAKCwB4AfoA9AQw%2BCdvIjBQCqEhvvLgUIIQcGx1Z4MesXCAGFAEywUmzxZY%2BgIZ9ADLaRfLH1Jgyz8gyYBA%2BwAGAIpQBIEBCPRZMO1E0IEBQNcgyAHPFvQAye1UAXKwjiOCEGRzdHKDHrFwgBhQBcsFUAPPFiP6AhPLassfyz%2FJgED7AJJfA%2BICASAMDQBZvSQrb2omhAgKBrkPoCGEcNQICEekk30pkQzmkD6f%2BYN4EoAbeBAUiYcVnzGEAgFYDg8AEbjJftRNDXCx%2BAA9sp37UTQgQFA1yH0BDACyMoHy%2F%2FJ0AGBAQj0Cm%2BhMYAIBIBARABmtznaiaEAga5Drhf%2FAABmvHfaiaEAQa5DrhY%2FAAG7SB%2FoA1NQi%2BQAFyMoHFcv%2FydB3dIAYyMsFywIizxZQBfoCFMtrEszMyXP7AMhAFIEBCPRR8qcCAHCBAQjXGPoA0z%2FIVCBHgQEI9FHyp4IQbm90ZXB0gBjIywXLAlAGzxZQBPoCE8tqEszMyXP7AMhAFIEBCPRR8qcCAHCBAQjXGPoA0z%2FIVCBHgQEI9FHyp4IQZHN0cnB0gBjIywXLAlAFzxZQA%2FoCE8tqyx8Syz%2FJc%2FsAAAr0AMntVA%3D%3D"}',
+        "device": '{"platform":"android","appName":"Tonkeeper","appVersion":"5.0.18","maxProtocolVersion":2,"features":["SendTransaction",{"name":"SendTransaction","maxMessages":4}]}',
+        "transaction": "1",
+        "id": req_id,
+        "show_sender": SHOW_SENDER,
+        "method": "getBuyStarsLink"
+    }
+    logger.debug(f"Payload для получения ссылки на покупку: {payload_link}")
+    try:
+        response_link = await fragment_client.post(payload_link)
+        response_link.raise_for_status()
+        logger.debug(f"Ответ сервера (получение ссылки на покупку): {response_link.text}")
+        if not response_link.text:
+            error_msg = "Пустой ответ от сервера Fragment при получении ссылки на покупку."
+            logger.error(error_msg)
+            return None, error_msg
         try:
-            AMOUNT = float(text_init.get('amount', 0))
-            logger.debug(f"Требуемая сумма: {AMOUNT} TON")
-        except (TypeError, ValueError):
-            AMOUNT = 0
-            logger.error("Не удалось конвертировать 'amount' в float.")
-        if not req_id or AMOUNT == 0:
-            error_msg = f"Не удалось получить req_id или amount: {text_init}"
+            text_link = response_link.json()
+        except json.JSONDecodeError as e:
+            error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_link.text}"
             logger.error(error_msg)
-            return None, None, quantity, error_msg
-        payload_link = {
-            "account": '{"address":"0:adc5b49f73e4796ecc3c290ad0d89f87fa552b515d173d5295469df9612c24a","chain":"-239","walletStateInit":"te6ccgECFgEAAwQAAgE0AQIBFP8A9KQT9LzyyAsDAFEAAAAAKamjF5hE%2BFriD8Ufe710n9USsAZBzBxLOlXNYCYDiPBRvJZXQAIBIAQFAgFIBgcE%2BPKDCNcYINMf0x%2FT%2F%2FQE0VFDuvKhUVG68qIF%2BQFUEGT5EPKj%2BAAkpMjLH1JAyx9SMMv%2FUhD0AMntVPgPAdMHIcAAn2xRkyDXSpbTB9QC%2BwDoMOAhwAHjACHAAuMAAcADkTDjDQOkyMsfEssfy%2F8SExQVAubQAdDTAyFxsJJfBOAi10nBIJJfBOAC0x8hghBwbHVnvSKCEGRzdHK9sJJfBeAD%2BkAwIPpEAcjKB8v%2FydDtRNCBAUDXIfQEMFyBAQj0Cm%2BhMbOSXwfgBdM%2FyCWCEHBsdWe6kjgw4w0DghBkc3RyupJJfBuMNCAkCASAKCwB4AfoA9AQw%2BCdvIjBQCqEhvvLgUIIQcGx1Z4MesXCAGFAEywUmzxZY%2BgIZ9ADLaRfLH1Jgyz8gyYBA%2BwAGAIpQBIEBCPRZMO1E0IEBQNcgyAHPFvQAye1UAXKwjiOCEGRzdHKDHrFwgBhQBcsFUAPPFiP6AhPLassfyz%2FJgED7AJJfA%2BICASAMDQBZvSQrb2omhAgKBrkPoCGEcNQICEekk30pkQzmkD6f%2BYN4EoAbeBAUiYcVnzGEAgFYDg8AEbjJftRNDXCx%2BAA9sp37UTQgQFA1yH0BDACyMoHy%2F%2FJ0AGBAQj0Cm%2BhMYAIBIBARABmtznaiaEAga5Drhf%2FAABmvHfaiaEAQa5DrhY%2FAAG7SB%2FoA1NQi%2BQAFyMoHFcv%2FydB3dIAYyMsFywIizxZQBfoCFMtrEszMyXP7AMhAFIEBCPRR8qcCAHCBAQjXGPoA0z%2FIVCBHgQEI9FHyp4IQbm90ZXB0gBjIywXLAlAGzxZQBPoCE8tqEszMyXP7AMhAFIEBCPRR8qcCAHCBAQjXGPoA0z%2FIVCBHgQEI9FHyp4IQZHN0cnB0gBjIywXLAlAFzxZQA%2FoCE8tqyx8Syz%2FJc%2FsAAAr0AMntVA%3D%3D"}',
-            "device": '{"platform":"android","appName":"Tonkeeper","appVersion":"5.0.18","maxProtocolVersion":2,"features":["SendTransaction",{"name":"SendTransaction","maxMessages":4}]}',
-            "transaction": "1",
-            "id": req_id,
-            "show_sender": SHOW_SENDER,
-            "method": "getBuyStarsLink"
-        }
-        logger.debug(f"Payload для получения ссылки на покупку: {payload_link}")
+            return None, error_msg
+        logger.debug(f"JSON получения ссылки на покупку: {text_link}")
+    except httpx.HTTPError as e:
+        error_msg = f"Ошибка при получении ссылки на покупку Stars: {e}"
+        logger.error(error_msg)
+        return None, error_msg
+    if text_link.get('ok') is True:
+        transaction_messages = text_link.get('transaction', {}).get('messages', [])
+        logger.debug(f"Сообщения транзакции: {transaction_messages}")
+        if not transaction_messages:
+            error_msg = f"Сообщения транзакции не найдены: {text_link}"
+            logger.error(error_msg)
+            return None, error_msg
+        payload_transaction = transaction_messages[0].get('payload')
+        logger.debug(f"Payload транзакции: {payload_transaction}")
+        if not payload_transaction:
+            error_msg = f"Payload сообщения транзакции не найден: {text_link}"
+            logger.error(error_msg)
+            return None, error_msg
         try:
-            response_link = requests.post(url, headers=headers, data=payload_link)
-            response_link.raise_for_status()
-            logger.debug(f"Ответ сервера (получение ссылки на покупку): {response_link.text}")
-            if not response_link.text:
-                error_msg = "Пустой ответ от сервера Fragment при получении ссылки на покупку."
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            try:
-                text_link = response_link.json()
-            except json.JSONDecodeError as e:
-                error_msg = f"Не удалось декодировать JSON: {e}. Ответ сервера: {response_link.text}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            logger.debug(f"JSON получения ссылки на покупку: {text_link}")
-        except requests.RequestException as e:
-            error_msg = f"Ошибка при получении ссылки на покупку Stars: {e}"
+            decoded_payload = decoder(payload_transaction)
+            ref_id = decoder2(data=decoded_payload)
+            COMMENT = f"{quantity} Telegram Stars \n\nRef#{ref_id}"
+            logger.debug(f"Комментарий для транзакции: {COMMENT}")
+        except Exception as e:
+            error_msg = f"Ошибка при обработке payload транзакции: {e}"
             logger.error(error_msg)
-            return None, None, quantity, error_msg
-        if text_link.get('ok') is True:
-            transaction_messages = text_link.get('transaction', {}).get('messages', [])
-            logger.debug(f"Сообщения транзакции: {transaction_messages}")
-            if not transaction_messages:
-                error_msg = f"Сообщения транзакции не найдены: {text_link}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            payload_transaction = transaction_messages[0].get('payload')
-            logger.debug(f"Payload транзакции: {payload_transaction}")
-            if not payload_transaction:
-                error_msg = f"Payload сообщения транзакции не найден: {text_link}"
-                logger.error(error_msg)
-                return None, None, quantity, error_msg
-            try:
-                decoded_payload = decoder(payload_transaction)
-                ref_id = decoder2(data=decoded_payload)
-                COMMENT = f"{quantity} Telegram Stars \n\nRef#{ref_id}"
-                logger.debug(f"Комментарий для транзакции: {COMMENT}")
-            except Exception as e:
-                error_msg = f"Ошибка при обработке payload транзакции: {e}"
-                logger.error(error_msg)
+            return None, error_msg
+    else:
+        error_detail = text_link.get('error', 'Неизвестная ошибка при получении ссылки на покупку Stars.')
+        error_msg = f"Ошибка при получении ссылки на покупку Stars: {error_detail}"
+        logger.error(error_msg)
+        return None, error_msg
+    return {
+        "recipient": recipient,
+        "req_id": req_id,
+        "amount": AMOUNT,
+        "comment": COMMENT,
+        "ref_id": ref_id
+    }, None
+
+
+class SpeculativePreparer:
+    """Готовит покупку Fragment заранее, пока покупатель подтверждает username (SPECULATIVE_PREPARE)."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, ttl: float = 120.0):
+        self.loop = loop
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[str, int, float, asyncio.Task]] = {}
+
+    def start(self, order_id: str, username: str, quantity: int):
+        """Потокобезопасно: вызывается из обработчиков FunPay."""
+        self.loop.call_soon_threadsafe(self._start, order_id, username, quantity)
+
+    def discard(self, order_id: str):
+        self.loop.call_soon_threadsafe(self._discard, order_id)
+
+    def _start(self, order_id: str, username: str, quantity: int):
+        now = time.monotonic()
+        for expired_id in [key for key, entry in self._entries.items() if now - entry[2] > self.ttl]:
+            self._discard(expired_id)
+        self._discard(order_id)
+        task = asyncio.ensure_future(prepare_purchase(username, quantity))
+        self._entries[order_id] = (RecipientCache.normalize(username), quantity, now, task)
+        logger.debug(f"Начата предварительная подготовка покупки для заказа {order_id}")
+
+    def _discard(self, order_id: str):
+        entry = self._entries.pop(order_id, None)
+        if entry is not None and not entry[3].done():
+            entry[3].cancel()
+
+    async def take(self, order_id: str, username: str, quantity: int) -> Optional[dict]:
+        """Готовая покупка для заказа или None, если её нет, она устарела или подготовлена для другого username."""
+        entry = self._entries.pop(order_id, None)
+        if entry is None:
+            return None
+        prepared_username, prepared_quantity, created_at, task = entry
+        if (prepared_username != RecipientCache.normalize(username) or prepared_quantity != quantity
+                or time.monotonic() - created_at > self.ttl):
+            task.cancel()
+            return None
+        try:
+            prepared, error_msg = await task
+        except Exception as e:
+            logger.debug(f"Предварительная подготовка заказа {order_id} не удалась: {e}")
+            return None
+        if error_msg:
+            return None
+        logger.debug(f"Использована заранее подготовленная покупка для заказа {order_id}")
+        return prepared
+
+
+async def main_async(username: str, quantity: int, order_id: str) -> Tuple[Optional[str], Optional[str], int, Optional[str]]:
+    if quantity:
+        prepared = await get_payment_processor().speculative.take(order_id, username, quantity)
+        if prepared is None:
+            prepared, error_msg = await prepare_purchase(username, quantity)
+            if error_msg:
                 return None, None, quantity, error_msg
-        else:
-            error_detail = text_link.get('error', 'Неизвестная ошибка при получении ссылки на покупку Stars.')
-            error_msg = f"Ошибка при получении ссылки на покупку Stars: {error_detail}"
-            logger.error(error_msg)
-            return None, None, quantity, error_msg
+        if not payment_ledger.resolve_recipient(order_id, recipient=prepared["recipient"], amount=prepared["amount"],
+                                                ref_id=prepared["ref_id"]):
+            return None, None, quantity, DUPLICATE_PAYMENT_ERROR
         try:
-            tx_hash, ref_id, error_transaction = await send_ton_transaction(AMOUNT, COMMENT)
+            tx_hash, ref_id, error_transaction = await send_ton_transaction(prepared["amount"], prepared["comment"], order_id)
             if error_transaction:
                 return None, None, quantity, error_transaction
             if not tx_hash or not ref_id:
@@ -499,17 +1424,853 @@ async def main_async(username: str, quantity: int) -> Tuple[Optional[str], Optio
         return tx_hash, ref_id, quantity, None
 
 
-orders_info: Dict[int, List[Dict[str, str | int | bool | None]]] = {}
+def normalize_tx_hash(tx_hash: str) -> str:
+    """Приводит hex/base64/base64url хеш к hex, чтобы сопоставлять ответы toncenter с отправленными переводами."""
+    value = str(tx_hash).strip()
+    if re.fullmatch(r'[0-9a-fA-F]{64}', value):
+        return value.lower()
+    try:
+        raw = base64.urlsafe_b64decode(value.replace('+', '-').replace('/', '_') + '=' * (-len(value) % 4))
+        if len(raw) == 32:
+            return raw.hex()
+    except ValueError:
+        pass
+    return value
+
+
+def normalize_address(address: str) -> str:
+    """Приводит адрес TON (raw или user-friendly) к виду workchain:hex; нераспознанный адрес возвращается как есть."""
+    value = str(address).strip()
+    if ":" in value:
+        workchain, _, account = value.partition(":")
+        return f"{workchain}:{account.lower()}"
+    try:
+        raw = base64.urlsafe_b64decode(value.replace('+', '-').replace('/', '_') + '=' * (-len(value) % 4))
+        if len(raw) == 36:
+            return f"{int.from_bytes(raw[1:2], 'big', signed=True)}:{raw[2:34].hex()}"
+    except ValueError:
+        pass
+    return value
+
+
+class ConfirmationPoller:
+    """Общий опрос toncenter: все ожидающие подтверждения переводы проверяются пакетными запросами.
+
+    В пакетной транзакции у нескольких заказов один хеш, поэтому каждый заказ подтверждается
+    по своему исходящему переводу (адрес, сумма и Ref#), а не по успеху трассы целиком.
+    """
+
+    TRACES_URL = "https://preview.toncenter.com/api/v3/traces"
+
+    def __init__(self, timeout: float = 125.0, batch_size: int = 16, min_interval: float = 1.0,
+                 max_interval: float = 8.0):
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending: Dict[str, dict] = {}
+        self._wakeup = asyncio.Event()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def wait(self, tx_hash: str, amount: Optional[float] = None,
+                   ref_id: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+        """Ждёт перевод заказа; без amount достаточно любого успешного действия в трассе."""
+        key = normalize_tx_hash(tx_hash)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = {
+                "tx_hash": tx_hash,
+                "waiters": [],
+                "deadline": time.monotonic() + self.timeout,
+                "error": None
+            }
+            self.pending[key] = entry
+        waiter = asyncio.get_running_loop().create_future()
+        entry["waiters"].append((waiter, amount, ref_id))
+        self._wakeup.set()
+        return await waiter
+
+    def _resolve(self, key: str, success: bool, error: Optional[str] = None):
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        for waiter, amount, ref_id in entry["waiters"]:
+            if not waiter.done():
+                waiter.set_result((success, error))
+
+    @staticmethod
+    def match(transfers: Optional[List[dict]], amount: Optional[float] = None,
+              ref_id: Optional[str] = None) -> Optional[bool]:
+        """Итог перевода заказа в найденной трассе: True / False (перевод не прошёл) / None (ещё не виден)."""
+        if not transfers:
+            return None
+        if amount is None:
+            return True if any(transfer["success"] for transfer in transfers) else None
+        destination = normalize_address(DESTINATION_ADDRESS)
+        value = round(amount * 1_000_000_000)
+        own = [transfer for transfer in transfers
+               if transfer["value"] is not None and abs(transfer["value"] - value) <= 1
+               and (transfer["destination"] is None or ":" not in destination
+                    or transfer["destination"] == destination)]
+        if ref_id and len(own) > 1:
+            own = [transfer for transfer in own if f"Ref#{ref_id}" in (transfer["comment"] or "")] or own
+        if not own:
+            return None
+        return any(transfer["success"] for transfer in own)
+
+    def _settle(self, key: str, transfers: List[dict]) -> bool:
+        """Разрешает ожидания, чей перевод найден в трассе; остальные ждут дальше. True, если разрешено хоть одно."""
+        entry = self.pending.get(key)
+        if entry is None:
+            return False
+        remaining = []
+        for waiter, amount, ref_id in entry["waiters"]:
+            outcome = self.match(transfers, amount, ref_id)
+            if outcome is None:
+                remaining.append((waiter, amount, ref_id))
+            elif not waiter.done():
+                waiter.set_result((outcome, None if outcome else "Перевод по заказу не выполнен в сети (отклонён)."))
+        resolved = len(entry["waiters"]) - len(remaining)
+        entry["waiters"] = remaining
+        if not remaining:
+            self.pending.pop(key, None)
+            logger.info(f"Транзакция с хешем {entry['tx_hash']} найдена в сети.")
+        return resolved > 0
+
+    async def lookup(self, tx_hashes: List[str]) -> Dict[str, List[dict]]:
+        """Один запрос к toncenter; нормализованный хеш -> исходящие переводы найденной трассы.
+
+        Перевод: destination (workchain:hex), value (нанотоны), comment и success своего действия.
+        """
+        params = [("msg_hash", tx_hash) for tx_hash in tx_hashes]
+        params += [("include_actions", "true"), ("limit", str(max(len(tx_hashes), 10)))]
+        rq = await self._get_client().get(self.TRACES_URL, params=params)
+        response_data = rq.json()
+        if 'traces' not in response_data:
+            # Ошибка toncenter не должна выглядеть как «трасса не найдена»
+            raise RuntimeError(f"toncenter {rq.status_code}: {str(response_data)[:200]}")
+        keys = {normalize_tx_hash(tx_hash) for tx_hash in tx_hashes}
+        found: Dict[str, List[dict]] = {}
+        for trace in response_data.get('traces', []):
+            trace_hashes = {trace.get('external_hash')}
+            for transaction in (trace.get('transactions') or {}).values():
+                in_msg = transaction.get('in_msg') or {}
+                trace_hashes.update((in_msg.get('hash'), in_msg.get('hash_norm')))
+            transfers = []
+            for action in trace.get('actions', []):
+                trace_hashes.add(action.get('trace_external_hash'))
+                details = action.get('details') or {}
+                value = details.get('value')
+                transfers.append({
+                    "destination": normalize_address(details['destination']) if details.get('destination') else None,
+                    "value": int(value) if value is not None else None,
+                    "comment": details.get('comment'),
+                    "success": bool(action.get('success', False))
+                })
+            matched = keys & {normalize_tx_hash(h) for h in trace_hashes if h}
+            if not matched and len(keys) == 1:
+                matched = keys
+            for key in matched:
+                found.setdefault(key, []).extend(transfers)
+        return found
+
+    async def run(self):
+        delay = self.min_interval
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                delay = self.min_interval
+            self._wakeup.clear()
+            keys = list(self.pending)
+            resolved_any = False
+            for i in range(0, len(keys), self.batch_size):
+                chunk = [key for key in keys[i:i + self.batch_size] if key in self.pending]
+                if not chunk:
+                    continue
+                try:
+                    found = await self.lookup([self.pending[key]["tx_hash"] for key in chunk])
+                except Exception as e:
+                    logger.error(f"Ошибка при проверке транзакций ({len(chunk)} шт.): {e}")
+                    for key in chunk:
+                        if key in self.pending:
+                            self.pending[key]["error"] = str(e)
+                    continue
+                for key, transfers in found.items():
+                    if self._settle(key, transfers):
+                        resolved_any = True
+            now = time.monotonic()
+            for key, entry in list(self.pending.items()):
+                if entry["deadline"] <= now:
+                    self._resolve(key, False, entry["error"] or
+                                  f"Не удалось получить подтверждение транзакции за {int(self.timeout)} с.")
+            if self.pending:
+                logger.debug(f"Ожидают подтверждения: {len(self.pending)} транзакций, следующая проверка через {delay:.1f} с.")
+            delay = self.min_interval if resolved_any else min(delay * 1.5, self.max_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                delay = self.min_interval
+            except asyncio.TimeoutError:
+                pass
+
+
+ORDERS_DB_FILE = "storage/plugins/auto_stars_orders.sqlite3"
+
+
+class OrderStore:
+    """Заказы в SQLite (WAL): переживают перезапуск, активный заказ чата ищется за O(1)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        # База открывается в BIND_TO_PRE_INIT (или при первом обращении), а не при импорте плагина
+        self._connection: Optional[sqlite3.Connection] = None
+        # В памяти держим только незавершённые заказы: order_id -> заказ и чат -> order_id по порядку
+        self._orders: Dict[str, dict] = {}
+        self._pending_by_chat: Dict[int, List[str]] = {}
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.open()
+        return self._connection
+
+    def open(self):
+        with self._lock:
+            if self._connection is not None:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._init_schema()
+            self._load_pending()
+
+    def _init_schema(self):
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            "order_id TEXT PRIMARY KEY, "
+            "buyer_chat_id INTEGER NOT NULL, "
+            "completed INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "data TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_orders_chat_completed ON orders (buyer_chat_id, completed)"
+        )
+
+    def _load_pending(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT order_id, buyer_chat_id, data FROM orders WHERE completed = 0 ORDER BY created_at"
+            ).fetchall()
+            loaded = 0
+            for order_id, buyer_chat_id, data in rows:
+                order = json.loads(data)
+                # Отменённые заказы из старых версий, где они не закрывались: закрываем и не загружаем
+                if order.get("is_canceled"):
+                    order["completed"] = True
+                    self._write(order)
+                    continue
+                self._orders[order_id] = order
+                self._pending_by_chat.setdefault(buyer_chat_id, []).append(order_id)
+                loaded += 1
+        if loaded:
+            logger.info(f"Загружено незавершённых заказов: {loaded}")
+
+    def _write(self, order: dict, created: bool = False):
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO orders (order_id, buyer_chat_id, completed, created_at, updated_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(order_id) DO UPDATE SET buyer_chat_id = excluded.buyer_chat_id, "
+            "completed = excluded.completed, updated_at = excluded.updated_at, data = excluded.data"
+            + (", created_at = excluded.created_at" if created else ""),
+            (order["orderID"], order["buyer_chat_id"], int(bool(order.get("completed"))), now, now,
+             json.dumps(order, ensure_ascii=False))
+        )
+
+    def _unindex(self, order_id: str, buyer_chat_id: int):
+        chat_orders = self._pending_by_chat.get(buyer_chat_id)
+        if chat_orders and order_id in chat_orders:
+            chat_orders.remove(order_id)
+            if not chat_orders:
+                del self._pending_by_chat[buyer_chat_id]
+
+    def add(self, buyer_chat_id: int, order: dict) -> dict:
+        self.open()
+        order = dict(order, buyer_chat_id=buyer_chat_id)
+        order_id = order["orderID"]
+        with self._lock:
+            previous = self._orders.pop(order_id, None)
+            if previous is not None:
+                self._unindex(order_id, previous["buyer_chat_id"])
+            if not order.get("completed"):
+                self._orders[order_id] = order
+                self._pending_by_chat.setdefault(buyer_chat_id, []).append(order_id)
+            self._write(order, created=True)
+        return order
+
+    def get(self, order_id: str) -> Optional[dict]:
+        self.open()
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is not None:
+                return order
+            row = self._conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def active(self, buyer_chat_id: int) -> Optional[dict]:
+        """Последний незавершённый заказ чата."""
+        self.open()
+        with self._lock:
+            chat_orders = self._pending_by_chat.get(buyer_chat_id)
+            return self._orders[chat_orders[-1]] if chat_orders else None
+
+    def pending(self) -> List[dict]:
+        self.open()
+        with self._lock:
+            return list(self._orders.values())
+
+    def update(self, order_id: str, **fields) -> Optional[dict]:
+        self.open()
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                return None
+            order.update(fields)
+            if order.get("completed"):
+                del self._orders[order_id]
+                self._unindex(order_id, order["buyer_chat_id"])
+            self._write(order)
+        return order
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+order_store = OrderStore(ORDERS_DB_FILE)
+
+
+class PaymentLedger:
+    """Журнал этапов оплаты по orderID в SQLite: один заказ не может быть оплачен или возвращён дважды.
+
+    Этапы: queued → recipient → sending → sent → confirmed, а также send_failed (сеть точно не приняла
+    перевод или он не прошёл в сети), refunding, refunded, released (заказ можно поставить в очередь
+    заново, например после смены username),
+    failed (обработка прекращена, продавец и покупатель уведомлены) и manual (исход перевода
+    неизвестен, заказ ждёт ручной проверки продавцом). failed и manual — конечные этапы.
+    """
+
+    # Пока заказ в одном из этих этапов, повторная постановка в очередь ничего не делает
+    CLAIM_ALLOWED = {"released"}
+    # Перевод уже ушёл или мог уйти: второй перевод по заказу запрещён
+    TRANSFER_BLOCKED = {"sending", "sent", "confirmed", "refunding", "refunded", "failed", "manual"}
+    # Stars выданы, перевод в процессе или ушёл в сеть, или деньги уже возвращены.
+    # Из sent вернуть деньги можно только после проверки в сети (PaymentProcessor.recheck_transfer),
+    # из manual — только по кнопке продавца
+    REFUND_BLOCKED = {"sending", "sent", "confirmed", "refunding", "refunded", "manual"}
+    # Этапы, которые не сверяются после перезапуска
+    FINAL = ("confirmed", "refunded", "released", "failed", "manual")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.open()
+        return self._connection
+
+    def open(self):
+        with self._lock:
+            if self._connection is not None:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._init_schema()
+
+    def _init_schema(self):
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_ledger ("
+            "order_id TEXT PRIMARY KEY, "
+            "stage TEXT NOT NULL, "
+            "tx_hash TEXT, "
+            "updated_at REAL NOT NULL, "
+            "history TEXT NOT NULL)"
+        )
+
+    def get(self, order_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stage, tx_hash, updated_at, history FROM payment_ledger WHERE order_id = ?", (order_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"order_id": order_id, "stage": row[0], "tx_hash": row[1], "updated_at": row[2],
+                "history": json.loads(row[3])}
+
+    def stage(self, order_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT stage FROM payment_ledger WHERE order_id = ?", (order_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark(self, order_id: str, stage: str, tx_hash: Optional[str] = None, **detail):
+        now = time.time()
+        entry = dict(detail, stage=stage, at=now)
+        if tx_hash:
+            entry["tx_hash"] = tx_hash
+        with self._lock:
+            row = self._conn.execute("SELECT history FROM payment_ledger WHERE order_id = ?", (order_id,)).fetchone()
+            history = json.loads(row[0]) if row else []
+            history.append(entry)
+            self._conn.execute(
+                "INSERT INTO payment_ledger (order_id, stage, tx_hash, updated_at, history) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(order_id) DO UPDATE SET stage = excluded.stage, "
+                "tx_hash = COALESCE(excluded.tx_hash, payment_ledger.tx_hash), "
+                "updated_at = excluded.updated_at, history = excluded.history",
+                (order_id, stage, tx_hash, now, json.dumps(history, ensure_ascii=False))
+            )
+
+    def _transition(self, order_id: str, stage: str, allowed: Callable[[Optional[str]], bool], **detail) -> bool:
+        with self._lock:
+            current = self.stage(order_id)
+            if not allowed(current):
+                logger.warning(f"Заказ {order_id}: переход {current} → {stage} отклонён журналом оплат.")
+                return False
+            self.mark(order_id, stage, previous=current, **detail)
+            return True
+
+    def claim(self, order_id: str) -> bool:
+        """Постановка в очередь оплаты; False, если заказ уже в работе или обработан."""
+        return self._transition(order_id, "queued", lambda current: current is None or current in self.CLAIM_ALLOWED)
+
+    def resolve_recipient(self, order_id: str, **detail) -> bool:
+        return self._transition(order_id, "recipient", lambda current: current not in self.TRANSFER_BLOCKED, **detail)
+
+    def begin_transfer(self, order_id: str) -> bool:
+        """Проверка перед переводом с кошелька: False, если перевод по заказу уже отправлялся."""
+        return self._transition(order_id, "sending", lambda current: current not in self.TRANSFER_BLOCKED)
+
+    def give_up(self, order_id: str, **detail) -> str:
+        """Отказ от оплаты заказа: failed, если перевода не было, manual, если перевод уже начат.
+
+        Конечные этапы и возврат в процессе не меняются. Возвращает итоговый этап.
+        """
+        with self._lock:
+            current = self.stage(order_id)
+            if current in self.FINAL or current == "refunding":
+                return current
+            stage = "manual" if current in ("sending", "sent") else "failed"
+            self.mark(order_id, stage, previous=current, **detail)
+            return stage
+
+    def unfinished(self) -> List[dict]:
+        """Заказы, оплата которых начата, но не доведена до конечного этапа."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT order_id FROM payment_ledger WHERE stage NOT IN ({', '.join('?' * len(self.FINAL))})",
+                self.FINAL
+            ).fetchall()
+        return [self.get(order_id) for (order_id,) in rows]
+
+    def can_transfer(self, order_id: str) -> bool:
+        return self.stage(order_id) not in self.TRANSFER_BLOCKED
+
+    def begin_refund(self, order_id: str, by_seller: bool = False) -> bool:
+        """Проверка перед возвратом: False, если Stars выданы, перевод в процессе или возврат уже был.
+
+        Заказ на ручной проверке (manual) возвращается только по решению продавца.
+        """
+        return self._transition(order_id, "refunding",
+                                 lambda current: current not in self.REFUND_BLOCKED
+                                 or (by_seller and current == "manual"))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+payment_ledger = PaymentLedger(ORDERS_DB_FILE)
+
+
+def refund_order(c: Cardinal, order_id: str, by_seller: bool = False) -> bool:
+    """Возврат через журнал оплат: повторный возврат или возврат выполненного заказа ничего не делает."""
+    if not payment_ledger.begin_refund(order_id, by_seller=by_seller):
+        return False
+    previous = (payment_ledger.get(order_id) or {}).get("history", [{}])[-1].get("previous")
+    try:
+        c.account.refund(order_id)
+    except Exception:
+        # Возврат не прошёл — заказ возвращается в прежний этап, чтобы его можно было вернуть повторно
+        payment_ledger.mark(order_id, previous or "released", error="refund_failed")
+        raise
+    payment_ledger.mark(order_id, "refunded")
+    order_store.update(order_id, is_canceled=True, completed=True)
+    return True
+
+
+def give_up_order(order_id: str, reason: str) -> str:
+    """Отказ от оплаты: конечный этап в журнале (PaymentLedger.give_up), заказ закрывается в OrderStore.
+
+    Закрытый заказ не загружается при следующих запусках; сверка и возврат продавцом берут его из базы.
+    """
+    stage = payment_ledger.give_up(order_id, reason=reason)
+    order_store.update(order_id, completed=True)
+    return stage
+
+
+class FairPaymentScheduler:
+    """Очередь платежей: round-robin по покупателям и приоритет мелких заказов (PRIORITY_SMALL_ORDERS).
+
+    Приоритет ограничен: после max_priority_streak мелких заказов подряд, если ждут крупные,
+    берётся крупный, так что поток мелких заказов не задерживает крупный бесконечно.
+    put и position вызываются из потоков FunPay, get — из воркеров цикла PaymentProcessor.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, small_order_threshold: int = 0, max_priority_streak: int = 3):
+        self.loop = loop
+        self.small_order_threshold = small_order_threshold
+        self.max_priority_streak = max(1, max_priority_streak)
+        # Сколько мелких заказов выдано подряд
+        self._streak = 0
+        self._lock = threading.Lock()
+        # Покупатель -> его заказы; покупатель, чей заказ взят в работу, уходит в конец круга
+        self._priority: OrderedDict = OrderedDict()
+        self._regular: OrderedDict = OrderedDict()
+        self._available = asyncio.Semaphore(0)
+        self._durations: deque = deque(maxlen=50)
+
+    def _is_priority(self, task: tuple) -> bool:
+        return 0 < self.small_order_threshold and task[3] <= self.small_order_threshold
+
+    def put(self, task: tuple) -> int:
+        buyer_chat_id = task[1]
+        with self._lock:
+            ring = self._priority if self._is_priority(task) else self._regular
+            ring.setdefault(buyer_chat_id, deque()).append(task)
+            position = self._position_locked(task[4])
+        self.loop.call_soon_threadsafe(self._available.release)
+        return position
+
+    @staticmethod
+    def _pop_from(ring: OrderedDict) -> tuple:
+        buyer_chat_id, tasks = ring.popitem(last=False)
+        task = tasks.popleft()
+        if tasks:
+            ring[buyer_chat_id] = tasks
+        return task
+
+    def _choose(self, priority: OrderedDict, regular: OrderedDict, streak: int) -> Tuple[OrderedDict, int]:
+        if priority and (not regular or streak < self.max_priority_streak):
+            return priority, streak + 1
+        return regular, 0
+
+    async def get(self) -> tuple:
+        await self._available.acquire()
+        with self._lock:
+            ring, self._streak = self._choose(self._priority, self._regular, self._streak)
+            return self._pop_from(ring)
+
+    def _position_locked(self, order_id: str) -> int:
+        priority, regular = (OrderedDict((buyer, deque(tasks)) for buyer, tasks in ring.items())
+                             for ring in (self._priority, self._regular))
+        streak = self._streak
+        position = 0
+        while priority or regular:
+            ring, streak = self._choose(priority, regular, streak)
+            position += 1
+            if self._pop_from(ring)[4] == order_id:
+                return position
+        return 0
+
+    def position(self, order_id: str) -> int:
+        """Номер заказа в очереди (с 1) в порядке выдачи; 0 — заказа в очереди нет."""
+        with self._lock:
+            return self._position_locked(order_id)
+
+    def qsize(self) -> int:
+        with self._lock:
+            return sum(len(tasks) for ring in (self._priority, self._regular) for tasks in ring.values())
+
+    def pending_stars(self) -> int:
+        with self._lock:
+            return sum(task[3] for ring in (self._priority, self._regular) for tasks in ring.values() for task in tasks)
+
+    def record_duration(self, seconds: float):
+        self._durations.append(seconds)
+
+    def eta(self, position: int, workers: int) -> float:
+        """Ожидание в секундах по средней длительности последних заказов."""
+        durations = list(self._durations)
+        average = sum(durations) / len(durations) if durations else 30.0
+        return math.ceil(position / max(1, workers)) * average
+
+
+class BalanceGuard:
+    """Прогноз остатка кошелька по расходу TON в час из статистики.
+
+    Если доступного баланса (за вычетом резервов и заказов в очереди) хватит меньше чем
+    на LOW_BALANCE_HOURS часов продаж, лоты Stars выключаются заранее; после пополнения
+    кошелька они включаются обратно.
+    """
+
+    # Пополнение считается замеченным, если баланс вырос хотя бы на столько TON
+    TOP_UP_THRESHOLD = 0.05
+
+    def __init__(self, wallets: WalletPool, task_queue: FairPaymentScheduler, interval: float = 60.0,
+                 low_hours: float = 1.0, window_hours: int = 3):
+        self.wallets = wallets
+        self.task_queue = task_queue
+        self.interval = interval
+        self.low_hours = low_hours
+        self.window_hours = window_hours
+        self.lots_disabled = False
+        self._disabled_balance: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def forecast(self) -> Optional[Tuple[float, float, Optional[float]]]:
+        """(доступно с учётом очереди, расход TON/ч, часов до нуля) или None, если баланс ещё неизвестен."""
+        available = self.wallets.available
+        if available is None:
+            return None
+        burn_rate, ton_per_star = stats_store.burn_rate(self.window_hours)
+        if ton_per_star:
+            available -= self.task_queue.pending_stars() * ton_per_star
+        runway = available / burn_rate if burn_rate > 0 else None
+        return available, burn_rate, runway
+
+    async def deactivate(self, reason: str, c: Optional[Cardinal] = None):
+        """Выключает лоты один раз, сколько бы заказов ни упёрлось в нехватку средств."""
+        async with self._lock:
+            if self.lots_disabled:
+                return
+            self.lots_disabled = True
+            self._disabled_balance = self.wallets.balance
+        c = c or cardinal_ref
+        logger.warning(f"Лоты Stars выключаются: {reason}")
+        if c is None:
+            return
+        try:
+            await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                f"⚠️ Лоты Stars выключены: {reason}\nПосле пополнения кошелька они включатся автоматически."))
+            await asyncio.to_thread(deactivate_lots, c, USER_ID)
+        except Exception as e:
+            logger.error(f"Не удалось выключить лоты: {e}")
+
+    async def _reactivate(self, balance: float):
+        async with self._lock:
+            if not self.lots_disabled:
+                return
+            self.lots_disabled = False
+            self._disabled_balance = None
+        logger.info(f"Замечено пополнение кошелька: {balance} TON, лоты Stars включаются.")
+        if cardinal_ref is None:
+            return
+        try:
+            await asyncio.to_thread(cardinal_ref.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                f"✅ Кошелёк пополнен ({balance} TON), лоты Stars снова включены."))
+            await asyncio.to_thread(activate_lots, cardinal_ref, USER_ID)
+        except Exception as e:
+            logger.error(f"Не удалось включить лоты: {e}")
+
+    async def check(self):
+        forecast = self.forecast()
+        if forecast is None:
+            return
+        available, burn_rate, runway = forecast
+        if not self.lots_disabled:
+            if available <= 0:
+                await self.deactivate(f"баланса {available:.2f} TON не хватит на заказы в очереди.")
+            elif runway is not None and runway < self.low_hours:
+                await self.deactivate(f"при расходе {burn_rate:.2f} TON/ч баланса хватит на {runway * 60:.0f} мин.")
+            return
+        balance = self.wallets.balance
+        topped_up = self._disabled_balance is None or balance >= self._disabled_balance + self.TOP_UP_THRESHOLD
+        # Включаем с запасом вдвое больше порога, чтобы лоты не переключались туда-обратно
+        if topped_up and available > 0 and (runway is None or runway >= self.low_hours * 2):
+            await self._reactivate(balance)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not config["LOW_BALANCE_GUARD"] or not RUNNING:
+                continue
+            try:
+                await self.check()
+            except Exception as e:
+                logger.warning(f"Ошибка прогноза баланса: {e}")
+
+
+class SalesGuard:
+    """Автопауза продаж при размыкании предохранителя Fragment или кошелька.
+
+    Выключает только лоты: новые заказы и ответы покупателей по-прежнему принимаются и ждут
+    в очереди, воркеры перестают брать из неё заказы, а заказы, которые были в работе,
+    возвращаются в очередь без траты попыток. Раз в CIRCUIT_PROBE_INTERVAL (с удвоением
+    до max_probe_interval) выполняются пробные запросы; после успеха очередь разбирается
+    и лоты включаются обратно.
+    """
+
+    PROBE_PAYLOAD = {"query": "telegram", "quantity": 50, "method": "searchStarsRecipient"}
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, breakers: List[CircuitBreaker], wallets: WalletPool,
+                 balance_guard: BalanceGuard, probe_interval: float = 60.0, max_probe_interval: float = 900.0):
+        self.loop = loop
+        self.breakers = breakers
+        self.wallets = wallets
+        self.balance_guard = balance_guard
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.tripped = False
+        # Лоты выключены предохранителем и включаются им же при замыкании
+        self._lots_paused = False
+        self._closed = asyncio.Event()
+        self._closed.set()
+        for breaker in breakers:
+            breaker.on_open = self._on_open
+
+    def _on_open(self, breaker: CircuitBreaker):
+        # record вызывается в цикле PaymentProcessor: заказ, чей запрос разомкнул цепь, уже видит tripped
+        # и откладывается, а не возвращается. Уведомления и лоты — позже, в самом цикле
+        if self.tripped:
+            return
+        self.tripped = True
+        self.loop.call_soon_threadsafe(self._trip, breaker)
+
+    def _trip(self, breaker: CircuitBreaker):
+        self._closed.clear()
+        asyncio.ensure_future(self._pause(breaker))
+        asyncio.ensure_future(self._probe_loop())
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    async def _notify(self, text: str):
+        if cardinal_ref is None:
+            return
+        try:
+            await asyncio.to_thread(cardinal_ref.telegram.bot.send_message, USER_ID, sanitize_telegram_text(text))
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление о предохранителе: {e}")
+
+    async def _toggle_lots(self, active: bool):
+        if cardinal_ref is None:
+            return
+        try:
+            await asyncio.to_thread(activate_lots if active else deactivate_lots, cardinal_ref, USER_ID)
+        except Exception as e:
+            logger.error(f"Не удалось {'включить' if active else 'выключить'} лоты: {e}")
+
+    async def _pause(self, breaker: CircuitBreaker):
+        await self._notify(
+            f"🛑 Автопродажа Stars приостановлена: {breaker.name} недоступен.\n"
+            f"Последняя ошибка: {breaker.last_error}\n"
+            f"Новые заказы принимаются и ждут в очереди, проверка каждые {int(self.probe_interval)} с."
+        )
+        if RUNNING and not self.balance_guard.lots_disabled:
+            self._lots_paused = True
+            await self._toggle_lots(False)
+
+    async def _probe(self) -> bool:
+        for breaker in self.breakers:
+            breaker.half_open()
+        try:
+            response = await fragment_client.post(dict(self.PROBE_PAYLOAD))
+            if not FragmentClient.healthy(response):
+                logger.warning(f"Пробный запрос к Fragment неудачен: HTTP {response.status_code}")
+                return False
+            await self.wallets.sync()
+        except Exception as e:
+            logger.warning(f"Пробный запрос неудачен: {e}")
+            return False
+        return True
+
+    async def _probe_loop(self):
+        interval = self.probe_interval
+        while True:
+            await asyncio.sleep(interval)
+            if await self._probe():
+                break
+            for breaker in self.breakers:
+                breaker.reopen()
+            interval = min(interval * 2, self.max_probe_interval)
+            logger.info(f"Предохранитель остаётся разомкнутым, следующая проверка через {int(interval)} с.")
+        for breaker in self.breakers:
+            breaker.close()
+        self.tripped = False
+        self._closed.set()
+        logger.info("Предохранитель замкнут, Fragment и кошелёк отвечают.")
+        lots_paused, self._lots_paused = self._lots_paused, False
+        # Лоты, выключенные из-за нехватки средств, включит BalanceGuard после пополнения
+        if lots_paused and not self.balance_guard.lots_disabled:
+            await self._toggle_lots(True)
+        await self._notify("🚀 Fragment и кошелёк снова отвечают, отложенные заказы выполняются, "
+                           "автопродажа Stars возобновлена." if lots_paused else
+                           "✅ Fragment и кошелёк снова отвечают, отложенные заказы выполняются.")
 
 
 class PaymentProcessor:
-    def __init__(self):
+    def __init__(self, workers: int = 1):
         self.loop = asyncio.new_event_loop()
         self.thread = threading.Thread(target=self.run_loop, daemon=True)
         self.thread.start()
         logger.debug("Поток PaymentProcessor запущен.")
-        self.task_queue = asyncio.Queue()
-        asyncio.run_coroutine_threadsafe(self.queue_worker(), self.loop)
+        self.task_queue = FairPaymentScheduler(self.loop, small_order_threshold=config["PRIORITY_SMALL_ORDERS"],
+                                               max_priority_streak=config["PRIORITY_MAX_STREAK"])
+        # Переводы с одного кошелька выполняются строго по одному (см. WalletSession.lock),
+        # разные кошельки пула и остальные этапы заказов работают параллельно
+        self.wallets = WalletPool.from_config(max_messages=config["TRANSFER_BATCH_SIZE"],
+                                              sync_interval=config["BALANCE_SYNC_INTERVAL"])
+        asyncio.run_coroutine_threadsafe(self.wallets.run(), self.loop)
+        self.speculative = SpeculativePreparer(self.loop, ttl=config["SPECULATIVE_TTL"])
+        self.confirmations = ConfirmationPoller(timeout=config["CONFIRMATION_TIMEOUT"])
+        asyncio.run_coroutine_threadsafe(self.confirmations.run(), self.loop)
+        self.balance_guard = BalanceGuard(self.wallets, self.task_queue,
+                                          interval=config["BALANCE_GUARD_INTERVAL"],
+                                          low_hours=config["LOW_BALANCE_HOURS"], window_hours=config["BURN_RATE_WINDOW"])
+        asyncio.run_coroutine_threadsafe(self.balance_guard.run(), self.loop)
+        self.guard = SalesGuard(self.loop, [fragment_breaker, wallet_breaker], self.wallets,
+                                self.balance_guard, probe_interval=config["CIRCUIT_PROBE_INTERVAL"])
+        metrics.gauges["queue_depth"] = self.task_queue.qsize
+        metrics.gauges["pending_confirmations"] = lambda: len(self.confirmations.pending)
+        metrics.gauges["circuit_open"] = lambda: int(self.guard.tripped)
+        for shard in self.wallets.shards:
+            metrics.gauges[f"wallet_{shard.name}_in_flight"] = lambda shard=shard: shard.in_flight
+        asyncio.run_coroutine_threadsafe(self.metrics_writer(), self.loop)
+        self.workers = max(1, int(workers))
+        self.busy_workers = 0
+        for worker_id in range(self.workers):
+            asyncio.run_coroutine_threadsafe(self.queue_worker(worker_id), self.loop)
+        logger.debug(f"Запущено воркеров PaymentProcessor: {self.workers}")
+
+    async def metrics_writer(self, interval: float = 30.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(metrics.write, METRICS_FILE)
+            except Exception as e:
+                logger.warning(f"Не удалось записать метрики в {METRICS_FILE}: {e}")
 
     def run_loop(self):
         asyncio.set_event_loop(self.loop)
@@ -517,21 +2278,112 @@ class PaymentProcessor:
         self.loop.run_forever()
 
     def enqueue_payment(self, c: Cardinal, buyer_chat_id: int, username: str, stars_quantity: int, orderID: str):
-        task = (c, buyer_chat_id, username, stars_quantity, orderID)
-        position_in_queue = self.task_queue.qsize() + 1
-        asyncio.run_coroutine_threadsafe(self.task_queue.put(task), self.loop)
+        # Повторное «Да» или повторное событие по уже принятому заказу ничего не делает
+        if not payment_ledger.claim(orderID):
+            logger.info(f"Заказ {orderID} уже в обработке или обработан, повторная постановка в очередь пропущена.")
+            return 0
+        task = (c, buyer_chat_id, username, stars_quantity, orderID, time.perf_counter())
+        position_in_queue = self.task_queue.put(task)
+        if self.guard.tripped:
+            try:
+                c.send_message(buyer_chat_id, sanitize_telegram_text(
+                    "⏳ Платёжный сервис временно недоступен. Ваш заказ сохранён и будет выполнен автоматически."))
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить покупателя {buyer_chat_id}: {e}")
+            return position_in_queue
+        # Есть свободный воркер — заказ уйдёт в работу сразу, сообщать об очереди незачем
+        if self.busy_workers + position_in_queue > self.workers:
+            eta = self.task_queue.eta(position_in_queue, self.workers)
+            try:
+                c.send_message(buyer_chat_id, sanitize_telegram_text(
+                    f"⏳ Ваш заказ в очереди: позиция {position_in_queue}, ожидание ~{max(1, round(eta / 60))} мин."))
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить покупателю {buyer_chat_id} позицию в очереди: {e}")
         return position_in_queue
 
-    async def queue_worker(self):
+    async def queue_worker(self, worker_id: int = 0):
         while True:
+            # Пока предохранитель разомкнут, заказы остаются в очереди
+            await self.guard.wait_closed()
             task = await self.task_queue.get()
+            # Заказ, взятый воркером перед самым размыканием, тоже ждёт, не теряя места
+            await self.guard.wait_closed()
+            started = time.perf_counter()
+            self.busy_workers += 1
             try:
-                c, buyer_chat_id, username, stars_quantity, orderID = task
-                await self.process_payment(c, buyer_chat_id, username, stars_quantity, orderID)
+                c, buyer_chat_id, username, stars_quantity, orderID, enqueued_at = task
+                metrics.observe("queue_wait", started - enqueued_at)
+                with metrics.timer("payment_total"):
+                    await self.process_payment(c, buyer_chat_id, username, stars_quantity, orderID)
             except Exception as e:
-                logger.error(f"[queue_worker] Ошибка при обработке задачи: {e}")
+                logger.error(f"[queue_worker {worker_id}] Ошибка при обработке задачи: {e}")
             finally:
-                self.task_queue.task_done()
+                self.busy_workers -= 1
+                self.task_queue.record_duration(time.perf_counter() - started)
+
+    async def recheck_transfer(self, order_id: str, tx_hash: str, amount: Optional[float],
+                               ref_id: Optional[str]) -> Optional[bool]:
+        """Повторная проверка неподтверждённого перевода перед возвратом денег.
+
+        True — перевод выполнен; False — перевод найден в трассе и не прошёл, заказ переводится в send_failed
+        и его можно вернуть; None — трассы нет или проверить не удалось, заказ уходит на ручную проверку
+        (manual). Отсутствие трассы не доказывает, что перевода не было: индексатор toncenter может отставать.
+        """
+        try:
+            found = await self.confirmations.lookup([tx_hash])
+        except Exception as e:
+            logger.warning(f"Не удалось перепроверить перевод заказа {order_id}: {e}")
+            outcome = None
+        else:
+            outcome = ConfirmationPoller.match(found.get(normalize_tx_hash(tx_hash)), amount, ref_id)
+        if outcome is False:
+            payment_ledger.mark(order_id, "send_failed", reason="failed_on_chain")
+        elif outcome is None:
+            payment_ledger.mark(order_id, "manual", reason="unverified_transfer")
+        return outcome
+
+    async def complete_payment(self, c: Cardinal, buyer_chat_id: int, username: str, stars_quantity: int, quantity: int,
+                               orderID: str, tx_hash: str, ref_id: str, amount: Optional[float] = None):
+        """Перевод подтверждён в сети: журнал, статистика, уведомления покупателю и продавцу."""
+        payment_ledger.mark(orderID, "confirmed", tx_hash=tx_hash)
+        logger.info(f"Платёж успешен для {username}: TX Hash: {tx_hash}, Ref ID: {ref_id}, Qty: {quantity}")
+        self.wallets.settle(orderID)
+        update_stats(True, stars_quantity, amount)
+        # Уведомления блокирующие, поэтому уходят в поток, чтобы не задерживать другие заказы
+        with metrics.timer("funpay_send_message"):
+            await asyncio.to_thread(
+                c.send_message,
+                buyer_chat_id,
+                sanitize_telegram_text(f"""
+🌟 Успешная сделка!
+👤 Покупатель: {username}
+⭐️ Stars: {quantity}
+🔑 Ref ID: Ref#{ref_id}
+✅ Статус: Готово
+
+🔗 Доп подробности: {tx_hash}
+
+
+📝 Оставьте отзыв — это мотивирует! 😎
+            """)
+            )
+        await asyncio.to_thread(
+            c.telegram.bot.send_message,
+            USER_ID,
+            sanitize_telegram_text(f"""
+🌟 Транзакция успешно завершена!
+🔗 Подробности: https://preview.toncenter.com/api/v3/traces?msg_hash={tx_hash}&include_actions=true
+🔗 Доп подробности: https://tonviewer.com/transaction/{tx_hash}
+👤 Покупатель: {username}
+⭐️ Stars: {quantity}
+🔑 Ref ID: Ref#{ref_id}
+✅ Статус: Готово
+
+📝 Поделитесь впечатлениями, буду рад! 😇
+            """),
+            parse_mode="HTML"
+        )
+        order_store.update(orderID, completed=True)
 
     async def process_payment(self, c: Cardinal, buyer_chat_id: int, username: str, stars_quantity: int, orderID: str):
 
@@ -541,10 +2393,49 @@ class PaymentProcessor:
 
         while retry_count < max_retries:
             try:
-                tx_hash, ref_id, quantity, error = await main_async(username, stars_quantity)
+                if not payment_ledger.can_transfer(orderID):
+                    logger.warning(f"Заказ {orderID} уже оплачен или возвращён (этап {payment_ledger.stage(orderID)}), "
+                                   f"повторная обработка пропущена.")
+                    return
+                tx_hash, ref_id, quantity, error = await main_async(username, stars_quantity, orderID)
+                if error == DUPLICATE_PAYMENT_ERROR:
+                    logger.warning(f"Заказ {orderID}: {error}")
+                    return
+                if error and error.startswith(UNCERTAIN_TRANSFER_ERROR):
+                    # Ни повтор, ни возврат: журнал держит заказ в manual до решения продавца
+                    order_store.update(orderID, completed=True)
+                    metrics.error(PipelineMetrics.classify_error(error))
+                    update_stats(False, stars_quantity)
+                    await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
+                        "❌ Не удалось подтвердить статус транзакции. Продавец проверит заказ вручную."))
+                    await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID,
+                                            f"{error} Проверьте кошелёк перед возвратом или повтором.")
+                    return
+                if (error and self.guard.tripped and payment_ledger.can_transfer(orderID)
+                        and PipelineMetrics.classify_error(error) not in ("user_not_found", "insufficient_funds")):
+                    # Сервис недоступен и перевода не было: заказ ждёт в очереди, попытки и возвраты не тратятся
+                    logger.warning(f"Заказ {orderID} отложен до восстановления сервиса: {error}")
+                    self.task_queue.put((c, buyer_chat_id, username, stars_quantity, orderID, time.perf_counter()))
+                    try:
+                        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
+                            "⏳ Платёжный сервис временно недоступен. Ваш заказ сохранён и будет выполнен автоматически."))
+                    except Exception as e:
+                        logger.warning(f"Не удалось уведомить покупателя {buyer_chat_id}: {e}")
+                    return
+                if (error and PipelineMetrics.classify_error(error) == "unavailable"
+                        and retry_count + 1 < max_retries and payment_ledger.can_transfer(orderID)):
+                    # Сбой сервиса до размыкания предохранителя: к следующей попытке он может разомкнуться,
+                    # и тогда заказ отложится, а не вернётся
+                    retry_count += 1
+                    metrics.retry("unavailable")
+                    logger.warning(f"Попытка {retry_count}: сервис недоступен ({error}), повторная попытка через 5 секунд.")
+                    await asyncio.sleep(5)
+                    continue
                 if error:
+                    metrics.error(PipelineMetrics.classify_error(error))
                     if '406' in error and 'External message was not accepted' in error:
                         retry_count += 1
+                        metrics.retry("http_406")
                         if retry_count < max_retries:
                             logger.warning(
                                 f"Попытка {retry_count}: Ошибка 406 'External message was not accepted', повторная попытка через 5 секунд.")
@@ -553,224 +2444,371 @@ class PaymentProcessor:
                         else:
                             logger.error(
                                 f"Превышено количество попыток ({max_retries}) для заказа {orderID} из-за ошибки 406.")
+                            give_up_order(orderID, "http_406")
                             update_stats(False, stars_quantity)
-                            c.send_message(buyer_chat_id, sanitize_telegram_text(
+                            await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                                 "❌ Не удалось выполнить транзакцию после нескольких попыток. Пожалуйста, свяжитесь с поддержкой."))
                             if config["AUTO_REFUND"]:
-                                c.account.refund(orderID)
-                                c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
-                                    f'Вернул пользователю: {username} деньги по причине: {error}'))
+                                if await asyncio.to_thread(refund_order, c, orderID):
+                                    await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                                        f'Вернул пользователю: {username} деньги по причине: {error}'))
                             else:
-                                send_error_with_inline_url(c, USER_ID, orderID, error)
+                                await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID, error)
                             return
                     elif 'No Telegram users found' in error:
                         logger.info(f"Username {username} не найден для пользователя {buyer_chat_id}")
-                        user_orders = orders_info.get(buyer_chat_id, [])
-                        for o in user_orders:
-                            if o['orderID'] == orderID and not o.get('completed', False):
-                                o['username'] = None
-                                o['confirmed'] = False
-                                break
-                        c.send_message(buyer_chat_id, sanitize_telegram_text(
+                        order_store.update(orderID, username=None, confirmed=False)
+                        payment_ledger.mark(orderID, "released", reason="user_not_found")
+                        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                             "❌ Указанный вами username не найден в Telegram. Пожалуйста, введите корректный @username для получения Stars."))
                         return
                     elif 'Не удалось декодировать JSON' in error:
                         logger.error(f"Платёж не удался для {username}: {error}")
-                        user_orders = orders_info.get(buyer_chat_id, [])
-                        current_order = next(
-                            (o for o in user_orders if o['orderID'] == orderID and not o.get('completed', False)), None)
-                        if current_order:
-                            if 'retry_count' not in current_order:
-                                current_order['retry_count'] = 0
-                            current_order['retry_count'] += 1
-                            if current_order['retry_count'] <= 3:
-                                await asyncio.sleep(5)
-                                await self.process_payment(c, buyer_chat_id, username, stars_quantity, orderID)
-                                return
-                            else:
-                                logger.error(f"Превышено количество попыток декодирования JSON для заказа {orderID}")
-                        else:
-                            logger.error(f"Заказ {orderID} не найден в orders_info для buyer_chat_id {buyer_chat_id}")
-                        c.send_message(buyer_chat_id, sanitize_telegram_text(
+                        retry_count += 1
+                        metrics.retry("json_decode")
+                        if retry_count < max_retries:
+                            logger.warning(
+                                f"Попытка {retry_count}: некорректный ответ Fragment, повторная попытка через 5 секунд.")
+                            await asyncio.sleep(5)
+                            continue
+                        logger.error(f"Превышено количество попыток декодирования JSON для заказа {orderID}")
+                        give_up_order(orderID, "json_decode")
+                        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                             "❌ Не удалось выполнить транзакцию после нескольких попыток. Пожалуйста, свяжитесь с поддержкой."))
                         return
                     elif 'Недостаточно средств на кошельке' in error:
+                        give_up_order(orderID, "insufficient_funds")
                         if config["AUTO_REFUND"]:
-                            c.send_message(buyer_chat_id, sanitize_telegram_text(
+                            await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                                 "❌ На кошельке владельца недостаточно средств для выполнения транзакции, возвращаю Вам деньги и приношу извинения."))
-                            c.account.refund(orderID)
-                            c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
-                                f'Вернул пользователю: {username} деньги по причине: {error}'))
-                            c.update_lots_and_categories()
-                            subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON,
-                                                                    SUBCATEGORY_ID)
-                            my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
-                            for lot_id, lot in my_lots.items():
-                                fields = c.account.get_lot_fields(lot_id)
-                                if fields:
-                                    fields.active = False
-                                    c.account.save_lot(fields)
-                                    logger.debug(f"Лот {lot_id} деактивирован из-за недостатка средств.")
-                                    message = f"❌ Лот {lot_id} деактивирован из-за недостатка средств на кошельке:\n"
-                                    c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(message))
+                            if await asyncio.to_thread(refund_order, c, orderID):
+                                await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                                    f'Вернул пользователю: {username} деньги по причине: {error}'))
+                            await self.balance_guard.deactivate("недостаточно средств на кошельке.", c)
                         else:
-                            c.send_message(buyer_chat_id, sanitize_telegram_text(
+                            await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                                 "❌ На кошельке владельца недостаточно средств для выполнения транзакции. Свяжитесь с продавцом для возврата средств."))
-                            send_error_with_inline_url(c, USER_ID, orderID, error)
-                            c.update_lots_and_categories()
-                            subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON,
-                                                                    SUBCATEGORY_ID)
-                            my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
-                            for lot_id, lot in my_lots.items():
-                                fields = c.account.get_lot_fields(lot_id)
-                                if fields:
-                                    fields.active = False
-                                    c.account.save_lot(fields)
-                                    logger.debug(f"Лот {lot_id} деактивирован из-за недостатка средств.")
-                                    message = f"❌ Лот {lot_id} деактивирован из-за недостатка средств на кошельке:\n"
-                                    c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(message))
+                            await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID, error)
+                            await self.balance_guard.deactivate("недостаточно средств на кошельке.", c)
                         return
                     else:
+                        give_up_order(orderID, PipelineMetrics.classify_error(error))
                         update_stats(False, stars_quantity)
-                        c.send_message(buyer_chat_id,
-                                       sanitize_telegram_text("❌ Ваш заказ не выполнен. Попробуйте ещё раз"))
+                        await asyncio.to_thread(c.send_message, buyer_chat_id,
+                                                sanitize_telegram_text("❌ Ваш заказ не выполнен. Попробуйте ещё раз"))
                         if config["AUTO_REFUND"]:
-                            c.account.refund(orderID)
-                            c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
-                                f'Вернул пользователю: {username} деньги по причине: {error}'))
+                            if await asyncio.to_thread(refund_order, c, orderID):
+                                await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                                    f'Вернул пользователю: {username} деньги по причине: {error}'))
                         else:
-                            send_error_with_inline_url(c, USER_ID, orderID, error)
+                            await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID, error)
                         return
 
-                found_success = False
-                check_error = None
-                for attempt in range(25):
-                    try:
-                        with httpx.Client() as client:
-                            rq = client.get(
-                                f'https://preview.toncenter.com/api/v3/traces?msg_hash={tx_hash}&include_actions=true')
-                        response_data = rq.json()
-
-                        for trace in response_data.get('traces', []):
-                            for action in trace.get('actions', []):
-                                success = action.get('success', False)
-                                if success:
-                                    logger.info(f"Транзакция с хешем {action['trace_external_hash']} успешна.")
-                                    found_success = True
-                                    break
-                            if found_success:
-                                break
-
-                        if found_success:
-                            break
-                        else:
-                            logger.warning(f"Попытка {attempt + 1}: транзакция не найдена или неуспешна.")
-                            await asyncio.sleep(5)
-                    except Exception as e:
-                        logger.error(f"Ошибка при проверке транзакции (попытка {attempt + 1}): {e}")
-                        check_error = str(e)
-                        await asyncio.sleep(5)
+                with metrics.timer("confirmation"):
+                    found_success, check_error = await self.confirmations.wait(
+                        tx_hash, self.wallets.reservations.get(orderID), ref_id)
 
                 if not found_success:
-                    check_error = check_error or "Не удалось получить подтверждение транзакции после 15 попыток."
+                    metrics.error("confirmation_timeout")
+                    check_error = check_error or "Не удалось получить подтверждение транзакции."
                     logger.error(check_error)
+                    amount = self.wallets.reservations.get(orderID)
+                    outcome = await self.recheck_transfer(orderID, tx_hash, amount, ref_id)
+                    if outcome:
+                        await self.complete_payment(c, buyer_chat_id, username, stars_quantity, quantity, orderID,
+                                                    tx_hash, ref_id, amount=amount)
+                        return
                     update_stats(False, stars_quantity)
+                    if outcome is False:
+                        self.wallets.release(orderID)
+                        self.wallets.request_sync()
+                        give_up_order(orderID, "not_confirmed")
+                    if outcome is None:
+                        # Резерв держится до синхронизации баланса: списание могло пройти
+                        self.wallets.settle(orderID)
+                        order_store.update(orderID, completed=True)
+                        # Перевод мог пройти: возврат вслепую оплатил бы заказ дважды
+                        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
+                            "❌ Не удалось подтвердить статус транзакции. Продавец проверит заказ вручную."))
+                        await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID,
+                                                f"{check_error} Перевод не подтверждён и не опровергнут: "
+                                                f"проверьте кошелёк перед возвратом.")
+                        return
                     if config["AUTO_REFUND"]:
                         if 'Транзакция не найдена на TonViewer (404)' in check_error or 'транзакция не найдена' in check_error.lower():
-                            c.send_message(buyer_chat_id, sanitize_telegram_text(
+                            await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                                 "❌ Не удалось подтвердить статус транзакции (404). Возвращаю вам деньги. Извините за неудобства!"))
                         else:
-                            c.send_message(buyer_chat_id, sanitize_telegram_text(
+                            await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                                 "❌ Не удалось подтвердить статус транзакции. Возвращаю вам деньги. Извините за неудобства!"))
-                        c.account.refund(orderID)
+                        await asyncio.to_thread(refund_order, c, orderID)
                         if 'Недостаточно средств на кошельке' in check_error:
-                            c.update_lots_and_categories()
-                            subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON,
-                                                                    SUBCATEGORY_ID)
-                            my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
-                            for lot_id, lot in my_lots.items():
-                                fields = c.account.get_lot_fields(lot_id)
-                                if fields:
-                                    fields.active = False
-                                    c.account.save_lot(fields)
-                                    logger.debug(f"Лот {lot_id} деактивирован из-за недостатка средств.")
-                                    message = f"❌ Лот {lot_id} деактивирован из-за недостатка средств на кошельке:\n"
-                                    c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(message))
+                            await self.balance_guard.deactivate("недостаточно средств на кошельке.", c)
                         elif 'No Telegram users found' in check_error:
-                            c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
+                            await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
                                 f'Вернул пользователю: {username} деньги по причине: {check_error}'))
                         else:
-                            c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
+                            await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
                                 f'Вернул пользователю: {username} деньги по причине: {check_error}'))
                     else:
-                        c.send_message(buyer_chat_id, sanitize_telegram_text(
+                        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
                             "❌ Не удалось подтвердить статус транзакции. Свяжитесь с продавцом для возврата средств."))
-                        c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
+                        await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
                             f"У вас произошла ошибка с пользователем: https://funpay.com/orders/{orderID}/\nОшибка: {check_error}\nПросьба вернуть средства"))
                     return
 
-                logger.info(f"Платёж успешен для {username}: TX Hash: {tx_hash}, Ref ID: {ref_id}, Qty: {quantity}")
-                update_stats(True, stars_quantity)
-                c.send_message(
-                    buyer_chat_id,
-                    sanitize_telegram_text(f"""
-🌟 Успешная сделка!
-👤 Покупатель: {username}
-⭐️ Stars: {quantity}
-🔑 Ref ID: Ref#{ref_id}
-✅ Статус: Готово
-
-🔗 Доп подробности: {tx_hash}
-
-
-📝 Оставьте отзыв — это мотивирует! 😎
-                    """)
-                )
-                c.telegram.bot.send_message(
-                    USER_ID,
-                    sanitize_telegram_text(f"""
-🌟 Транзакция успешно завершена!
-🔗 Подробности: https://preview.toncenter.com/api/v3/traces?msg_hash={tx_hash}&include_actions=true
-🔗 Доп подробности: https://tonviewer.com/transaction/{tx_hash}
-👤 Покупатель: {username}
-⭐️ Stars: {quantity}
-🔑 Ref ID: Ref#{ref_id}
-✅ Статус: Готово
-
-📝 Поделитесь впечатлениями, буду рад! 😇
-                    """),
-                    parse_mode="HTML"
-                )
-                orders = orders_info.get(buyer_chat_id, [])
-                for order in orders:
-                    if order['orderID'] == orderID and not order.get('completed', False):
-                        order['completed'] = True
-                        break
+                await self.complete_payment(c, buyer_chat_id, username, stars_quantity, quantity, orderID, tx_hash,
+                                            ref_id, amount=self.wallets.reservations.get(orderID))
 
                 return
 
             except Exception as e:
                 logger.error(f"Ошибка при обработке платежа для {username}: {e}")
                 try:
-                    c.send_message(buyer_chat_id,
-                                   sanitize_telegram_text(f"❌ Ваш заказ не выполнен. Причина: {str(e)}."))
+                    await asyncio.to_thread(c.send_message, buyer_chat_id,
+                                            sanitize_telegram_text(f"❌ Ваш заказ не выполнен. Причина: {str(e)}."))
                 except Exception as send_error:
                     logger.error(f"Не удалось отправить сообщение об ошибке пользователю {buyer_chat_id}: {send_error}")
                 break
 
         logger.error(f"Превышено количество попыток ({max_retries}) для заказа {orderID}.")
+        give_up_order(orderID, "retries_exhausted")
         update_stats(False, stars_quantity)
-        c.send_message(buyer_chat_id, sanitize_telegram_text(
+        await asyncio.to_thread(c.send_message, buyer_chat_id, sanitize_telegram_text(
             "❌ Не удалось выполнить транзакцию после нескольких попыток. Пожалуйста, свяжитесь с поддержкой."))
         if config["AUTO_REFUND"]:
-            c.account.refund(orderID)
-            c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(
-                f'Вернул пользователю: {username} деньги по причине: Превышено количество попыток'))
+            if await asyncio.to_thread(refund_order, c, orderID):
+                await asyncio.to_thread(c.telegram.bot.send_message, USER_ID, sanitize_telegram_text(
+                    f'Вернул пользователю: {username} деньги по причине: Превышено количество попыток'))
         else:
-            send_error_with_inline_url(c, USER_ID, orderID, "Превышено количество попыток выполнения транзакции")
+            await asyncio.to_thread(send_error_with_inline_url, c, USER_ID, orderID,
+                                    "Превышено количество попыток выполнения транзакции")
+
+
+_payment_processor: Optional[PaymentProcessor] = None
+_payment_processor_lock = threading.Lock()
 
 
-payment_processor = PaymentProcessor()
+def get_payment_processor() -> PaymentProcessor:
+    """PaymentProcessor запускается при первом заказе или обращении к кошельку, а не при импорте плагина."""
+    global _payment_processor
+    if _payment_processor is None:
+        with _payment_processor_lock:
+            if _payment_processor is None:
+                started = time.perf_counter()
+                _payment_processor = PaymentProcessor(workers=config["PAYMENT_WORKERS"])
+                elapsed = time.perf_counter() - started
+                metrics.observe("processor_start", elapsed)
+                logger.info(f"PaymentProcessor запущен за {elapsed * 1000:.1f} мс.")
+    return _payment_processor
+
+
+def discard_speculative(order_id: str):
+    """Отменяет заготовку покупки; если PaymentProcessor ещё не запущен, заготовок нет и запускать его незачем."""
+    processor = _payment_processor
+    if processor is not None:
+        processor.speculative.discard(order_id)
+
+
+class StartupReconciler:
+    """Доводит до конца заказы, оставшиеся в работе после перезапуска Cardinal.
+
+    Статусы FunPay берутся постранично через get_sales, все записанные tx_hash проверяются
+    пакетными запросами toncenter; затем каждый заказ подтверждается, ставится в очередь
+    заново, ждёт подтверждения, возвращается или передаётся продавцу на ручную проверку.
+    """
+
+    MAX_SALES_PAGES = 10
+
+    def __init__(self, c: Cardinal):
+        self.c = c
+        self.results: Dict[str, List[str]] = {key: [] for key in
+                                               ("confirmed", "requeued", "waiting", "refunded", "manual")}
+
+    @staticmethod
+    def _detail(entry: dict, key: str):
+        for record in reversed(entry["history"]):
+            if key in record:
+                return record[key]
+        return None
+
+    def _funpay_statuses(self, order_ids: set) -> Dict[str, object]:
+        statuses = {}
+        start_from, locale, subcs = None, None, None
+        for _ in range(self.MAX_SALES_PAGES):
+            try:
+                start_from, orders, locale, subcs = self.c.account.get_sales(start_from=start_from, locale=locale,
+                                                                             sudcategories=subcs)
+            except Exception as e:
+                logger.warning(f"Не удалось получить продажи FunPay для сверки: {e}")
+                break
+            for order in orders:
+                if order.id in order_ids:
+                    statuses[order.id] = order.status
+            if not start_from or order_ids <= set(statuses):
+                break
+            time.sleep(1)
+        return statuses
+
+    def _traces(self, processor: PaymentProcessor, tx_hashes: List[str]) -> Dict[str, List[dict]]:
+        found = {}
+        batch_size = processor.confirmations.batch_size
+        for i in range(0, len(tx_hashes), batch_size):
+            chunk = tx_hashes[i:i + batch_size]
+            try:
+                found.update(asyncio.run_coroutine_threadsafe(processor.confirmations.lookup(chunk),
+                                                              processor.loop).result(timeout=30))
+            except Exception as e:
+                logger.warning(f"Не удалось проверить транзакции при сверке: {e}")
+        return found
+
+    async def _await_confirmation(self, processor: PaymentProcessor, order: dict, tx_hash: str, ref_id: str,
+                                  amount: Optional[float]):
+        found_success, check_error = await processor.confirmations.wait(tx_hash, amount, ref_id)
+        if not found_success:
+            outcome = await processor.recheck_transfer(order["orderID"], tx_hash, amount, ref_id)
+            if outcome is None:
+                update_stats(False, order["stars_count"])
+                await asyncio.to_thread(send_error_with_inline_url, self.c, USER_ID, order["orderID"],
+                                        "Перевод после перезапуска не подтверждён и не опровергнут: "
+                                        "проверьте кошелёк перед возвратом.")
+                return
+            found_success = outcome
+        if found_success:
+            await processor.complete_payment(self.c, order["buyer_chat_id"], order["username"], order["stars_count"],
+                                             order["stars_count"], order["orderID"], tx_hash, ref_id, amount)
+            return
+        update_stats(False, order["stars_count"])
+        await asyncio.to_thread(self._refund_or_alert, order, check_error or "перевод не подтвердился после перезапуска")
+
+    def _manual(self, order_id: str, reason: str):
+        """Заказ уходит на ручную проверку и больше не сверяется при следующих запусках."""
+        payment_ledger.mark(order_id, "manual", reason=reason)
+        order_store.update(order_id, completed=True)
+        self.results["manual"].append(order_id)
+
+    def _refund_or_alert(self, order: dict, reason: str):
+        order_id = order["orderID"]
+        if config["AUTO_REFUND"] and refund_order(self.c, order_id):
+            self.c.send_message(order["buyer_chat_id"], sanitize_telegram_text(
+                "❌ Не удалось подтвердить статус транзакции. Возвращаю вам деньги. Извините за неудобства!"))
+            order_store.update(order_id, is_canceled=True, completed=True)
+            self.results["refunded"].append(order_id)
+        else:
+            give_up_order(order_id, "not_confirmed")
+            send_error_with_inline_url(self.c, USER_ID, order_id, reason)
+            self.results["manual"].append(order_id)
+
+    @staticmethod
+    def collect() -> Dict[str, dict]:
+        """Заказы для сверки: незавершённые по журналу оплат и подтверждённые покупателем без записи в журнале."""
+        entries = {entry["order_id"]: entry for entry in payment_ledger.unfinished()}
+        # Сбой между «Да» и постановкой в очередь: записи в журнале ещё нет
+        for order in order_store.pending():
+            if (order.get("confirmed") and not order.get("is_canceled") and order["orderID"] not in entries
+                    and payment_ledger.stage(order["orderID"]) is None):
+                entries[order["orderID"]] = {"order_id": order["orderID"], "stage": None, "tx_hash": None,
+                                             "history": []}
+        return entries
+
+    def run(self):
+        entries = self.collect()
+        if not entries:
+            return
+        processor = get_payment_processor()
+        started = time.perf_counter()
+        logger.info(f"Сверка после перезапуска: незавершённых заказов {len(entries)}")
+        statuses = self._funpay_statuses(set(entries))
+        tx_hashes = [entry["tx_hash"] for entry in entries.values() if entry["tx_hash"]]
+        traces = self._traces(processor, tx_hashes) if tx_hashes else {}
+
+        for order_id, entry in entries.items():
+            try:
+                self._reconcile(processor, order_id, entry, statuses.get(order_id), traces)
+            except Exception as e:
+                logger.error(f"Ошибка сверки заказа {order_id}: {e}")
+                self._manual(order_id, f"reconcile_error: {str(e)[:200]}")
+
+        elapsed = time.perf_counter() - started
+        metrics.observe("startup_reconcile", elapsed)
+        summary = ", ".join(f"{key}: {len(ids)}" for key, ids in self.results.items() if ids)
+        logger.info(f"Сверка после перезапуска завершена за {elapsed:.1f} с ({summary})")
+        text = (f"♻️ Сверка заказов Stars после перезапуска ({elapsed:.1f} с)\n"
+                f"✅ Подтверждено: {len(self.results['confirmed'])}\n"
+                f"🔁 Снова в очереди: {len(self.results['requeued'])}\n"
+                f"⏳ Ждут подтверждения в сети: {len(self.results['waiting'])}\n"
+                f"↩️ Возвращено: {len(self.results['refunded'])}\n"
+                f"🔎 Нужна ручная проверка: {len(self.results['manual'])}")
+        if self.results["manual"]:
+            text += "\n" + "\n".join(f"https://funpay.com/orders/{order_id}/" for order_id in self.results["manual"])
+        try:
+            self.c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(text))
+        except Exception as e:
+            logger.warning(f"Не удалось отправить итог сверки: {e}")
+
+    def _reconcile(self, processor: PaymentProcessor, order_id: str, entry: dict, status,
+                   traces: Dict[str, List[dict]]):
+        stage = entry["stage"]
+        tx_hash = entry["tx_hash"]
+        order = order_store.get(order_id)
+        if status == enums.OrderStatuses.REFUNDED:
+            # Возврат уже сделан на FunPay (вручную или до сбоя)
+            payment_ledger.mark(order_id, "refunded", reason="funpay_refunded")
+            if order:
+                order_store.update(order_id, is_canceled=True, completed=True)
+            self.results["refunded"].append(order_id)
+            return
+        if order is None or not order.get("username"):
+            self._manual(order_id, "order_missing")
+            return
+        outcome = ConfirmationPoller.match(traces.get(normalize_tx_hash(tx_hash)), self._detail(entry, "amount"),
+                                           self._detail(entry, "ref_id")) if tx_hash else None
+        if outcome:
+            asyncio.run_coroutine_threadsafe(processor.complete_payment(
+                self.c, order["buyer_chat_id"], order["username"], order["stars_count"], order["stars_count"],
+                order_id, tx_hash, self._detail(entry, "ref_id"), self._detail(entry, "amount")
+            ), processor.loop).result(timeout=60)
+            self.results["confirmed"].append(order_id)
+        elif tx_hash:
+            asyncio.run_coroutine_threadsafe(self._await_confirmation(
+                processor, order, tx_hash, self._detail(entry, "ref_id"), self._detail(entry, "amount")
+            ), processor.loop)
+            self.results["waiting"].append(order_id)
+        elif stage == "sending":
+            # Сбой во время перевода: повторять перевод или возвращать деньги вслепую нельзя.
+            # send_failed без хеша сюда не попадает: такой перевод точно отклонён сетью и повторяется
+            send_error_with_inline_url(self.c, USER_ID, order_id,
+                                       "Перезапуск во время перевода: проверьте кошелёк перед возвратом или повтором")
+            self._manual(order_id, f"restart_during_{stage}")
+        elif stage == "refunding":
+            self.c.account.refund(order_id)
+            payment_ledger.mark(order_id, "refunded", reason="reconcile")
+            order_store.update(order_id, is_canceled=True, completed=True)
+            self.results["refunded"].append(order_id)
+        elif status is None:
+            # Заказ не найден в последних продажах FunPay: он мог быть возвращён вручную, повторять оплату нельзя
+            send_error_with_inline_url(self.c, USER_ID, order_id,
+                                       "После перезапуска не удалось найти статус заказа на FunPay: проверьте заказ")
+            self._manual(order_id, "funpay_status_unknown")
+        else:
+            # Перевода не было: заказ снова в очередь, мимо claim — он уже числится за этим заказом
+            if stage is None:
+                payment_ledger.claim(order_id)
+            processor.task_queue.put((self.c, order["buyer_chat_id"], order["username"], order["stars_count"],
+                                      order_id, time.perf_counter()))
+            self.c.send_message(order["buyer_chat_id"], sanitize_telegram_text(
+                "🔁 Ваш заказ восстановлен после перезапуска и снова в очереди на выполнение."))
+            self.results["requeued"].append(order_id)
+
+
+def reconcile_on_start(c: Cardinal):
+    """BIND_TO_POST_INIT: сверка идёт в отдельном потоке и не задерживает запуск Cardinal.
+
+    PaymentProcessor запускается только если есть что сверять.
+    """
+    if not StartupReconciler.collect():
+        return
+    threading.Thread(target=StartupReconciler(c).run, daemon=True, name="autostars-reconcile").start()
 
 
 class PluginFilter(Filter):
@@ -805,10 +2843,12 @@ SETTINGS_PAGE = False
 
 RUNNING = True
 chat_id = None
+# Cardinal из init_commands: нужен SalesGuard для уведомлений и переключения лотов
+cardinal_ref: Optional[Cardinal] = None
 
 
 def handle_new_order_stars(c: Cardinal, e: NewOrderEvent, *args):
-    global RUNNING, chat_id, orders_info
+    global RUNNING, chat_id
     if not RUNNING:
         return
     OrderID = e.order.id
@@ -896,9 +2936,6 @@ def handle_new_order_stars(c: Cardinal, e: NewOrderEvent, *args):
             except AttributeError:
                 return
 
-            if buyer_chat_id not in orders_info:
-                orders_info[buyer_chat_id] = []
-
             order_info = {
                 "username": username_from_order,
                 "confirmed": False,
@@ -908,28 +2945,21 @@ def handle_new_order_stars(c: Cardinal, e: NewOrderEvent, *args):
                 "stars_count": total_stars
             }
 
-            orders_info[buyer_chat_id].append(order_info)
+            order_info = order_store.add(buyer_chat_id, order_info)
 
             if not need_to_ask_username:
                 fragment_found_name = None
                 fragment_id = None
                 try:
-                    search_payload = {
-                        "query": username_from_order.replace("@", ""),
-                        "quantity": 50,
-                        "method": "searchStarsRecipient"
-                    }
-                    response_search = requests.post(url, headers=headers, data=search_payload)
-                    response_search.raise_for_status()
-                    data_search = response_search.json()
-                    if data_search.get('ok'):
-                        fragment_found_name = data_search.get('found', {}).get('name')
-                        fragment_id = data_search.get('found', {}).get('recipient')
+                    found, search_error = search_recipient_sync(username_from_order)
+                    if found:
+                        fragment_found_name = found.get('name')
+                        fragment_id = found.get('recipient')
                 except Exception as err:
                     logger.error(f"Ошибка при проверке username: {err}")
 
-                order_info['fragment_found_name'] = fragment_found_name
-                order_info['fragment_id'] = fragment_id
+                order_info = order_store.update(OrderID, fragment_found_name=fragment_found_name,
+                                                fragment_id=fragment_id) or order_info
 
                 blurred_name = ''
                 if fragment_found_name:
@@ -958,6 +2988,8 @@ def handle_new_order_stars(c: Cardinal, e: NewOrderEvent, *args):
                 logger.info(
                     f"Автоматически найден username: {username_from_order}, Fragment Name: {blurred_name}, Fragment ID: {fragment_display}"
                 )
+                if config["SPECULATIVE_PREPARE"] and fragment_id:
+                    get_payment_processor().speculative.start(OrderID, username_from_order, total_stars)
             else:
                 c.send_message(
                     buyer_chat_id,
@@ -980,7 +3012,7 @@ def handle_new_order_stars(c: Cardinal, e: NewOrderEvent, *args):
 
 
 def handle_new_message_text(c: Cardinal, e: NewMessageEvent, *args):
-    global RUNNING, chat_id, orders_info
+    global RUNNING, chat_id
     if not RUNNING:
         return
     buyer_chat_id = e.message.chat_id
@@ -994,18 +3026,19 @@ def handle_new_message_text(c: Cardinal, e: NewMessageEvent, *args):
         return
     if e.message.author.lower() in ["funpay", my_user.lower()]:
         return
-    if buyer_chat_id not in orders_info or not orders_info[buyer_chat_id]:
-        return
-    current_order = next((o for o in reversed(orders_info[buyer_chat_id]) if not o.get('completed', False)), None)
+    current_order = order_store.active(buyer_chat_id)
     if current_order is None:
         return
+    orderID = current_order['orderID']
 
     if e.message.text.strip().lower().startswith("!бэк"):
         if current_order.get('completed', False) or current_order.get('is_canceled', False) or current_order.get(
                 'answered', False):
             return
-        c.account.refund(current_order['orderID'])
-        current_order['is_canceled'] = True
+        if not refund_order(c, orderID):
+            return
+        order_store.update(orderID, is_canceled=True, completed=True)
+        discard_speculative(orderID)
         c.send_message(
             buyer_chat_id,
             sanitize_telegram_text(
@@ -1022,21 +3055,18 @@ def handle_new_message_text(c: Cardinal, e: NewMessageEvent, *args):
         user_response = e.message.text.strip().lower()
 
         if user_response in ['да', '+', 'yes', 'y', 'д']:
-            current_order['confirmed'] = True
-            current_order['answered'] = True
-            orderID = current_order['orderID']
+            order_store.update(orderID, confirmed=True, answered=True)
             stars_quantity = current_order.get('stars_count', 50)
             username = current_order['username']
 
-            position = payment_processor.enqueue_payment(
+            position = get_payment_processor().enqueue_payment(
                 c, buyer_chat_id, username, stars_quantity, orderID
             )
 
 
         elif user_response in ['нет', '-', 'no', 'n', 'н']:
-            current_order['answered'] = True
-            current_order['auto_username'] = False
-            current_order['username'] = None
+            order_store.update(orderID, answered=True, auto_username=False, username=None)
+            discard_speculative(orderID)
 
             c.send_message(
                 buyer_chat_id,
@@ -1053,26 +3083,17 @@ def handle_new_message_text(c: Cardinal, e: NewMessageEvent, *args):
             )
             return
         username = e.message.text.strip()
-        current_order['username'] = username
-        current_order['confirmed'] = False
+        order_store.update(orderID, username=username, confirmed=False)
         fragment_found_name = None
         fragment_id = None
         try:
-            search_payload = {
-                "query": username.replace("@", ""),
-                "quantity": 50,
-                "method": "searchStarsRecipient"
-            }
-            response_search = requests.post(url, headers=headers, data=search_payload)
-            response_search.raise_for_status()
-            data_search = response_search.json()
-            if data_search.get('ok'):
-                fragment_found_name = data_search.get('found', {}).get('name')
-                fragment_id = data_search.get('found', {}).get('recipient')
-        except:
+            found, search_error = search_recipient_sync(username)
+            if found:
+                fragment_found_name = found.get('name')
+                fragment_id = found.get('recipient')
+        except Exception:
             pass
-        current_order['fragment_found_name'] = fragment_found_name
-        current_order['fragment_id'] = fragment_id
+        order_store.update(orderID, fragment_found_name=fragment_found_name, fragment_id=fragment_id)
 
         blurred_name = ''
         if fragment_found_name:
@@ -1093,22 +3114,22 @@ def handle_new_message_text(c: Cardinal, e: NewMessageEvent, *args):
         logger.info(
             f"Найден username: {username}, Fragment Name: {blurred_name}, Fragment ID: {fragment_display}"
         )
+        if config["SPECULATIVE_PREPARE"] and fragment_id:
+            get_payment_processor().speculative.start(orderID, username, current_order.get('stars_count', 50))
         return
 
     if current_order['username'] is not None and not current_order['confirmed']:
         user_response = e.message.text.strip().lower()
         if user_response in ['да', '+', 'yes', 'y', 'д']:
-            current_order['confirmed'] = True
-            current_order['answered'] = True
-            orderID = current_order['orderID']
+            order_store.update(orderID, confirmed=True, answered=True)
             stars_quantity = current_order.get('stars_count', 50)
-            position = payment_processor.enqueue_payment(
+            position = get_payment_processor().enqueue_payment(
                 c, buyer_chat_id, current_order['username'], stars_quantity, orderID
             )
 
         elif user_response in ['нет', '-', 'no', 'n', 'н']:
-            current_order['answered'] = True
-            current_order['username'] = None
+            order_store.update(orderID, answered=True, username=None)
+            discard_speculative(orderID)
             c.send_message(
                 e.message.chat_id,
                 sanitize_telegram_text("Пожалуйста, введите @username ещё раз.")
@@ -1127,8 +3148,271 @@ def stars_auto(c: Cardinal, e, *args):
         handle_new_message_text(c, e, *args)
 
 
+LOTS_IDS_FILE = "storage/cache/auto_stars_id.json"
+LOTS_PROGRESS_FILE = "storage/cache/auto_stars_lots_progress.json"
+
+
+class TokenBucket:
+    """Токен-бакет запросов к FunPay: после 429 скорость падает вдвое, после успехов плавно растёт."""
+
+    def __init__(self, rate: float = 1.0, capacity: float = 2.0, min_rate: float = 0.1, max_rate: float = 2.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.05)
+
+    def on_rate_limited(self, attempt: int) -> float:
+        """Снижает скорость и возвращает паузу перед повтором."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+        return min(60.0, 2.0 * 2 ** attempt) + random.uniform(0, 1)
+
+
+class LotStateEngine:
+    """Массовое включение и выключение лотов с адаптивным лимитом запросов и продолжением после прерывания."""
+
+    RESULT_KEYS = ("changed", "unchanged", "not_found", "invalid", "errors")
+
+    def __init__(self, progress_path: str, max_retries: int = 6):
+        self.progress_path = progress_path
+        self.max_retries = max_retries
+        self.bucket = TokenBucket()
+        self._run_lock = threading.Lock()
+
+    def _load_progress(self) -> Optional[dict]:
+        if not os.path.exists(self.progress_path):
+            return None
+        try:
+            with open(self.progress_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Не удалось прочитать прогресс переключения лотов: {e}")
+            return None
+
+    def _save_progress(self, progress: dict):
+        os.makedirs(os.path.dirname(self.progress_path), exist_ok=True)
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(progress, f, ensure_ascii=False)
+        os.replace(tmp_path, self.progress_path)
+
+    @staticmethod
+    def _is_rate_limited(e: Exception) -> bool:
+        return getattr(e, 'status_code', None) == 429 or '429' in str(e)
+
+    def _apply(self, c: Cardinal, lot_id: int, active: bool) -> Tuple[str, Optional[str]]:
+        for attempt in range(self.max_retries):
+            try:
+                self.bucket.acquire()
+                fields = c.account.get_lot_fields(lot_id)
+                if fields is None:
+                    return "not_found", None
+                if fields.active == active:
+                    self.bucket.on_success()
+                    return "unchanged", None
+                fields.active = active
+                self.bucket.acquire()
+                c.account.save_lot(fields)
+                self.bucket.on_success()
+                return "changed", None
+            except FunPayAPI.common.exceptions.RequestFailedError as e:
+                if not self._is_rate_limited(e):
+                    return "errors", str(e)
+                delay = self.bucket.on_rate_limited(attempt)
+                logger.warning(f"Лимит запросов FunPay (429) на лоте {lot_id}, повтор через {delay:.1f} с. "
+                               f"Скорость: {self.bucket.rate:.2f} запр/с")
+                time.sleep(delay)
+            except Exception as e:
+                return "errors", str(e)
+        return "errors", "Превышен лимит запросов (429)"
+
+    def run(self, c: Cardinal, lot_ids: list, active: bool, chat_id: Optional[int] = None) -> dict:
+        """Переводит лоты в состояние active. Незавершённый запуск с той же целью продолжается с места остановки."""
+        with self._run_lock:
+            progress = self._load_progress()
+            if progress and progress.get("active") == active:
+                known = set(progress["pending"]) | {lot[0] if isinstance(lot, list) else lot
+                                                    for key in self.RESULT_KEYS for lot in progress["results"][key]}
+                progress["pending"] += [lot_id for lot_id in lot_ids if lot_id not in known]
+                logger.info(f"Продолжаю прерванное переключение лотов: осталось {len(progress['pending'])}")
+            else:
+                progress = {
+                    "active": active,
+                    "pending": list(lot_ids),
+                    "results": {key: [] for key in self.RESULT_KEYS}
+                }
+            self._save_progress(progress)
+
+            title = "Активация" if active else "Деактивация"
+            total = len(progress["pending"]) + sum(len(progress["results"][key]) for key in self.RESULT_KEYS)
+            message = None
+            if chat_id is not None:
+                try:
+                    message = c.telegram.bot.send_message(chat_id, f"⏳ {title} лотов: 0/{total}")
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить сообщение о прогрессе: {e}")
+            reported_at = time.monotonic()
+
+            while progress["pending"]:
+                lot_id = progress["pending"][0]
+                if not isinstance(lot_id, int):
+                    status, error = "invalid", None
+                else:
+                    status, error = self._apply(c, lot_id, active)
+                    if status in ("changed", "unchanged"):
+                        lot_snapshot.set_state(lot_id, active)
+                    elif status == "not_found":
+                        lot_snapshot.discard(lot_id)
+                progress["results"][status].append([lot_id, error] if status == "errors" else lot_id)
+                progress["pending"].pop(0)
+                self._save_progress(progress)
+                if message is not None and time.monotonic() - reported_at >= 5:
+                    done = total - len(progress["pending"])
+                    try:
+                        c.telegram.bot.edit_message_text(f"⏳ {title} лотов: {done}/{total}",
+                                                         message.chat.id, message.id)
+                    except Exception:
+                        pass
+                    reported_at = time.monotonic()
+
+            os.remove(self.progress_path)
+            results = progress["results"]
+            if chat_id is not None:
+                report = self.format_report(title, active, results)
+                try:
+                    if message is not None:
+                        c.telegram.bot.edit_message_text(report, message.chat.id, message.id)
+                    else:
+                        c.telegram.bot.send_message(chat_id, report)
+                except Exception:
+                    c.telegram.bot.send_message(chat_id, report)
+            return results
+
+    @staticmethod
+    def format_report(title: str, active: bool, results: dict) -> str:
+        report = f"✅ **{title} лотов завершена.**\n\n"
+        if results["changed"]:
+            report += f"**{'Активированы' if active else 'Деактивированы'}**: {', '.join(map(str, results['changed']))}\n"
+        if results["unchanged"]:
+            report += f"**{'Уже активны' if active else 'Уже были неактивны'}**: {', '.join(map(str, results['unchanged']))}\n"
+        if results["not_found"]:
+            report += f"**Не найдены**: {', '.join(map(str, results['not_found']))}\n"
+        if results["invalid"]:
+            report += f"**Неверные ID**: {', '.join(map(str, results['invalid']))}\n"
+        if results["errors"]:
+            error_details = "; ".join([f"{lot_id}: {err}" for lot_id, err in results["errors"]])
+            report += f"**Ошибки**: {error_details}\n"
+        return sanitize_telegram_text(report)
+
+
+lot_engine = LotStateEngine(LOTS_PROGRESS_FILE)
+
+
+class LotSnapshot:
+    """Кэш состояния лотов SUBCATEGORY_ID: панель рисуется из него, обновление идёт в фоне по TTL."""
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.states: Dict[int, bool] = {}
+        self.updated_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def loaded(self) -> bool:
+        return self.updated_at is not None
+
+    @property
+    def active_lots(self) -> List[int]:
+        with self._lock:
+            return [lot_id for lot_id, active in self.states.items() if active]
+
+    def set_state(self, lot_id: int, active: bool):
+        with self._lock:
+            self.states[lot_id] = active
+
+    def discard(self, lot_id: int):
+        with self._lock:
+            self.states.pop(lot_id, None)
+
+    def refresh(self, c: Cardinal):
+        c.update_lots_and_categories()
+        subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON, SUBCATEGORY_ID)
+        my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
+        states = {}
+        for lot_id in my_lots:
+            try:
+                lot_engine.bucket.acquire()
+                lot_fields = c.account.get_lot_fields(lot_id)
+                if lot_fields:
+                    states[lot_id] = lot_fields.active
+                lot_engine.bucket.on_success()
+            except FunPayAPI.common.exceptions.RequestFailedError as lot_err:
+                if LotStateEngine._is_rate_limited(lot_err):
+                    lot_engine.bucket.on_rate_limited(0)
+                    logger.warning(f"Достигнут лимит запросов к FunPay API (429) при проверке лота {lot_id}")
+                else:
+                    logger.error(f"Ошибка при получении данных лота {lot_id}: {lot_err}")
+                # Неизвестное состояние берём из прошлого снимка
+                if lot_id in self.states:
+                    states[lot_id] = self.states[lot_id]
+        with self._lock:
+            self.states = states
+            self.updated_at = time.monotonic()
+        logger.debug(f"Снимок лотов обновлён: активных {len(self.active_lots)} из {len(states)}")
+
+    def refresh_async(self, c: Cardinal, force: bool = False):
+        """Запускает фоновое обновление, если снимок устарел и обновление ещё не идёт."""
+        with self._lock:
+            stale = self.updated_at is None or time.monotonic() - self.updated_at >= self.ttl
+            if self._refreshing or not (stale or force):
+                return
+            self._refreshing = True
+
+        def worker():
+            try:
+                self.refresh(c)
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении снимка лотов: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=worker, daemon=True).start()
+
+
+lot_snapshot = LotSnapshot(ttl=config["LOTS_SNAPSHOT_TTL"])
+
+
+def lots_status_text() -> str:
+    active_lots = lot_snapshot.active_lots
+    if not lot_snapshot.loaded:
+        return "⏳ Обновляются..."
+    return f"⚡️ Активных: {len(active_lots)}" if active_lots else "💤 Нет активных"
+
+
 def activate_lots(c: Cardinal, chat_id: int):
-    json_path = 'storage/cache/auto_stars_id.json'
+    json_path = LOTS_IDS_FILE
     if not os.path.exists(json_path):
         logger.error(f"Файл {json_path} не найден.")
         c.send_message(chat_id, sanitize_telegram_text(f"❌ Файл {json_path} не найден."))
@@ -1149,59 +3433,7 @@ def activate_lots(c: Cardinal, chat_id: int):
         logger.error(f"Неверный формат данных в {json_path}. Ожидался список ID.")
         c.send_message(chat_id, sanitize_telegram_text("❌ Неверный формат JSON."))
         return
-    activated_lots = []
-    already_active = []
-    not_found = []
-    invalid_ids = []
-    errors = []
-    rate_limited = False
-
-    for lot_id in lot_ids:
-        if rate_limited:
-            break
-
-        if not isinstance(lot_id, int):
-            invalid_ids.append(lot_id)
-            continue
-        try:
-            fields = c.account.get_lot_fields(lot_id)
-            if fields is None:
-                not_found.append(lot_id)
-                continue
-            if fields.active:
-                already_active.append(lot_id)
-                continue
-            fields.active = True
-            c.account.save_lot(fields)
-            activated_lots.append(lot_id)
-            # Добавляем небольшую задержку между запросами
-            time.sleep(1)
-        except FunPayAPI.common.exceptions.RequestFailedError as e:
-            if '429' in str(e):
-                logger.warning(f"Достигнут лимит запросов к FunPay API (429) при активации лота {lot_id}")
-                errors.append((lot_id, "Превышен лимит запросов (429)"))
-                rate_limited = True
-            else:
-                errors.append((lot_id, str(e)))
-        except Exception as e:
-            errors.append((lot_id, str(e)))
-
-    report = "✅ **Активация лотов завершена.**\n\n"
-    if activated_lots:
-        report += f"**Активированы**: {', '.join(map(str, activated_lots))}\n"
-    if already_active:
-        report += f"**Уже активны**: {', '.join(map(str, already_active))}\n"
-    if not_found:
-        report += f"**Не найдены**: {', '.join(map(str, not_found))}\n"
-    if invalid_ids:
-        report += f"**Неверные ID**: {', '.join(map(str, invalid_ids))}\n"
-    if errors:
-        error_details = "; ".join([f"{lot_id}: {err}" for lot_id, err in errors])
-        report += f"**Ошибки**: {error_details}\n"
-    if rate_limited:
-        report += "\n⚠️ **Внимание**: Активация была прервана из-за превышения лимита запросов FunPay. Повторите попытку через несколько минут."
-
-    c.telegram.bot.send_message(chat_id, sanitize_telegram_text(report))
+    lot_engine.run(c, lot_ids, True, chat_id)
 
 
 def deactivate_lots(c: Cardinal, chat_id: int):
@@ -1215,55 +3447,7 @@ def deactivate_lots(c: Cardinal, chat_id: int):
     if not my_lots:
         c.send_message(chat_id, sanitize_telegram_text("ℹ️ Нет лотов для деактивации."))
         return
-    deactivated_lots = []
-    already_inactive = []
-    errors = []
-    not_found = []
-    rate_limited = False
-
-    for lot_id, lot in my_lots.items():
-        if rate_limited:
-            break
-
-        if not isinstance(lot_id, int):
-            continue
-        try:
-            fields = c.account.get_lot_fields(lot_id)
-            if fields is None:
-                not_found.append(lot_id)
-                continue
-            if not fields.active:
-                already_inactive.append(lot_id)
-                continue
-            fields.active = False
-            c.account.save_lot(fields)
-            deactivated_lots.append(lot_id)
-            # Увеличиваем задержку между запросами
-            time.sleep(2)
-        except FunPayAPI.common.exceptions.RequestFailedError as e:
-            if '429' in str(e):
-                logger.warning(f"Достигнут лимит запросов к FunPay API (429) при деактивации лота {lot_id}")
-                errors.append((lot_id, "Превышен лимит запросов (429)"))
-                rate_limited = True
-            else:
-                errors.append((lot_id, str(e)))
-        except Exception as e:
-            errors.append((lot_id, str(e)))
-
-    report = "✅ **Деактивация лотов завершена.**\n\n"
-    if deactivated_lots:
-        report += f"**Деактивированы**: {', '.join(map(str, deactivated_lots))}\n"
-    if already_inactive:
-        report += f"**Уже были неактивны**: {', '.join(map(str, already_inactive))}\n"
-    if not_found:
-        report += f"**Не найдены**: {', '.join(map(str, not_found))}\n"
-    if errors:
-        error_details = "; ".join([f"{lot_id}: {err}" for lot_id, err in errors])
-        report += f"**Ошибки**: {error_details}\n"
-    if rate_limited:
-        report += "\n⚠️ **Внимание**: Деактивация была прервана из-за превышения лимита запросов FunPay. Повторите попытку через несколько минут."
-
-    c.telegram.bot.send_message(USER_ID, sanitize_telegram_text(report))
+    lot_engine.run(c, [lot_id for lot_id in my_lots if isinstance(lot_id, int)], False, chat_id)
 
 
 def stars(m: types.Message, c: Cardinal):
@@ -1275,7 +3459,8 @@ def stars(m: types.Message, c: Cardinal):
         )
         return
     RUNNING = True
-    future = asyncio.run_coroutine_threadsafe(check_wallet_balance(), payment_processor.loop)
+    processor = get_payment_processor()
+    future = asyncio.run_coroutine_threadsafe(processor.wallets.current(), processor.loop)
     try:
         balance_ton = future.result(timeout=10)
     except Exception as e:
@@ -1305,12 +3490,15 @@ def off_stars(m: types.Message, c: Cardinal):
 
 async def get_wallet_balance():
     try:
-        balance_nano = await check_wallet_balance()
+        wallets = get_payment_processor().wallets
+        balance_ton = await wallets.current()
+        reserved_text = f" (в резерве: {wallets.reserved:.2f} TON)" if wallets.reservations else ""
+        if len(wallets.shards) > 1:
+            reserved_text += f", кошельков: {len(wallets.shards)}"
         if config["USE_OLD_BALANCE"]:
-            return f"{balance_nano} (старый формат)"
+            return f"{balance_ton} (старый формат){reserved_text}"
         else:
-            balance_ton = balance_nano / 1_000_000_000
-            return f"{balance_ton:.2f} TON"
+            return f"{balance_ton:.2f} TON{reserved_text}"
     except Exception as e:
         logger.error(f"Ошибка при получении баланса: {e}")
         return "Неизвестно"
@@ -1319,26 +3507,10 @@ async def get_wallet_balance():
 def stars_config(c: Cardinal, m: types.Message):
     """Инициализация панели управления /stars_config с балансом и кнопкой статистики."""
     try:
-        c.update_lots_and_categories()
-        subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON, SUBCATEGORY_ID)
-        my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
+        lot_snapshot.refresh_async(c)
+        active_lots = lot_snapshot.active_lots
 
-        active_lots = []
-        try:
-            for lot_id, lot in my_lots.items():
-                try:
-                    lot_fields = c.account.get_lot_fields(lot_id)
-                    if lot_fields and lot_fields.active:
-                        active_lots.append(lot_id)
-                except FunPayAPI.common.exceptions.RequestFailedError as lot_err:
-                    if '429' in str(lot_err):
-                        logger.warning(f"Достигнут лимит запросов к FunPay API (429) при проверке лота {lot_id}")
-                    else:
-                        logger.error(f"Ошибка при получении данных лота {lot_id}: {lot_err}")
-        except Exception as lots_err:
-            logger.error(f"Ошибка при обработке лотов: {lots_err}")
-
-        balance_future = asyncio.run_coroutine_threadsafe(get_wallet_balance(), payment_processor.loop)
+        balance_future = asyncio.run_coroutine_threadsafe(get_wallet_balance(), get_payment_processor().loop)
         balance_text = balance_future.result(timeout=10)
 
         activation_status = "🟢 Активирован"
@@ -1360,7 +3532,7 @@ def stars_config(c: Cardinal, m: types.Message):
         keyboard.add(stats_btn)
 
         status_text = "🟢 Активна" if RUNNING else "🔴 Неактивна"
-        lots_text = f"⚡️ Активных: {len(active_lots)}" if active_lots else "💤 Нет активных"
+        lots_text = lots_status_text()
         message_text = (
             "✨ <b>AutoStars: Панель управления</b> ✨\n"
             "────────────────────\n"
@@ -1400,26 +3572,10 @@ def stars_config(c: Cardinal, m: types.Message):
 
 def update_config_panel(c: Cardinal, chat_id: int, message_id: int):
     try:
-        c.update_lots_and_categories()
-        subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON, SUBCATEGORY_ID)
-        my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
-
-        active_lots = []
-        try:
-            for lot_id, lot in my_lots.items():
-                try:
-                    lot_fields = c.account.get_lot_fields(lot_id)
-                    if lot_fields and lot_fields.active:
-                        active_lots.append(lot_id)
-                except FunPayAPI.common.exceptions.RequestFailedError as lot_err:
-                    if '429' in str(lot_err):
-                        logger.warning(f"Достигнут лимит запросов к FunPay API (429) при проверке лота {lot_id}")
-                    else:
-                        logger.error(f"Ошибка при получении данных лота {lot_id}: {lot_err}")
-        except Exception as lots_err:
-            logger.error(f"Ошибка при обработке лотов: {lots_err}")
+        lot_snapshot.refresh_async(c)
+        active_lots = lot_snapshot.active_lots
 
-        balance_future = asyncio.run_coroutine_threadsafe(get_wallet_balance(), payment_processor.loop)
+        balance_future = asyncio.run_coroutine_threadsafe(get_wallet_balance(), get_payment_processor().loop)
         balance_text = balance_future.result(timeout=10)
 
         activation_status = "🟢 Активирован"
@@ -1441,7 +3597,7 @@ def update_config_panel(c: Cardinal, chat_id: int, message_id: int):
         keyboard.add(stats_btn)
 
         status_text = "🟢 Активна" if RUNNING else "🔴 Неактивна"
-        lots_text = f"⚡️ Активных: {len(active_lots)}" if active_lots else "💤 Нет активных"
+        lots_text = lots_status_text()
         message_text = (
             "✨ <b>AutoStars: Панель управления</b> ✨\n"
             "────────────────────\n"
@@ -1514,7 +3670,7 @@ def update_settings_panel(c: Cardinal, chat_id: int, message_id: int):
 def get_daily_stats():
     """Получение ежедневной статистики по транзакциям в виде чистого текста."""
     date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-    day_stats = stats_data.get(date_str, {})
+    day_stats = stats_store.day(date_str) or {}
 
     if not day_stats:
         return None
@@ -1548,7 +3704,7 @@ def handle_status_command(c: Cardinal, e: NewMessageEvent):
     else:
         date_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
-    if date_str not in stats_data:
+    if stats_store.day(date_str) is None:
         msg = (
             f"Статистика за {date_str} отсутствует.\n"
             "Вероятно, не было транзакций или дата указана неверно."
@@ -1556,24 +3712,40 @@ def handle_status_command(c: Cardinal, e: NewMessageEvent):
         c.send_message(e.message.chat_id, msg)
         return
 
-    image_stream = generate_order_graph(date_str)
-    if image_stream is None:
-        c.send_message(e.message.chat_id, "Статистика за эту дату отсутствует.")
-        return
+    chat_id = e.message.chat_id
+    chat_name = e.message.chat_name
+
+    def send_chart(future: Future):
+        try:
+            png = future.result()
+            if png is None:
+                c.send_message(chat_id, "Статистика за эту дату отсутствует.")
+                return
+            c.account.send_image(chat_id, io.BytesIO(png), chat_name=chat_name)
+        except Exception as err:
+            logger.error(f"Ошибка при отправке графика статистики за {date_str}: {err}")
+
+    chart_renderer.render(date_str).add_done_callback(send_chart)
 
-    c.account.send_image(
-        e.message.chat_id,
-        image_stream,
-        chat_name=e.message.chat_name
-    )
+
+def stars_metrics(c: Cardinal, m: types.Message):
+    """Команда /stars_metrics: задержки этапов, повторы и ошибки."""
+    c.telegram.bot.send_message(m.chat.id, sanitize_telegram_text(metrics.summary_text()))
 
 
 def init_commands(c: Cardinal):
     """Инициализация команд и callback-обработчиков для бота."""
+    global cardinal_ref
+    started = time.perf_counter()
+    cardinal_ref = c
+    order_store.open()
+    payment_ledger.open()
     c.add_telegram_commands(UUID, [
         ("stars_config", "настройка автопродажи тг старсов", True),
+        ("stars_metrics", "метрики выдачи тг старсов", True),
     ])
     c.telegram.msg_handler(lambda m: stars_config(c, m), commands=["stars_config"])
+    c.telegram.msg_handler(lambda m: stars_metrics(c, m), commands=["stars_metrics"])
 
     @c.telegram.bot.callback_query_handler(func=lambda call: call.data in [
         "toggle_autosale", "toggle_lots", "send_logs", "open_settings", "edit_hash",
@@ -1601,7 +3773,8 @@ def init_commands(c: Cardinal):
                         sanitize_telegram_text("🛑 Автопродажа отключена.")
                     )
                 else:
-                    future = asyncio.run_coroutine_threadsafe(check_wallet_balance(), payment_processor.loop)
+                    processor = get_payment_processor()
+                    future = asyncio.run_coroutine_threadsafe(processor.wallets.current(), processor.loop)
                     balance_ton = future.result(timeout=10)
                     RUNNING = True
                     c.telegram.bot.send_message(
@@ -1611,10 +3784,9 @@ def init_commands(c: Cardinal):
                 update_config_panel(c, chat_id, message_id)
 
             elif data == "toggle_lots":
-                subcategory = c.account.get_subcategory(FunPayAPI.types.SubCategoryTypes.COMMON, SUBCATEGORY_ID)
-                my_lots = c.tg_profile.get_sorted_lots(2).get(subcategory, {})
-                active_lots = [lot_id for lot_id, lot in my_lots.items() if c.account.get_lot_fields(lot_id).active]
-                if active_lots:
+                if not lot_snapshot.loaded:
+                    lot_snapshot.refresh(c)
+                if lot_snapshot.active_lots:
                     deactivate_lots(c, chat_id)
                 else:
                     activate_lots(c, chat_id)
@@ -1828,23 +4000,47 @@ def init_commands(c: Cardinal):
     def refund_order_callback(call):
         order_id = call.data.replace("refund_order_", "")
         try:
-            c.account.refund(order_id)
-            msg = f"✅ Заказ #{order_id} возвращён."
+            if refund_order(c, order_id, by_seller=True):
+                msg = f"✅ Заказ #{order_id} возвращён."
+            else:
+                msg = f"⚠️ Заказ #{order_id} уже выполнен, в процессе оплаты или возвращён — возврат не выполнен."
         except Exception as e:
             msg = f"❌ Ошибка при возврате заказа #{order_id}: {e}"
         c.telegram.bot.answer_callback_query(call.id, text=msg, show_alert=True)
         c.telegram.bot.send_message(chat_id, sanitize_telegram_text(msg))
 
+    elapsed = time.perf_counter() - started
+    metrics.observe("plugin_init", elapsed)
+    logger.info(f"{NAME}: команды зарегистрированы за {elapsed * 1000:.1f} мс (импорт {IMPORT_TIME * 1000:.1f} мс).")
+
 
 BIND_TO_PRE_INIT = [init_commands]
+BIND_TO_POST_INIT = [reconcile_on_start]
 BIND_TO_NEW_MESSAGE = [stars_auto]
 BIND_TO_NEW_ORDER = [handle_new_order_stars]
 BIND_TO_DELETE = []
 
 
 def shutdown():
-    payment_processor.loop.call_soon_threadsafe(payment_processor.loop.stop)
-    payment_processor.thread.join()
+    # Если PaymentProcessor так и не понадобился, останавливать в нём нечего
+    processor = _payment_processor
+    if processor is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(fragment_client.aclose(), processor.loop).result(timeout=5)
+            asyncio.run_coroutine_threadsafe(processor.confirmations.aclose(), processor.loop).result(timeout=5)
+        except Exception as e:
+            logger.debug(f"Не удалось закрыть HTTP клиенты: {e}")
+        # Базы закрываются только после остановки цикла: его корутины ещё могут писать в журнал и заказы
+        processor.loop.call_soon_threadsafe(processor.loop.stop)
+        processor.thread.join(timeout=10)
+    order_store.close()
+    payment_ledger.close()
+    stats_store.snapshot()
+    chart_renderer.shutdown()
 
 
 atexit.register(shutdown)
+
+IMPORT_TIME = time.perf_counter() - _IMPORT_STARTED
+metrics.observe("plugin_import", IMPORT_TIME)
+logger.info(f"{NAME} v{VERSION} импортирован за {IMPORT_TIME * 1000:.1f} мс.")
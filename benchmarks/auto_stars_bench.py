@@ -0,0 +1,675 @@
+"""
+Нагрузочный стенд auto_stars без сети.
+
+Плагин загружается как есть, а вместо внешних сервисов подставляются локальные заглушки:
+Fragment (api?hash=...) и toncenter (/api/v3/traces) через httpx.MockTransport,
+кошелёк TON через заглушку tonutils, Cardinal/Account через объекты в памяти.
+У каждой заглушки настраиваются задержка и доля ошибок (406, мусор вместо JSON, 429);
+у FunPay — для send_message, get_lot_fields и save_lot, так что выключение лотов
+предохранителем и потерянные уведомления покупателю тоже попадают в прогон.
+
+Прогон заканчивается, когда все заказы закрыты в OrderStore, журнал оплат дошёл до конечного этапа
+и воркеры свободны: сообщение покупателю уходит раньше, чем плагин записывает метрики заказа.
+
+Поток синтетических NewOrderEvent/NewMessageEvent прогоняется через stars_auto
+в одном потоке, как это делает Cardinal, и в конце печатается пропускная способность,
+перцентили задержки и усиление запросов из-за повторов.
+
+Запуск из корня репозитория (нужен только httpx):
+    python benchmarks/auto_stars_bench.py --orders 200 --rate 2 --workers 3 --fragment-garbage 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import atexit
+import base64
+import heapq
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "auto_stars.py")
+SELLER_ID = 1
+SELLER_USERNAME = "seller"
+
+
+class Fault:
+    """Задержка и доли ошибок одной заглушки."""
+
+    def __init__(self, rng: random.Random, latency: float = 0.0, jitter: float = 0.0,
+                 http_406: float = 0.0, garbage: float = 0.0, http_429: float = 0.0,
+                 outage: Optional[Tuple[float, float]] = None):
+        self.rng = rng
+        # (начало, длительность) в секундах от старта прогона: сервис полностью недоступен
+        self.outage = outage
+        self.started = time.monotonic()
+        self.latency = latency
+        self.jitter = jitter
+        self.http_406 = http_406
+        self.garbage = garbage
+        self.http_429 = http_429
+
+    async def delay(self):
+        value = self.latency + self.rng.uniform(0, self.jitter)
+        if value > 0:
+            await asyncio.sleep(value)
+
+    def pick(self) -> Optional[str]:
+        if self.outage is not None:
+            since_start = time.monotonic() - self.started
+            if self.outage[0] <= since_start < self.outage[0] + self.outage[1]:
+                return "outage"
+        roll = self.rng.random()
+        for name, rate in (("429", self.http_429), ("406", self.http_406), ("garbage", self.garbage)):
+            if roll < rate:
+                return name
+            roll -= rate
+        return None
+
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values: Dict[str, int] = {}
+
+    def inc(self, name: str, value: int = 1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def get(self, name: str) -> int:
+        return self.values.get(name, 0)
+
+
+class FakeChain:
+    """Переводы заглушек кошельков; toncenter видит их через confirm_after секунд.
+
+    У каждого кошелька (по мнемонике) свой баланс balance_ton.
+    """
+
+    def __init__(self, balance_ton: float, confirm_after: float):
+        self.initial_nano = int(balance_ton * 1_000_000_000)
+        self.balances: Dict[str, int] = {}
+        self.confirm_after = confirm_after
+        self.transactions: Dict[str, float] = {}
+        self.transfers: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def balance(self, wallet: str) -> int:
+        with self._lock:
+            return self.balances.setdefault(wallet, self.initial_nano)
+
+    def add(self, wallet: str, transfers: list) -> str:
+        """transfers: (адрес, сумма в TON, комментарий) каждого сообщения транзакции."""
+        tx_hash = os.urandom(32).hex()
+        amount_ton = sum(amount for _, amount, _ in transfers)
+        with self._lock:
+            self.balances[wallet] = self.balances.get(wallet, self.initial_nano) - int(amount_ton * 1_000_000_000)
+            self.transactions[tx_hash] = time.monotonic() + self.confirm_after
+            self.transfers[tx_hash] = transfers
+        return tx_hash
+
+    def confirmed(self, tx_hash: str) -> bool:
+        with self._lock:
+            confirm_at = self.transactions.get(tx_hash)
+        return confirm_at is not None and confirm_at <= time.monotonic()
+
+
+def fragment_handler(fault: Fault, counters: Counters):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        form = {key: values[0] for key, values in parse_qs(request.content.decode()).items()}
+        method = form.get("method", "unknown")
+        counters.inc("fragment")
+        counters.inc(f"fragment_{method}")
+        await fault.delay()
+        error = fault.pick()
+        if error == "429":
+            return httpx.Response(429, text="Too Many Requests")
+        if error == "outage":
+            return httpx.Response(503, text="<html>Service Unavailable</html>")
+        if error == "406":
+            return httpx.Response(406, text="Not Acceptable")
+        if error == "garbage":
+            return httpx.Response(200, text="<html><body>Cloudflare</body></html>")
+        if method == "searchStarsRecipient":
+            query = form.get("query", "")
+            return httpx.Response(200, json={"ok": True, "found": {"recipient": f"rcpt_{query}", "name": query.title()}})
+        if method == "initBuyStarsRequest":
+            quantity = int(form.get("quantity", 50))
+            return httpx.Response(200, json={"req_id": os.urandom(8).hex(), "amount": f"{quantity * 0.0035:.4f}"})
+        if method == "getBuyStarsLink":
+            payload = base64.b64encode(b"\x00\x00\x00\x00Telegram Stars Ref#" + os.urandom(6).hex().encode()).decode()
+            return httpx.Response(200, json={"ok": True, "transaction": {"messages": [{"payload": payload.rstrip("=")}]}})
+        return httpx.Response(200, json={"ok": False, "error": f"Unknown method {method}"})
+    return handler
+
+
+def toncenter_handler(fault: Fault, counters: Counters, chain: FakeChain):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        counters.inc("toncenter")
+        await fault.delay()
+        error = fault.pick()
+        if error == "429":
+            return httpx.Response(429, json={"error": "Ratelimit exceed"})
+        if error == "garbage":
+            return httpx.Response(200, json={"error": "internal"})
+        traces = []
+        for tx_hash in request.url.params.get_list("msg_hash"):
+            if chain.confirmed(tx_hash):
+                actions = [{"type": "ton_transfer", "success": True, "trace_external_hash": tx_hash,
+                            "details": {"destination": destination, "value": str(round(amount * 1_000_000_000)),
+                                        "comment": comment}}
+                           for destination, amount, comment in chain.transfers[tx_hash]]
+                traces.append({"external_hash": tx_hash, "transactions": {}, "actions": actions})
+        return httpx.Response(200, json={"traces": traces})
+    return handler
+
+
+class RequestFailedError(Exception):
+    """Как FunPayAPI.common.exceptions.RequestFailedError: ответ FunPay с кодом ошибки."""
+
+    def __init__(self, url: str, status_code: int):
+        self.url = url
+        self.status_code = status_code
+        super().__init__(f"Ошибка запроса к {url}. (Статус-код: {status_code})")
+
+
+def funpay_request(fault: Fault, counters: Counters, name: str, url: str):
+    """Один запрос к FunPay: задержка и ошибка по fault."""
+    counters.inc(f"funpay_{name}")
+    value = fault.latency + fault.rng.uniform(0, fault.jitter)
+    if value > 0:
+        time.sleep(value)
+    kind = fault.pick()
+    if kind is None:
+        return
+    counters.inc(f"funpay_{name}_error")
+    if kind == "garbage":
+        raise ValueError(f"Не удалось разобрать ответ FunPay на {url}")
+    raise RequestFailedError(url, {"outage": 503, "429": 429, "406": 406}[kind])
+
+
+def install_stubs(chain: FakeChain, wallet_fault: Fault, counters: Counters):
+    """Заглушки FunPayAPI, telebot и tonutils в sys.modules: плагин импортирует их при загрузке."""
+
+    def module(name: str, **attrs) -> types.ModuleType:
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    class NewOrderEvent:
+        def __init__(self, order):
+            self.order = order
+
+    class NewMessageEvent:
+        def __init__(self, message):
+            self.message = message
+
+    class InlineKeyboardMarkup:
+        def __init__(self, *args, **kwargs):
+            self.buttons = []
+
+        def add(self, *buttons):
+            self.buttons.extend(buttons)
+
+        def row(self, *buttons):
+            self.buttons.extend(buttons)
+
+    class InlineKeyboardButton:
+        def __init__(self, text: str = "", **kwargs):
+            self.text = text
+
+    funpay_types = module("FunPayAPI.types", SubCategoryTypes=types.SimpleNamespace(COMMON="common"))
+    events = module("FunPayAPI.updater.events", NewOrderEvent=NewOrderEvent, NewMessageEvent=NewMessageEvent)
+    updater = module("FunPayAPI.updater", events=events)
+    enums = types.SimpleNamespace(OrderStatuses=types.SimpleNamespace(PAID="paid", CLOSED="closed", REFUNDED="refunded"))
+    exceptions = module("FunPayAPI.common.exceptions", RequestFailedError=RequestFailedError)
+    common = module("FunPayAPI.common", exceptions=exceptions)
+    module("FunPayAPI", Account=object, enums=enums, types=funpay_types, updater=updater, common=common)
+    telebot_types = module("telebot.types", InlineKeyboardMarkup=InlineKeyboardMarkup,
+                           InlineKeyboardButton=InlineKeyboardButton, Message=object, CallbackQuery=object)
+    module("telebot", types=telebot_types)
+
+    class TransferData:
+        def __init__(self, destination: str, amount: float, body: str):
+            self.destination = destination
+            self.amount = amount
+            self.body = body
+
+    class TonapiClient:
+        def __init__(self, api_key: str = "", is_testnet: bool = False):
+            self.api_key = api_key
+
+    class WalletV5R1:
+        def __init__(self, name: str):
+            self.name = name
+
+        @classmethod
+        def from_mnemonic(cls, client, mnemonic):
+            return cls(mnemonic[0] if mnemonic else "main"), b"", b"", mnemonic
+
+        async def balance(self) -> int:
+            counters.inc("wallet_balance")
+            await wallet_fault.delay()
+            if wallet_fault.pick() == "outage":
+                raise RuntimeError("Tonapi error 503: service unavailable")
+            return chain.balance(self.name)
+
+        async def _send(self, transfers: list) -> str:
+            counters.inc("wallet_send")
+            await wallet_fault.delay()
+            error = wallet_fault.pick()
+            if error == "406":
+                raise RuntimeError("Failed to send message: 406 External message was not accepted")
+            if error == "429":
+                raise RuntimeError("Tonapi error 429: rate limit exceeded")
+            if error == "outage":
+                raise RuntimeError("Tonapi error 503: service unavailable")
+            if error == "garbage":
+                raise RuntimeError("Failed to parse Tonapi response")
+            counters.inc(f"wallet_send_{self.name}")
+            return chain.add(self.name, transfers)
+
+        async def transfer(self, destination: str, amount: float, body: str = "") -> str:
+            return await self._send([(destination, amount, body)])
+
+        async def batch_transfer(self, data_list: List[TransferData]) -> str:
+            counters.inc("wallet_batched_messages", len(data_list))
+            return await self._send([(data.destination, data.amount, data.body) for data in data_list])
+
+    module("tonutils")
+    module("tonutils.client", TonapiClient=TonapiClient)
+    module("tonutils.wallet", WalletV5R1=WalletV5R1)
+    module("tonutils.wallet.data", TransferData=TransferData)
+    return NewOrderEvent, NewMessageEvent
+
+
+class Tracker:
+    """Время заказов от NewOrderEvent и от подтверждения «Да» до финального сообщения покупателю."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created: Dict[int, float] = {}
+        self.confirmed: Dict[int, float] = {}
+        self.finished: Dict[int, tuple] = {}
+
+    def buyer_message(self, chat_id: int, text: str):
+        if "Успешная сделка" in text:
+            outcome = "success"
+        elif text.lstrip().startswith("❌"):
+            outcome = "fail"
+        else:
+            return
+        with self._lock:
+            if chat_id in self.finished or chat_id not in self.created:
+                return
+            self.finished[chat_id] = (outcome, time.perf_counter())
+
+
+class FakeCardinal:
+    """Cardinal и Account в памяти; запросы к FunPay идут через fault.
+
+    send_message, как в Cardinal, делает до SEND_ATTEMPTS попыток и после неудачных не бросает исключение,
+    а возвращает None: сообщение покупателю просто теряется.
+    """
+
+    SEND_ATTEMPTS = 3
+
+    def __init__(self, tracker: Tracker, counters: Counters, fault: Fault, lots: int = 0):
+        self.tracker = tracker
+        self.counters = counters
+        self.fault = fault
+        self.account = FakeAccount(counters, fault, lots)
+        bot = types.SimpleNamespace(send_message=self._telegram_message, answer_callback_query=lambda *a, **k: None,
+                                    edit_message_text=lambda *a, **k: None)
+        self.telegram = types.SimpleNamespace(bot=bot)
+        self.tg_profile = types.SimpleNamespace(get_sorted_lots=self._sorted_lots)
+
+    def send_message(self, chat_id: int, text: str, *args, **kwargs):
+        # Момент, когда плагин закончил с заказом, — первая попытка, а не доставка
+        self.tracker.buyer_message(chat_id, text)
+        for attempt in range(self.SEND_ATTEMPTS):
+            try:
+                funpay_request(self.fault, self.counters, "send_message", f"https://funpay.com/chat/?node={chat_id}")
+                return True
+            except Exception:
+                if attempt + 1 < self.SEND_ATTEMPTS:
+                    time.sleep(self.fault.latency)
+        self.counters.inc("funpay_send_message_lost")
+        return None
+
+    def _sorted_lots(self, mode: int) -> dict:
+        return {FakeAccount.SUBCATEGORY: {lot_id: types.SimpleNamespace(id=lot_id) for lot_id in self.account.lots}}
+
+    def _telegram_message(self, *args, **kwargs):
+        self.counters.inc("telegram_send_message")
+
+    def update_lots_and_categories(self):
+        pass
+
+
+class FakeAccount:
+    SUBCATEGORY = "stars"
+
+    def __init__(self, counters: Counters, fault: Fault, lots: int = 0):
+        self.counters = counters
+        self.fault = fault
+        self.id = SELLER_ID
+        self.username = SELLER_USERNAME
+        self._lock = threading.Lock()
+        # Лоты продавца: id → активен ли
+        self.lots: Dict[int, bool] = {1000 + index: True for index in range(lots)}
+
+    def get_order(self, order_id: str):
+        index = order_id.split("-")[-1]
+        return types.SimpleNamespace(status="paid", lot_params=[], character_name=None,
+                                     buyer_params={"Telegram Username": f"@buyer{index}"})
+
+    def get_chat_by_name(self, name: str, make_request: bool = False):
+        return types.SimpleNamespace(id=100_000 + int(name.replace("buyer", "")))
+
+    def refund(self, order_id: str):
+        self.counters.inc("refund")
+
+    def get_subcategory(self, *args):
+        return self.SUBCATEGORY
+
+    def get_lot_fields(self, lot_id: int):
+        funpay_request(self.fault, self.counters, "get_lot_fields", f"https://funpay.com/lots/offerEdit?offer={lot_id}")
+        with self._lock:
+            if lot_id not in self.lots:
+                return None
+            return types.SimpleNamespace(lot_id=lot_id, active=self.lots[lot_id])
+
+    def save_lot(self, fields):
+        funpay_request(self.fault, self.counters, "save_lot", "https://funpay.com/lots/offerSave")
+        with self._lock:
+            self.lots[fields.lot_id] = fields.active
+
+
+def parse_outage(value: Optional[str]) -> Optional[Tuple[float, float]]:
+    if not value:
+        return None
+    start, duration = value.split(":")
+    return float(start), float(duration)
+
+
+def percentiles(values: List[float]) -> str:
+    if not values:
+        return "нет данных"
+    values = sorted(values)
+    picks = [values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.95, 0.99)]
+    return f"p50={picks[0]:.2f}s p95={picks[1]:.2f}s p99={picks[2]:.2f}s max={values[-1]:.2f}s"
+
+
+class ScaledRandom:
+    """random для плагина с масштабированной паузой между переводами (TransferBatcher спит randint(2, 10) с)."""
+
+    def __init__(self, scale: float):
+        self.scale = scale
+
+    def randint(self, a: int, b: int) -> float:
+        return random.uniform(a, b) * self.scale
+
+    def __getattr__(self, name):
+        return getattr(random, name)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд auto_stars без сети")
+    parser.add_argument("--orders", type=int, default=100, help="количество синтетических заказов")
+    parser.add_argument("--rate", type=float, default=2.0, help="заказов в секунду (пуассоновский поток)")
+    parser.add_argument("--confirm-delay", type=float, default=1.0, help="через сколько секунд покупатель отвечает «Да»")
+    parser.add_argument("--workers", type=int, default=3, help="PAYMENT_WORKERS")
+    parser.add_argument("--batch-size", type=int, default=1, help="TRANSFER_BATCH_SIZE")
+    parser.add_argument("--speculative", action="store_true", help="SPECULATIVE_PREPARE")
+    parser.add_argument("--seqno-pause-scale", type=float, default=1.0,
+                        help="множитель паузы между переводами кошелька (1 — как в бою, 0 — без паузы)")
+    parser.add_argument("--fragment-latency", type=float, default=0.3)
+    parser.add_argument("--fragment-406", type=float, default=0.0, help="доля ответов 406 от Fragment")
+    parser.add_argument("--fragment-garbage", type=float, default=0.0, help="доля ответов не-JSON от Fragment")
+    parser.add_argument("--fragment-429", type=float, default=0.0, help="доля ответов 429 от Fragment")
+    parser.add_argument("--fragment-outage", help="START:DURATION — Fragment отвечает 503 в этом окне, с от старта")
+    parser.add_argument("--wallet-latency", type=float, default=0.5)
+    parser.add_argument("--wallet-406", type=float, default=0.0, help="доля 'External message was not accepted'")
+    parser.add_argument("--wallet-429", type=float, default=0.0)
+    parser.add_argument("--wallet-outage", help="START:DURATION — кошелёк недоступен в этом окне, с от старта")
+    parser.add_argument("--probe-interval", type=float, default=60.0, help="CIRCUIT_PROBE_INTERVAL")
+    parser.add_argument("--toncenter-latency", type=float, default=0.2)
+    parser.add_argument("--toncenter-429", type=float, default=0.0)
+    parser.add_argument("--toncenter-garbage", type=float, default=0.0)
+    parser.add_argument("--confirm-after", type=float, default=5.0, help="через сколько секунд перевод виден в toncenter")
+    parser.add_argument("--funpay-latency", type=float, default=0.05, help="задержка запроса к FunPay")
+    parser.add_argument("--funpay-406", type=float, default=0.0, help="доля ответов 406 от FunPay")
+    parser.add_argument("--funpay-garbage", type=float, default=0.0, help="доля неразборчивых ответов FunPay")
+    parser.add_argument("--funpay-429", type=float, default=0.0, help="доля ответов 429 от FunPay")
+    parser.add_argument("--funpay-outage", help="START:DURATION — FunPay отвечает 503 в этом окне, с от старта")
+    parser.add_argument("--lots", type=int, default=5, help="число лотов продавца (выключаются предохранителем)")
+    parser.add_argument("--balance", type=float, default=100_000.0, help="баланс каждого кошелька заглушки, TON")
+    parser.add_argument("--wallets", type=int, default=1, help="число кошельков в WALLETS (1 — только MNEMONIC)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="предельное время прогона, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи плагина")
+    return parser.parse_args(argv)
+
+
+def load_plugin(workdir: str, args):
+    os.makedirs(os.path.join(workdir, "plugins"), exist_ok=True)
+    with open(os.path.join(workdir, "plugins", "stars_config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "PAYMENT_WORKERS": args.workers,
+            "TRANSFER_BATCH_SIZE": args.batch_size,
+            "SPECULATIVE_PREPARE": args.speculative,
+            "CONFIRMATION_TIMEOUT": max(30.0, args.confirm_after * 5),
+            "AUTO_REFUND": False,
+            "CIRCUIT_PROBE_INTERVAL": args.probe_interval,
+            "MNEMONIC": ["main"],
+            "WALLETS": [{"name": f"w{index + 1}", "MNEMONIC": [f"w{index + 1}"]}
+                        for index in range(args.wallets)] if args.wallets > 1 else [],
+            "user_id": SELLER_ID,
+        }, f)
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("auto_stars_bench_plugin", PLUGIN_PATH)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    atexit.unregister(plugin.shutdown)
+    if not args.verbose:
+        for handler in plugin.logger.handlers:
+            if not isinstance(handler, logging.FileHandler):
+                handler.setLevel(logging.CRITICAL)
+    return plugin
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    counters = Counters()
+    chain = FakeChain(args.balance, args.confirm_after)
+    fragment_fault = Fault(rng, args.fragment_latency, args.fragment_latency / 2, args.fragment_406,
+                           args.fragment_garbage, args.fragment_429, outage=parse_outage(args.fragment_outage))
+    wallet_fault = Fault(rng, args.wallet_latency, args.wallet_latency / 2, http_406=args.wallet_406,
+                         http_429=args.wallet_429, outage=parse_outage(args.wallet_outage))
+    toncenter_fault = Fault(rng, args.toncenter_latency, args.toncenter_latency / 2,
+                            garbage=args.toncenter_garbage, http_429=args.toncenter_429)
+    funpay_fault = Fault(rng, args.funpay_latency, 0.0, args.funpay_406, args.funpay_garbage, args.funpay_429,
+                         outage=parse_outage(args.funpay_outage))
+    NewOrderEvent, NewMessageEvent = install_stubs(chain, wallet_fault, counters)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="auto_stars_bench_")
+    try:
+        plugin = load_plugin(workdir, args)
+        plugin.random = ScaledRandom(args.seqno_pause_scale)
+        plugin.fragment_client._client = httpx.AsyncClient(
+            transport=httpx.MockTransport(fragment_handler(fragment_fault, counters)),
+            headers=plugin.headers, timeout=plugin.fragment_client.timeout)
+        processor = plugin.get_payment_processor()
+        processor.confirmations._client = httpx.AsyncClient(
+            transport=httpx.MockTransport(toncenter_handler(toncenter_fault, counters, chain)))
+
+        tracker = Tracker()
+        cardinal = FakeCardinal(tracker, counters, funpay_fault, args.lots)
+        plugin.cardinal_ref = cardinal
+        os.makedirs(os.path.dirname(plugin.LOTS_IDS_FILE), exist_ok=True)
+        with open(plugin.LOTS_IDS_FILE, "w", encoding="utf-8") as f:
+            json.dump(list(cardinal.account.lots), f)
+
+        # События идут по одному в порядке времени, как из runner'а Cardinal
+        events = []
+        at = 0.0
+        for i in range(args.orders):
+            at += rng.expovariate(args.rate) if args.rate > 0 else 0.0
+            heapq.heappush(events, (at, i, "order"))
+            heapq.heappush(events, (at + args.confirm_delay, i, "confirm"))
+
+        started = time.perf_counter()
+        fragment_fault.started = wallet_fault.started = toncenter_fault.started = funpay_fault.started = time.monotonic()
+        while events:
+            at, i, kind = heapq.heappop(events)
+            wait = started + at - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            chat_id = 100_000 + i
+            if kind == "order":
+                order = types.SimpleNamespace(id=f"BENCH-{i}", buyer_id=chat_id, buyer_username=f"buyer{i}",
+                                              description="100 звёзд", price=150.0, currency="₽", amount=1)
+                with tracker._lock:
+                    tracker.created[chat_id] = time.perf_counter()
+                plugin.stars_auto(cardinal, NewOrderEvent(order))
+            else:
+                message = types.SimpleNamespace(chat_id=chat_id, text="Да", author=f"buyer{i}")
+                with tracker._lock:
+                    tracker.confirmed[chat_id] = time.perf_counter()
+                plugin.stars_auto(cardinal, NewMessageEvent(message))
+        dispatched = time.perf_counter() - started
+
+        order_ids = [f"BENCH-{i}" for i in range(args.orders)]
+        wait_settled(plugin, processor, order_ids, started + args.timeout)
+        elapsed = time.perf_counter() - started
+        report = build_report(args, plugin, tracker, counters, elapsed, dispatched)
+        report["lots_active"] = sum(cardinal.account.lots.values())
+        plugin.shutdown()
+        # Перезапуск: выполненные, отменённые и брошенные заказы не должны снова попасть в незавершённые
+        reloaded = plugin.OrderStore(plugin.ORDERS_DB_FILE)
+        report["reloaded_orders"] = len(reloaded.pending())
+        reloaded.close()
+        return report
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def wait_settled(plugin, processor, order_ids: List[str], deadline: float) -> bool:
+    """Ждёт, пока заказы закроются в OrderStore, журнал дойдёт до конечного этапа и воркеры освободятся.
+
+    Финальное сообщение покупателю уходит до того, как process_payment вернётся и запишет метрики,
+    поэтому Tracker для остановки не годится.
+    """
+    while time.perf_counter() < deadline:
+        pending = {order["orderID"] for order in plugin.order_store.pending()}
+        stages = [plugin.payment_ledger.stage(order_id) for order_id in order_ids]
+        if (processor.busy_workers == 0 and not pending.intersection(order_ids)
+                and all(stage is None or stage in plugin.PaymentLedger.FINAL for stage in stages)):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def build_report(args, plugin, tracker: Tracker, counters: Counters, elapsed: float, dispatched: float) -> dict:
+    with tracker._lock:
+        finished = dict(tracker.finished)
+    # Исход заказа — по журналу оплат: финальное сообщение покупателю могло потеряться
+    pending = {order["orderID"] for order in plugin.order_store.pending()}
+    stages = {100_000 + i: plugin.payment_ledger.stage(f"BENCH-{i}") for i in range(args.orders)}
+    succeeded = [chat for chat, stage in stages.items() if stage == "confirmed"]
+    closed = [chat for chat, stage in stages.items()
+              if f"BENCH-{chat - 100_000}" not in pending and (stage is None or stage in plugin.PaymentLedger.FINAL)]
+    end_to_end = [at - tracker.created[chat] for chat, (_, at) in finished.items()]
+    after_confirm = [at - tracker.confirmed[chat] for chat, (_, at) in finished.items() if chat in tracker.confirmed]
+    last_finish = max((at for _, at in finished.values()), default=0.0)
+    first_order = min(tracker.created.values(), default=0.0)
+    span = max(last_finish - first_order, 1e-9)
+    fragment_calls = counters.get("fragment")
+    wallet_sends = counters.get("wallet_send")
+    return {
+        "orders": args.orders,
+        "finished": len(closed),
+        "succeeded": len(succeeded),
+        "failed": len(closed) - len(succeeded),
+        "unfinished": args.orders - len(closed),
+        "elapsed_s": round(elapsed, 2),
+        "dispatch_s": round(dispatched, 2),
+        "throughput_per_min": round(len(succeeded) / span * 60, 2) if succeeded else 0.0,
+        "latency_order": percentiles(end_to_end),
+        "latency_after_confirm": percentiles(after_confirm),
+        "fragment_calls": fragment_calls,
+        "fragment_calls_by_method": {k[len("fragment_"):]: v for k, v in sorted(counters.values.items())
+                                     if k.startswith("fragment_")},
+        # Без ошибок заказ стоит 3 запроса к Fragment: search, init, link
+        "fragment_amplification": round(fragment_calls / (3 * args.orders), 2) if args.orders else 0.0,
+        "wallet_sends": wallet_sends,
+        "wallet_amplification": round(wallet_sends / max(1, len(succeeded)), 2),
+        "wallet_sends_by_wallet": {k[len("wallet_send_"):]: v for k, v in sorted(counters.values.items())
+                                   if k.startswith("wallet_send_")},
+        "toncenter_calls": counters.get("toncenter"),
+        "funpay_messages": counters.get("funpay_send_message"),
+        "funpay_messages_lost": counters.get("funpay_send_message_lost"),
+        "funpay_errors": {k[len("funpay_"):-len("_error")]: v for k, v in sorted(counters.values.items())
+                          if k.startswith("funpay_") and k.endswith("_error")},
+        "lots_total": args.lots,
+        "refunds": counters.get("refund"),
+        "plugin_retries": dict(plugin.metrics.retries),
+        "plugin_errors": dict(plugin.metrics.errors),
+        "plugin_metrics": plugin.metrics.summary_text(),
+    }
+
+
+def print_report(report: dict):
+    print("AutoStars — нагрузочный прогон")
+    print("──────────────────────────────")
+    print(f"Заказов: {report['orders']}, выполнено: {report['succeeded']}, ошибок: {report['failed']}, "
+          f"не завершено: {report['unfinished']}")
+    print(f"Время прогона: {report['elapsed_s']} с (подача событий {report['dispatch_s']} с)")
+    print(f"Пропускная способность: {report['throughput_per_min']} заказов/мин")
+    print(f"Задержка от заказа: {report['latency_order']}")
+    print(f"Задержка от «Да»: {report['latency_after_confirm']}")
+    print(f"Fragment: {report['fragment_calls']} запросов, усиление x{report['fragment_amplification']} "
+          f"{report['fragment_calls_by_method']}")
+    print(f"Кошелёк: {report['wallet_sends']} отправок, x{report['wallet_amplification']} на выполненный заказ")
+    if len(report["wallet_sends_by_wallet"]) > 1:
+        print("  по кошелькам: " + ", ".join(f"{name}={count}" for name, count in report["wallet_sends_by_wallet"].items()))
+    print(f"toncenter: {report['toncenter_calls']} запросов")
+    print(f"FunPay: {report['funpay_messages']} попыток отправки, потеряно сообщений: "
+          f"{report['funpay_messages_lost']}, ошибок {report['funpay_errors']}, возвратов: {report['refunds']}")
+    print(f"Лоты: активно {report['lots_active']} из {report['lots_total']}")
+    print(f"Незавершённых заказов после перезапуска: {report['reloaded_orders']}")
+    print(f"Повторы плагина: {report['plugin_retries']}, ошибки: {report['plugin_errors']}")
+    print()
+    print(report["plugin_metrics"])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,9 +17,13 @@ try:
 except ImportError:
     main(["install", "-U", "mplcyberpunk==0.7.1"])
     import mplcyberpunk
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import TYPE_CHECKING
 import io
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from telebot.types import InputMediaPhoto
 
@@ -28,6 +32,7 @@ from tg_bot import CBT
 if TYPE_CHECKING:
     from cardinal import Cardinal
 from FunPayAPI.updater.events import *
+from FunPayAPI.common.enums import OrderStatuses
 from os.path import exists
 import tg_bot.CBT
 import telebot
@@ -35,7 +40,8 @@ import time
 from logging import getLogger
 
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import matplotlib.style
+from matplotlib.figure import Figure
 from telebot.types import InlineKeyboardMarkup as K, InlineKeyboardButton as B
 
 NAME = "Graphs Plugin"
@@ -48,6 +54,7 @@ SETTINGS_PAGE = True
 SETTINGS = {
     "head": 10,
     "min4line": 13,
+    "recheck": 7,
     "graph1": True,
     "graph2": True,
     "graph3": True,
@@ -68,6 +75,468 @@ CBT_TEXT_EDITED = "graphs_Edited"
 CBT_TEXT_SWITCH = "graphs_Switch"
 
 
+SALES_DB_FILE = "storage/plugins/graphs_sales_{}.sqlite3"
+
+
+class CachedSale:
+    """Продажа из локального кэша с теми же полями, что использует отрисовка графиков."""
+    __slots__ = ("id", "date", "price", "currency", "status", "subcategory_name", "buyer_username")
+
+    def __init__(self, id, date, price, currency, status, subcategory_name, buyer_username):
+        self.id = id
+        self.date = date
+        self.price = price
+        self.currency = currency
+        self.status = status
+        self.subcategory_name = subcategory_name
+        self.buyer_username = buyer_username
+
+
+class SalesCache:
+    """Продажи аккаунта в SQLite: ключ — ID заказа, индекс по дате.
+
+    В кэше лежит непрерывный отрезок истории от самого нового заказа до tail_date;
+    tail_id — с какого заказа продолжать сканирование вглубь, complete — история выкачана целиком.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sales ("
+            "id TEXT PRIMARY KEY, "
+            "date REAL NOT NULL, "
+            "price REAL NOT NULL, "
+            "currency TEXT NOT NULL, "
+            "status INTEGER NOT NULL, "
+            "subcategory_name TEXT NOT NULL, "
+            "buyer_username TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_date ON sales (date)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def get_meta(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, **values):
+        self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                               [(key, json.dumps(value)) for key, value in values.items()])
+
+    @property
+    def tail_date(self) -> datetime | None:
+        timestamp = self.get_meta("tail_date")
+        return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+    def contains_any(self, order_ids: list[str]) -> bool:
+        if not order_ids:
+            return False
+        with self._lock:
+            row = self._conn.execute(f"SELECT 1 FROM sales WHERE id IN ({','.join('?' * len(order_ids))}) LIMIT 1",
+                                     order_ids).fetchone()
+        return row is not None
+
+    def _upsert(self, sales: list):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO sales (id, date, price, currency, status, subcategory_name, buyer_username) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(sale.id, sale.date.timestamp(), sale.price, str(sale.currency), sale.status.value,
+              sale.subcategory_name, sale.buyer_username) for sale in sales]
+        )
+
+    def save_head(self, sales: list, next_order_id: str | None, reset: bool = False):
+        """Сохраняет свежие страницы одним коммитом: либо отрезок стыкуется с кэшем, либо кэш начинается заново."""
+        with self._lock, self._conn:
+            if reset:
+                self._conn.execute("DELETE FROM sales")
+                self._conn.execute("DELETE FROM meta")
+            self._upsert(sales)
+            if reset:
+                self._set_meta(tail_id=next_order_id,
+                               tail_date=sales[-1].date.timestamp() if sales else time.time(),
+                               complete=next_order_id is None or not sales)
+
+    def save_tail(self, sales: list, next_order_id: str | None):
+        """Дописывает страницу, полученную при сканировании вглубь от tail_id."""
+        with self._lock, self._conn:
+            self._upsert(sales)
+            values = {"tail_id": next_order_id, "complete": next_order_id is None}
+            if sales:
+                values["tail_date"] = sales[-1].date.timestamp()
+            self._set_meta(**values)
+
+    def since(self, border: datetime) -> list[CachedSale]:
+        """Продажи новее border, от новых к старым."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, date, price, currency, status, subcategory_name, buyer_username "
+                "FROM sales WHERE date > ? ORDER BY date DESC", (border.timestamp(),)
+            ).fetchall()
+        return [CachedSale(order_id, datetime.fromtimestamp(date), price, currency, OrderStatuses(status),
+                           subcategory_name, buyer_username)
+                for order_id, date, price, currency, status, subcategory_name, buyer_username in rows]
+
+
+# Кэш у каждого аккаунта свой: после смены аккаунта в Cardinal продажи не смешиваются
+sales_caches: dict[int, SalesCache] = {}
+sales_caches_lock = threading.Lock()
+
+
+def get_sales_cache(account_id: int) -> SalesCache:
+    with sales_caches_lock:
+        if account_id not in sales_caches:
+            sales_caches[account_id] = SalesCache(SALES_DB_FILE.format(account_id))
+        return sales_caches[account_id]
+
+
+def orders_to_columns(orders_list) -> dict:
+    """Заказы -> компактные numpy-массивы; из них, а не из объектов заказов, строятся агрегаты для графиков."""
+    subcategories, subcategory_codes = np.unique([order.subcategory_name for order in orders_list],
+                                                 return_inverse=True)
+    buyers, buyer_codes = np.unique([order.buyer_username for order in orders_list], return_inverse=True)
+    return {
+        "date": np.array([order.date for order in orders_list], dtype="datetime64[ns]"),
+        "price": np.array([order.price for order in orders_list], dtype=np.float64),
+        "status": np.array([order.status.value for order in orders_list], dtype=np.int8),
+        "currency": np.array([str(order.currency) for order in orders_list]),
+        "subcategory": subcategory_codes.astype(np.int32),
+        "subcategories": subcategories,
+        "buyer": buyer_codes.astype(np.int32),
+        "buyers": buyers
+    }
+
+
+def get_color(status: OrderStatuses):
+    try:
+        return ("blue", "green", "orange")[status]
+    except:
+        return "black"
+
+
+def get_text(status: OrderStatuses):
+    try:
+        return ("Оплачен", "Закрыт", "Возврат")[status]
+    except:
+        return "Какой-то статус"
+
+
+def my_cyberpunk(ax, bars=None):
+    # mplcyberpunk.make_lines_glow(ax)
+    # mplcyberpunk.add_underglow(ax)
+    mplcyberpunk.add_gradient_fill(ax=ax)
+    # mplcyberpunk.add_glow_effects(ax, gradient_fill=True)
+    # mplcyberpunk.add_gradient_fill(ax)
+    try:
+        mplcyberpunk.make_scatter_glow(ax)
+    except:
+        pass
+    if bars is not None:
+        mplcyberpunk.add_bar_gradient(bars.patches, ax=ax, horizontal=True)
+
+def fill_days(by_day: pd.Series) -> pd.DataFrame:
+    """(день, статус) -> таблица день × статус без пропущенных дней между первым и последним заказом."""
+    table = by_day.unstack(fill_value=0)
+    table.index = pd.PeriodIndex(table.index, freq='D')
+    table = table.reindex(pd.period_range(table.index.min(), table.index.max(), freq='D'), fill_value=0)
+    table.index.name = 'day'
+    return table
+
+
+def aggregate_orders(columns: dict) -> dict:
+    """Один проход по заказам периода: все графики строятся из этих агрегатов.
+
+    Заказы группируются один раз по (валюта, статус, день, подкатегория, покупатель),
+    остальные группировки — свёртки этой таблицы, а не новых списков заказов.
+    """
+    frame = pd.DataFrame({
+        'currency': columns["currency"],
+        'status': columns["status"].astype(int),
+        'day': columns["date"].astype("datetime64[D]"),
+        'subcategory': columns["subcategory"],
+        'buyer': columns["buyer"],
+        'price': columns["price"]
+    })
+    base = frame.groupby(['currency', 'status', 'day', 'subcategory', 'buyer'], sort=False) \
+        .agg(count=('price', 'size'), price=('price', 'sum'))
+    currencies = sorted(frame['currency'].unique().tolist())
+
+    by_day = base.groupby(level=['currency', 'day', 'status']).sum()
+    result = {
+        "currencies": currencies,
+        "count_by_day": fill_days(by_day['count'].groupby(level=['day', 'status']).sum()),
+        "price_by_day": {currency: fill_days(by_day.loc[currency, 'price']) for currency in currencies}
+    }
+
+    by_subcategory = base.groupby(level=['currency', 'subcategory', 'status']).sum()
+    games = np.array([name.split(",")[0] for name in columns["subcategories"]], dtype=object)
+    sources = {
+        'subcategory_name': (by_subcategory, columns["subcategories"]),
+        'game_name': (by_subcategory, games),
+        'buyer_username': (base.groupby(level=['currency', 'buyer', 'status']).sum(), columns["buyers"])
+    }
+    for parameter, (grouped, names) in sources.items():
+        # Коды -> названия; для игр несколько подкатегорий сворачиваются в одну строку
+        keys = [grouped.index.get_level_values('currency'), names[grouped.index.get_level_values(1)],
+                grouped.index.get_level_values('status')]
+        grouped = grouped.groupby(keys).sum().rename_axis(['currency', parameter, 'status'])
+        result[parameter] = {
+            "count": grouped['count'].groupby(level=[parameter, 'status']).sum().unstack(fill_value=0),
+            "price": {currency: grouped.loc[currency, 'price'].unstack(fill_value=0) for currency in currencies}
+        }
+    return result
+
+
+def split_periods(by_day: pd.DataFrame) -> list:
+    """Таблица по дням -> [по дням, по месяцам, по годам]; месяцы и годы — только если их больше одного."""
+    by_month = by_day.groupby(by_day.index.asfreq('M')).sum().rename_axis('month')
+    by_year = by_day.groupby(by_day.index.asfreq('Y')).sum().rename_axis('year')
+    return [by_day] + [table for table in (by_month, by_year) if len(table) > 1]
+
+
+def draw_price_time(price_by_day: pd.DataFrame, currency, min4line: int) -> bytes:
+    # Суммы по дням, а при нескольких месяцах / годах — и по ним
+    ord_data = split_periods(price_by_day)
+    rows = len(ord_data)
+    # Строим графики
+    fig = Figure(figsize=(10, 5 * rows))
+    axs = fig.subplots(rows, 1)
+    if type(axs) != np.ndarray:
+        axs = [axs]
+
+    # Добавляем аннотации и корректные подписи столбцов с цветами
+    for ax, orders_data, x_title in zip(axs, ord_data, ['День', "Месяц", "Год"]):
+        bars = None
+        if len(orders_data) < min4line:
+            colors = {0: 'blue', 1: 'green', 2: 'orange'}
+            labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
+            # Строим столбчатую диаграмму, если столбцов не более 10
+            bars = orders_data[::-1].plot(kind='barh', stacked=False, ax=ax,
+                                          color=[colors[col] for col in orders_data.columns])
+
+            # Добавляем подписи над столбцами с суммой
+            for rect in bars.patches:
+                width = rect.get_width()
+                ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
+                            xy=(width, rect.get_y() + rect.get_height() / 2),
+                            xytext=(3, 0),  # 3 points horizontal offset
+                            textcoords="offset points",
+                            ha='left', va='center')
+
+            ax.legend([labels[lb] for lb in orders_data.columns])
+        else:
+            # Строим линейный график, если столбцов более 10
+            for status in orders_data.columns:
+                orders_data[status].plot(ax=ax, label=get_text(status), color=get_color(status), marker=".")
+
+            # Добавляем сетку на линейный график
+            ax.grid(True)
+
+            ax.legend()
+        my_cyberpunk(ax, bars)
+        ax.set_title(f'Сумма заказов ({currency}) / {x_title}')
+        ax.set_xlabel("")
+        ax.set_ylabel(f'')
+
+    fig.tight_layout()
+    fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
+             fontsize=10, color='gray', alpha=0.5)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=300)
+
+    return buf.getvalue()
+
+
+def draw_k_sales_time(count_by_day: pd.DataFrame, min4line: int) -> bytes:
+    # Количество по дням, а при нескольких месяцах / годах — и по ним
+    ord_data = split_periods(count_by_day)
+    rows = len(ord_data)
+
+    # Строим графики
+    fig = Figure(figsize=(10, 5 * rows))
+    axs = fig.subplots(rows, 1)
+    if type(axs) != np.ndarray:
+        axs = [axs]
+
+    # Добавляем аннотации и корректные подписи столбцов с цветами
+    for ax, orders_data, x_title in zip(axs, ord_data, ['День', "Месяц", "Год"]):
+        bars = None
+        if len(orders_data) < min4line:
+            colors = {0: 'blue', 1: 'green', 2: 'orange'}
+            labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
+            # Строим столбчатую диаграмму, если столбцов не более 10
+            bars = orders_data[::-1].plot(kind='barh', stacked=False, ax=ax,
+                                          color=[colors[col] for col in orders_data.columns])
+
+            # Добавляем подписи над столбцами с количеством
+            for rect in bars.patches:
+                width = rect.get_width()
+                ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
+                            xy=(width, rect.get_y() + rect.get_height() / 2),
+                            xytext=(3, 0),  # 3 points horizontal offset
+                            textcoords="offset points",
+                            ha='left', va='center')
+            ax.legend([labels[lb] for lb in orders_data.columns])
+
+        else:
+            # Строим линейный график, если столбцов более 10
+            for status in orders_data.columns:
+                orders_data[status].plot(ax=ax, label=get_text(status), color=get_color(status), marker=".")
+
+            # Добавляем сетку на линейный график
+            ax.grid(True)
+
+            ax.legend()
+
+        ax.set_title(f'Количество заказов / {x_title}')
+        ax.set_xlabel("")
+        ax.set_ylabel('')
+        my_cyberpunk(ax, bars)
+    fig.tight_layout()
+    fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
+             fontsize=10, color='gray', alpha=0.5)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=300)
+
+    return buf.getvalue()
+
+
+def draw_bar_charts(orders_by_parameter: pd.DataFrame, parameter, head: int) -> bytes:
+    # Выбираем заголовок по параметру группировки
+    if parameter == 'subcategory_name':
+        title = 'Количество заказов по подкатегориям'
+    elif parameter == 'buyer_username':
+        title = 'Количество заказов по никнеймам покупателей'
+    elif parameter == 'game_name':
+        title = 'Количество заказов по названиям игр'
+    else:
+        raise ValueError(f"Неподдерживаемый параметр: {parameter}")
+
+    # Количество заказов уже посчитано в aggregate_orders, сортируем по убыванию
+    sorted_orders = orders_by_parameter.sum(axis=1).sort_values(ascending=False).index
+    orders_by_parameter = orders_by_parameter.loc[sorted_orders]
+    # orders_by_parameter = df.groupby([group_by_parameter]).size().sort_values(ascending=False)
+
+    # Получаем только топ-X значений
+    top_x_orders = orders_by_parameter.head(head)[::-1]
+
+    # Строим столбчатую диаграмму
+    fig = Figure(figsize=(10, 10))
+    ax = fig.subplots()
+    colors = {0: 'blue', 1: 'green', 2: 'orange'}
+    labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
+    bars = top_x_orders.plot(kind='barh', stacked=False, ax=ax,
+                             color=[colors[col] for col in top_x_orders.columns])
+
+    # Добавляем подписи над столбцами с количеством
+    for rect in bars.patches:
+        width = rect.get_width()
+        ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
+                    xy=(width, rect.get_y() + rect.get_height() / 2),
+                    xytext=(3, 0),  # 3 points horizontal offset
+                    textcoords="offset points",
+                    ha='left', va='center')
+    ax.legend([labels[lb] for lb in top_x_orders.columns], loc='lower right')
+
+    ax.set_title(title)
+    ax.set_xlabel("")
+    ax.set_ylabel('')
+    my_cyberpunk(ax, bars)
+    fig.tight_layout()
+    fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
+             fontsize=10, color='gray', alpha=0.5)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=300)
+
+    return buf.getvalue()
+
+
+def draw_combined_charts(price_by_currency: dict, parameter, head) -> bytes | None:
+    currencies = ['₽', '$', '€']
+    non_empty_plots = 0  # Счетчик непустых графиков
+
+    # Создаем общий график
+    set_curr = set(price_by_currency)
+    len_curr = len(set_curr)
+    fig = Figure(figsize=(10, 5 * (2 if len_curr == 1 else len_curr)))
+    axes = fig.subplots(len_curr, 1)
+    if type(axes) != np.ndarray:
+        axes = [axes]
+    for currency, ax in zip(sorted(list(set_curr)), axes):
+        # Выбираем заголовок по параметру группировки
+        if parameter == 'subcategory_name':
+            title = f'Сумма цен заказов по подкатегориям ({currency})'
+        elif parameter == 'buyer_username':
+            title = f'Сумма цен заказов по никнеймам покупателей ({currency})'
+        elif parameter == 'game_name':
+            title = f'Сумма цен заказов по названиям игр ({currency})'
+        else:
+            raise ValueError(f"Неподдерживаемый параметр: {parameter}")
+
+        # Суммы цен уже посчитаны в aggregate_orders, сортируем по убыванию
+        orders_by_parameter = price_by_currency[currency]
+        sorted_orders = orders_by_parameter.sum(axis=1).sort_values(ascending=False).index
+        orders_by_parameter = orders_by_parameter.loc[sorted_orders]
+
+        # Получаем только топ-X значений
+        top_x_orders = orders_by_parameter.head(head)[::-1]
+
+        # Строим столбчатую диаграмму
+        colors = {0: 'blue', 1: 'green', 2: 'orange'}
+        labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
+        # Строим столбчатую диаграмму, если столбцов не более 10
+        bars = top_x_orders.plot(kind='barh', stacked=False, ax=ax,
+                                 color=[colors[col] for col in top_x_orders.columns])
+
+        # Добавляем подписи над столбцами с суммой цен
+        for rect in bars.patches:
+            width = rect.get_width()
+            ax.annotate(
+                f"{(int(width) if int(width) == width else width.round(2))} {currency}" if width else "",
+                xy=(width, rect.get_y() + rect.get_height() / 2),
+                xytext=(3, 0),  # 3 points horizontal offset
+                textcoords="offset points",
+                ha='left', va='center')
+        ax.legend([labels[lb] for lb in top_x_orders.columns], loc='lower right')
+
+        ax.set_title(title)
+        ax.set_xlabel("")
+        ax.set_ylabel('')
+        my_cyberpunk(ax, bars)
+        non_empty_plots += 1
+
+    # Если есть непустые графики, то сохраняем изображение
+    if non_empty_plots > 0:
+
+        fig.tight_layout()
+        fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
+                 fontsize=10, color='gray', alpha=0.5)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=300)
+
+        return buf.getvalue()
+    else:
+        return None  # Возвращаем None, если нет непустых графиков
+
+
+def render_charts(jobs: list) -> list:
+    """Рисует независимые графики (функция отрисовки, аргументы) в пуле потоков.
+
+    Каждый график — свой Figure без pyplot, поэтому у потоков нет общего состояния фигур.
+    Стиль cyberpunk меняет глобальные rcParams, поэтому он включается один раз на весь вызов, до запуска потоков.
+    Сжатие PNG в savefig идёт без GIL, остальная отрисовка — под ним.
+    """
+    workers = min(len(jobs), os.cpu_count() or 1)
+    with matplotlib.style.context('cyberpunk'):
+        if workers <= 1:
+            return [draw(*args) for draw, args in jobs]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graphs") as executor:
+            return list(executor.map(lambda job: job[0](*job[1]), jobs))
+
+
 def init_commands(cardinal: Cardinal, *args):
     if not cardinal.telegram:
         return
@@ -91,6 +560,7 @@ def init_commands(cardinal: Cardinal, *args):
         keyboard = K()
         keyboard.add(B(f"Head: {SETTINGS['head']}", callback_data=f"{CBT_TEXT_CHANGE_COUNT}:head"))
         keyboard.add(B(f"Min4Line: {SETTINGS['min4line']}", callback_data=f"{CBT_TEXT_CHANGE_COUNT}:min4line"))
+        keyboard.add(B(f"Recheck: {SETTINGS['recheck']}", callback_data=f"{CBT_TEXT_CHANGE_COUNT}:recheck"))
         keyboard.row_width = 2
         for i in range(1, 10, 2):
             keyboard.row(
@@ -103,7 +573,8 @@ def init_commands(cardinal: Cardinal, *args):
 
         bot.edit_message_text("Настройки плагина графиков.\n\n"
                               "<b>Head:</b> Для столбчатых диаграмм отображать первые <u>X</u> значений.\n\n"
-                              "<b>Min4Line:</b> Рисовать линейный график, если количество столбцов не менее <u>X</u>.\n"
+                              "<b>Min4Line:</b> Рисовать линейный график, если количество столбцов не менее <u>X</u>.\n\n"
+                              "<b>Recheck:</b> Заказы хранятся локально, при каждом запуске заново проверяются статусы заказов за последние <u>X</u> дн.\n"
                               "Номера графиков можно посмотреть в конце подписи к каждому изображению при использовании /graphs",
                               call.message.chat.id, call.message.id,
                               reply_markup=keyboard)
@@ -139,394 +610,73 @@ def init_commands(cardinal: Cardinal, *args):
         save_config()
         bot.reply_to(message, f"✅ Успех: {count}", reply_markup=keyboard)
 
+    def fetch_sales(**kwargs):
+        for i in range(2, -1, -1):
+            try:
+                return acc.get_sales(**kwargs)
+            except:
+                logger.warning(f"{LOGGER_PREFIX} Не удалось получить заказы. Осталось попыток: {i}")
+                logger.debug("TRACEBACK", exc_info=True)
+                time.sleep(2)
+        raise Exception("Не удалось спарсить")
+
+    def report_progress(c: int, next_order_id, new_mes: telebot.types.Message):
+        str4tg = f"Обновляю статистику аккаунта. Запрос N{c}. Последний заказ: <a href='https://funpay.com/orders/{next_order_id}/'>{next_order_id}</a>"
+        logger.debug(f"{LOGGER_PREFIX} {str4tg}")
+        if c % 5 == 0:
+            try:
+                msg = bot.edit_message_text(str4tg, new_mes.chat.id, new_mes.id)
+                logger.debug(f"{LOGGER_PREFIX} Сообщение изменено. {msg}")
+            except:
+                logger.warning(f"{LOGGER_PREFIX} Не получилось изменить сообщение.")
+                logger.debug("TRACEBACK", exc_info=True)
+
     def orders_generator(days: list(float), new_mes: telebot.types.Message):
         now = datetime.now()
         days.sort()
-        max_seconds = days[-1] * 3600 * 24
-        next_order_id, all_sales, locale, subcs = acc.get_sales()
+        cache = get_sales_cache(acc.id)
+        tail_date = cache.tail_date
+        recheck_border = now - timedelta(days=SETTINGS["recheck"])
+        # Свежие страницы: до стыка с кэшем и не меньше recheck дн., чтобы обновить статусы недавних заказов.
+        # Без кэша сканируем сразу на глубину самого большого периода.
+        head_border = now - timedelta(days=days[-1]) if tail_date is None else recheck_border
+        next_order_id, head, locale, subcs = fetch_sales()
+        connected = tail_date is not None and cache.contains_any([sale.id for sale in head])
         c = 1
-        while next_order_id != None and (now - all_sales[-1].date).total_seconds() < max_seconds:
+        while next_order_id is not None and head and not (head[-1].date < head_border and
+                                                          (connected or tail_date is None)):
+            if tail_date is not None and not connected and head[-1].date < tail_date:
+                logger.warning(f"{LOGGER_PREFIX} Свежие заказы не стыкуются с кэшем, кэш будет собран заново.")
+                tail_date = None
+                head_border = now - timedelta(days=days[-1])
+                continue
             time.sleep(1)
-            for i in range(2, -1, -1):
-                try:
-                    next_order_id, new_sales, locale, subcs = acc.get_sales(start_from=next_order_id,
-                                                                            sudcategories=subcs,
-                                                                            locale=locale)
-                    break
-                except:
-                    logger.warning(f"{LOGGER_PREFIX} Не удалось получить заказы. Осталось попыток: {i}")
-                    logger.debug("TRACEBACK", exc_info=True)
-                    time.sleep(2)
-            else:
-                raise Exception("Не удалось спарсить")
-            all_sales += new_sales
-            str4tg = f"Обновляю статистику аккаунта. Запрос N{c}. Последний заказ: <a href='https://funpay.com/orders/{next_order_id}/'>{next_order_id}</a>"
-            logger.debug(f"{LOGGER_PREFIX} {str4tg}")
-            if c % 5 == 0:
-                try:
-                    msg = bot.edit_message_text(str4tg, new_mes.chat.id, new_mes.id)
-                    logger.debug(f"{LOGGER_PREFIX} Сообщение изменено. {msg}")
-                except:
-                    logger.warning(f"{LOGGER_PREFIX} Не получилось изменить сообщение.")
-                    logger.debug("TRACEBACK", exc_info=True)
-            while (days and (now - all_sales[-1].date).total_seconds() > days[0] * 3600 * 24):
-                temp_list = [sale for sale in all_sales if (now - sale.date).total_seconds() < days[0] * 3600 * 24]
-                bot.edit_message_text(f"Закончил сканировать заказы за последние {days[0]} дн..", new_mes.chat.id,
-                                      new_mes.id)
-                yield days[0], temp_list
-                del days[0]
+            next_order_id, new_sales, locale, subcs = fetch_sales(start_from=next_order_id, sudcategories=subcs,
+                                                                   locale=locale)
+            connected = connected or (tail_date is not None and cache.contains_any([sale.id for sale in new_sales]))
+            head += new_sales
+            report_progress(c, next_order_id, new_mes)
             c += 1
-        all_sales = [sale for sale in all_sales if (now - sale.date).total_seconds() < max_seconds]
-        if all_sales and days:
-            yield days[0], all_sales
-
-    def get_color(status: OrderStatuses):
-        try:
-            return ("blue", "green", "orange")[status]
-        except:
-            return "black"
-
-    def get_text(status: OrderStatuses):
-        try:
-            return ("Оплачен", "Закрыт", "Возврат")[status]
-        except:
-            return "Какой-то статус"
-
-    def my_cyberpunk(ax, bars=None):
-        # mplcyberpunk.make_lines_glow(ax)
-        # mplcyberpunk.add_underglow(ax)
-        mplcyberpunk.add_gradient_fill(ax=ax)
-        # mplcyberpunk.add_glow_effects(ax, gradient_fill=True)
-        # mplcyberpunk.add_gradient_fill(ax)
-        try:
-            mplcyberpunk.make_scatter_glow(ax)
-        except:
-            pass
-        if bars is not None:
-            mplcyberpunk.add_bar_gradient(bars.patches, ax=ax, horizontal=True)
-
-    def df_update_dates(df):
-        df['date'] = pd.to_datetime(df['date']).dt.floor('D')  # Округляем до дня
-
-        # Создаем все комбинации дат и статусов
-        all_dates = pd.date_range(start=df['date'].min(), end=df['date'].max(), freq='D')
-        all_statuses = df['status'].unique()
-        all_combinations = pd.MultiIndex.from_product([all_dates, all_statuses], names=['date', 'status'])
-
-        # Создаем полный датафрейм с уникальными комбинациями
-        full_df = pd.DataFrame(index=all_combinations).reset_index()
-
-        # Объединяем с исходным датафреймом
-        result_df = pd.merge(full_df, df, how='left', on=['date', 'status']).fillna(0)
-        # Ваш дополненный датафрейм
-
-        df = result_df
-        df['date'] = pd.to_datetime(df['date'])
-
-        # Добавляем столбец с годом, месяцем и днем
-        df['year'] = df['date'].dt.to_period('Y')
-        df['month'] = df['date'].dt.to_period('M')
-        df['day'] = df['date'].dt.to_period('d')
-        return df
-
-    def draw_price_time(orders_list, currency, min4line: int):
-        with plt.style.context('cyberpunk'):
-            # Преобразуем список заказов в DataFrame
-            data = {
-                'date': [order.date for order in orders_list if str(order.currency) == currency],
-                'price': [order.price for order in orders_list if str(order.currency) == currency],
-                'status': [order.status.value for order in orders_list if str(order.currency) == currency]
-            }
-            df = pd.DataFrame(data)
-            df = df_update_dates(df)
-
-            # Проверяем, все ли данные относятся к одному году или месяцу
-            unique_years = df['year'].nunique() > 1
-            unique_months = df['month'].nunique() > 1
-
-            # Группируем данные по году, месяцу и дню
-            orders_by_year = df.groupby(['year', 'status']).price.sum().unstack(fill_value=0)
-            orders_by_month = df.groupby(['month', 'status']).price.sum().unstack(fill_value=0)
-            orders_by_day = df.groupby(['day', 'status']).price.sum().unstack(fill_value=0)
-
-            rows = int(unique_years) + int(unique_months) + 1
-            # Строим графики
-            fig, axs = plt.subplots(rows, 1, figsize=(10, 5 * rows))
-            if type(axs) != np.ndarray:
-                axs = [axs]
-            ord_data = [orders_by_day]
-            if unique_months:
-                ord_data.append(orders_by_month)
-            if unique_years:
-                ord_data.append(orders_by_year)
-
-            # Добавляем аннотации и корректные подписи столбцов с цветами
-            for ax, orders_data, x_title in zip(axs, ord_data, ['День', "Месяц", "Год"]):
-                bars = None
-                if len(orders_data) < min4line:
-                    colors = {0: 'blue', 1: 'green', 2: 'orange'}
-                    labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
-                    # Строим столбчатую диаграмму, если столбцов не более 10
-                    bars = orders_data[::-1].plot(kind='barh', stacked=False, ax=ax,
-                                                  color=[colors[col] for col in orders_data.columns])
-
-                    # Добавляем подписи над столбцами с суммой
-                    for rect in bars.patches:
-                        width = rect.get_width()
-                        ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
-                                    xy=(width, rect.get_y() + rect.get_height() / 2),
-                                    xytext=(3, 0),  # 3 points horizontal offset
-                                    textcoords="offset points",
-                                    ha='left', va='center')
-
-                    ax.legend([labels[lb] for lb in orders_data.columns])
-                else:
-                    # Строим линейный график, если столбцов более 10
-                    for status in orders_data.columns:
-                        orders_data[status].plot(ax=ax, label=get_text(status), color=get_color(status), marker=".")
-
-                    # Добавляем сетку на линейный график
-                    ax.grid(True)
-
-                    ax.legend()
-                my_cyberpunk(ax, bars)
-                ax.set_title(f'Сумма заказов ({currency}) / {x_title}')
-                ax.set_xlabel("")
-                ax.set_ylabel(f'')
-
-            plt.tight_layout()
-            fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
-                     fontsize=10, color='gray', alpha=0.5)
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', dpi=300)
-            buf.seek(0)
-            plt.close(fig)
-
-            return buf
-
-    def draw_k_sales_time(orders_list, min4line: int):
-        with plt.style.context('cyberpunk'):
-            # Преобразуем список заказов в DataFrame
-            data = {
-                'date': [order.date for order in orders_list],
-                'status': [order.status.value for order in orders_list],
-                "add_to_k": [1 for _ in orders_list]
-            }
-            df = pd.DataFrame(data)
-            df = df_update_dates(df)
-            # Проверяем, все ли данные относятся к одному году или месяцу
-            unique_years = df['year'].nunique() > 1
-            unique_months = df['month'].nunique() > 1
-
-            # Группируем данные по году, месяцу и дню
-            orders_by_year = df.groupby(['year', 'status']).add_to_k.sum().unstack(fill_value=0)
-            orders_by_month = df.groupby(['month', 'status']).add_to_k.sum().unstack(fill_value=0)
-            orders_by_day = df.groupby(['day', 'status']).add_to_k.sum().unstack(fill_value=0)
-
-            rows = int(unique_years) + int(unique_months) + 1
-
-            # Строим графики
-            fig, axs = plt.subplots(rows, 1, figsize=(10, 5 * rows))
-            if type(axs) != np.ndarray:
-                axs = [axs]
-            ord_data = [orders_by_day]
-            if unique_months:
-                ord_data.append(orders_by_month)
-            if unique_years:
-                ord_data.append(orders_by_year)
-
-            # Добавляем аннотации и корректные подписи столбцов с цветами
-            for ax, orders_data, x_title in zip(axs, ord_data, ['День', "Месяц", "Год"]):
-                bars = None
-                if len(orders_data) < min4line:
-                    colors = {0: 'blue', 1: 'green', 2: 'orange'}
-                    labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
-                    # Строим столбчатую диаграмму, если столбцов не более 10
-                    with plt.style.context('cyberpunk'):
-                        bars = orders_data[::-1].plot(kind='barh', stacked=False, ax=ax,
-                                                      color=[colors[col] for col in orders_data.columns])
-
-                    # Добавляем подписи над столбцами с количеством
-                    for rect in bars.patches:
-                        width = rect.get_width()
-                        ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
-                                    xy=(width, rect.get_y() + rect.get_height() / 2),
-                                    xytext=(3, 0),  # 3 points horizontal offset
-                                    textcoords="offset points",
-                                    ha='left', va='center')
-                    ax.legend([labels[lb] for lb in orders_data.columns])
-
-                else:
-                    # Строим линейный график, если столбцов более 10
-                    for status in orders_data.columns:
-                        orders_data[status].plot(ax=ax, label=get_text(status), color=get_color(status), marker=".")
-
-                    # Добавляем сетку на линейный график
-                    ax.grid(True)
-
-                    ax.legend()
-
-                ax.set_title(f'Количество заказов / {x_title}')
-                ax.set_xlabel("")
-                ax.set_ylabel('')
-                my_cyberpunk(ax, bars)
-            plt.tight_layout()
-            fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
-                     fontsize=10, color='gray', alpha=0.5)
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', dpi=300)
-            buf.seek(0)
-            plt.close(fig)
-
-            return buf
-
-    def draw_bar_charts(orders_list, parameter, head: int):
-        with plt.style.context('cyberpunk'):
-            # Создаем DataFrame из списка заказов
-            data = {
-                'subcategory_name': [order.subcategory_name for order in orders_list],
-                'buyer_username': [order.buyer_username for order in orders_list],
-                'game_name': [order.subcategory_name.split(",")[0] for order in orders_list],
-                'status': [order.status.value for order in orders_list]
-            }
-            df = pd.DataFrame(data)
-
-            # Выбираем параметр для группировки
-            if parameter == 'subcategory_name':
-                group_by_parameter = 'subcategory_name'
-                title = 'Количество заказов по подкатегориям'
-            elif parameter == 'buyer_username':
-                group_by_parameter = 'buyer_username'
-                title = 'Количество заказов по никнеймам покупателей'
-            elif parameter == 'game_name':
-                group_by_parameter = 'game_name'
-                title = 'Количество заказов по названиям игр'
-            else:
-                raise ValueError(f"Неподдерживаемый параметр: {parameter}")
-
-            # Группируем данные, считаем количество заказов и сортируем по убыванию
-            orders_by_parameter = df.groupby([group_by_parameter, 'status']).size().unstack(fill_value=0)
-            sorted_orders = orders_by_parameter.sum(axis=1).sort_values(ascending=False).index
-            orders_by_parameter = orders_by_parameter.loc[sorted_orders]
-            # orders_by_parameter = df.groupby([group_by_parameter]).size().sort_values(ascending=False)
-
-            # Получаем только топ-X значений
-            top_x_orders = orders_by_parameter.head(head)[::-1]
-
-            # Строим столбчатую диаграмму
-            fig, ax = plt.subplots(figsize=(10, 10))
-            colors = {0: 'blue', 1: 'green', 2: 'orange'}
-            labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
-            bars = top_x_orders.plot(kind='barh', stacked=False, ax=ax,
-                                     color=[colors[col] for col in top_x_orders.columns])
-
-            # Добавляем подписи над столбцами с количеством
-            for rect in bars.patches:
-                width = rect.get_width()
-                ax.annotate((int(width) if int(width) == width else width.round(2)) if width else "",
-                            xy=(width, rect.get_y() + rect.get_height() / 2),
-                            xytext=(3, 0),  # 3 points horizontal offset
-                            textcoords="offset points",
-                            ha='left', va='center')
-            ax.legend([labels[lb] for lb in top_x_orders.columns], loc='lower right')
-
-            ax.set_title(title)
-            ax.set_xlabel("")
-            ax.set_ylabel('')
-            my_cyberpunk(ax, bars)
-            plt.tight_layout()
-            fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
-                     fontsize=10, color='gray', alpha=0.5)
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', dpi=300)
-            buf.seek(0)
-            plt.close(fig)
-
-            return buf
-
-    def draw_combined_charts(orders_list, parameter, head):
-        with plt.style.context('cyberpunk'):
-            currencies = ['₽', '$', '€']
-            non_empty_plots = 0  # Счетчик непустых графиков
-
-            # Создаем общий график
-            set_curr = set([str(order.currency) for order in orders_list])
-            len_curr = len(set_curr)
-            fig, axes = plt.subplots(len_curr, 1, figsize=(10, 5 * (2 if len_curr == 1 else len_curr)))
-            if type(axes) != np.ndarray:
-                axes = [axes]
-            for currency, ax in zip(sorted(list(set_curr)), axes):
-                currency_orders = [order for order in orders_list if str(order.currency) == currency]
-                # Создаем DataFrame из списка заказов
-                data = {
-                    'subcategory_name': [order.subcategory_name for order in currency_orders],
-                    'buyer_username': [order.buyer_username for order in currency_orders],
-                    'game_name': [order.subcategory_name.split(",")[0] for order in currency_orders],
-                    'status': [order.status.value for order in currency_orders],
-                    'price': [order.price for order in currency_orders]
-                }
-                df = pd.DataFrame(data)
-
-                # Выбираем параметр для группировки
-                if parameter == 'subcategory_name':
-                    group_by_parameter = 'subcategory_name'
-                    title = f'Сумма цен заказов по подкатегориям ({currency})'
-                elif parameter == 'buyer_username':
-                    group_by_parameter = 'buyer_username'
-                    title = f'Сумма цен заказов по никнеймам покупателей ({currency})'
-                elif parameter == 'game_name':
-                    group_by_parameter = 'game_name'
-                    title = f'Сумма цен заказов по названиям игр ({currency})'
-                else:
-                    raise ValueError(f"Неподдерживаемый параметр: {parameter}")
-
-                # Группируем данные, считаем сумму цен заказов и сортируем по убыванию
-                orders_by_parameter = df.groupby([group_by_parameter, 'status'])['price'].sum().unstack(fill_value=0)
-                sorted_orders = orders_by_parameter.sum(axis=1).sort_values(ascending=False).index
-                orders_by_parameter = orders_by_parameter.loc[sorted_orders]
-
-                # Получаем только топ-X значений
-                top_x_orders = orders_by_parameter.head(head)[::-1]
-
-                # Строим столбчатую диаграмму
-                colors = {0: 'blue', 1: 'green', 2: 'orange'}
-                labels = {0: 'Оплачен', 1: 'Закрыт', 2: 'Возврат'}
-                # Строим столбчатую диаграмму, если столбцов не более 10
-                bars = top_x_orders.plot(kind='barh', stacked=False, ax=ax,
-                                         color=[colors[col] for col in top_x_orders.columns])
-
-                # Добавляем подписи над столбцами с суммой цен
-                for rect in bars.patches:
-                    width = rect.get_width()
-                    ax.annotate(
-                        f"{(int(width) if int(width) == width else width.round(2))} {currency}" if width else "",
-                        xy=(width, rect.get_y() + rect.get_height() / 2),
-                        xytext=(3, 0),  # 3 points horizontal offset
-                        textcoords="offset points",
-                        ha='left', va='center')
-                ax.legend([labels[lb] for lb in top_x_orders.columns], loc='lower right')
-
-                ax.set_title(title)
-                ax.set_xlabel("")
-                ax.set_ylabel('')
-                my_cyberpunk(ax, bars)
-                non_empty_plots += 1
-
-            # Если есть непустые графики, то сохраняем изображение
-            if non_empty_plots > 0:
-
-                plt.tight_layout()
-                fig.text(0.01, 0.99, f'FPC {NAME} v{VERSION} by @sidor0912\n{CRD_LINK}', ha='left', va='top',
-                         fontsize=10, color='gray', alpha=0.5)
-                buf = io.BytesIO()
-                fig.savefig(buf, format='png', dpi=300)
-                buf.seek(0)
-                plt.close(fig)
-
-                return buf
-            else:
-                plt.close()
-                return None  # Возвращаем None, если нет непустых графиков
+        # Не состыковались, но дошли до конца истории — кэш тоже собирается заново
+        cache.save_head(head, next_order_id, reset=tail_date is None or not connected)
+        logger.info(f"{LOGGER_PREFIX} Обновлено заказов в кэше: {len(head)}, запросов к FunPay: {c}.")
+
+        # Вглубь сканируем только то, чего в кэше ещё нет
+        for day in days:
+            border = now - timedelta(days=day)
+            while not cache.get_meta("complete") and cache.tail_date > border:
+                time.sleep(1)
+                next_order_id, new_sales, locale, subcs = fetch_sales(start_from=cache.get_meta("tail_id"),
+                                                                       sudcategories=subcs, locale=locale)
+                cache.save_tail(new_sales, next_order_id)
+                report_progress(c, next_order_id, new_mes)
+                c += 1
+            orders = cache.since(border)
+            if not orders:
+                continue
+            bot.edit_message_text(f"Закончил сканировать заказы за последние {day} дн..", new_mes.chat.id,
+                                  new_mes.id)
+            yield day, orders
 
     def get_graphs(m: telebot.types.Message):
         global in_progress
@@ -552,42 +702,33 @@ def init_commands(cardinal: Cardinal, *args):
                               f"Рисовать линейный график, если количество столбцов не менее <u><b>{min4line}</b></u>.\n" \
                               f"Для столбчатых диаграмм отображать первые <u><b>{head}</b></u> значений.\n\n" \
                               f"Сгенерировано с помощью {NAME} v{VERSION} by {CREDITS}"
-                    photos = []
-                    if SETTINGS[a := "graph1"]:
-                        photos.append(InputMediaPhoto(draw_k_sales_time(orders, min4line), caption=f"{caption}\n\n{a}",
-                                                      parse_mode="HTML"))
-                    currencies = sorted(set([str(i.currency) for i in orders]))
+                    # Заказы сворачиваются один раз, в потоки отрисовки уходят только готовые таблицы
+                    aggregated = aggregate_orders(orders_to_columns(orders))
+                    # (номер графика, функция отрисовки, аргументы, скрыть под спойлер)
+                    jobs = []
+                    if SETTINGS["graph1"]:
+                        jobs.append(("graph1", draw_k_sales_time, (aggregated["count_by_day"], min4line), False))
                     list_curr = ["$", "€", "₽"]
-                    for curr in currencies:
+                    for curr in aggregated["currencies"]:
                         graph_num = list_curr.index(curr) + 2
                         if SETTINGS[a := f"graph{graph_num}"]:
-                            photos.append(
-                                InputMediaPhoto(draw_price_time(orders, curr, min4line), caption=f"{caption}\n\n{a}",
-                                                parse_mode="HTML"))
-                    if SETTINGS[a := "graph5"]:
-                        photos.append(InputMediaPhoto(draw_bar_charts(orders, parameter="subcategory_name", head=head),
-                                                      caption=f"{caption}\n\n{a}", parse_mode="HTML"))
-                    if SETTINGS[a := "graph6"]:
-                        photos.append(
-                            InputMediaPhoto(draw_combined_charts(orders, parameter="subcategory_name", head=head),
-                                            caption=f"{caption}\n\n{a}", parse_mode="HTML"))
-                    if SETTINGS[a := "graph7"]:
-                        photos.append(InputMediaPhoto(draw_bar_charts(orders, parameter="game_name", head=head),
-                                                      caption=f"{caption}\n\n{a}", parse_mode="HTML"))
-                    if SETTINGS[a := "graph8"]:
-                        photos.append(
-                            InputMediaPhoto(draw_combined_charts(orders, parameter="game_name", head=head),
-                                            caption=f"{caption}\n\n{a}",
-                                            parse_mode="HTML"))
-                    if SETTINGS[a := "graph9"]:
-                        photos.append(InputMediaPhoto(draw_bar_charts(orders, parameter="buyer_username", head=head),
-                                                      has_spoiler=True, caption=f"{caption}\n\n{a}", parse_mode="HTML"))
-
-                    if SETTINGS[a := "graph10"]:
-                        photos.append(
-                            InputMediaPhoto(draw_combined_charts(orders, parameter="buyer_username", head=head),
-                                            has_spoiler=True, caption=f"{caption}\n\n{a}", parse_mode="HTML"))
-
+                            jobs.append((a, draw_price_time, (aggregated["price_by_day"][curr], curr, min4line), False))
+                    for a, parameter in (("graph5", "subcategory_name"), ("graph7", "game_name"),
+                                         ("graph9", "buyer_username")):
+                        if SETTINGS[a]:
+                            jobs.append((a, draw_bar_charts, (aggregated[parameter]["count"], parameter, head),
+                                         parameter == "buyer_username"))
+                    for a, parameter in (("graph6", "subcategory_name"), ("graph8", "game_name"),
+                                         ("graph10", "buyer_username")):
+                        if SETTINGS[a]:
+                            jobs.append((a, draw_combined_charts, (aggregated[parameter]["price"], parameter, head),
+                                         parameter == "buyer_username"))
+                    # Порядок изображений — по номерам графиков, как и раньше
+                    jobs.sort(key=lambda job: int(job[0][len("graph"):]))
+                    images = render_charts([(draw, args) for _, draw, args, _ in jobs])
+                    photos = [InputMediaPhoto(io.BytesIO(image), caption=f"{caption}\n\n{a}", parse_mode="HTML",
+                                              **({"has_spoiler": True} if spoiler else {}))
+                              for (a, _, _, spoiler), image in zip(jobs, images) if image is not None]
                     bot.send_media_group(new_mes.chat.id, photos)
                     bot.send_message(new_mes.chat.id, f"⬆️ Изображения для {int(days)} дн. ⬆️")
 
@@ -614,6 +755,7 @@ def init_commands(cardinal: Cardinal, *args):
     tg.cbq_handler(open_settings, lambda c: f"{CBT.PLUGIN_SETTINGS}:{UUID}" in c.data)
     tg.msg_handler(edited, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, f"{CBT_TEXT_EDITED}:head"))
     tg.msg_handler(edited, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, f"{CBT_TEXT_EDITED}:min4line"))
+    tg.msg_handler(edited, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, f"{CBT_TEXT_EDITED}:recheck"))
     tg.cbq_handler(switch, lambda c: f"{CBT_TEXT_SWITCH}" in c.data)
 
 